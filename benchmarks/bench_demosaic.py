@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Compares demosaic_image throughput against the previous mask-and-convolve implementation
+on synthetic Bayer frames.
+
+    python benchmarks/bench_demosaic.py --height 1920 --width 2560 --repeat 5
+"""
+import argparse
+
+import numpy as np
+from PIL import Image
+from scipy.ndimage import convolve
+
+from common import best_time, synthetic_bayer_frame
+from mars2020.image_processing import demosaic_image
+
+
+def legacy_demosaic_image(pil_image: Image, pattern="RGGB"):
+    image: np.ndarray = np.array(pil_image, dtype=np.float64).mean(axis=2)
+    image /= 255.0
+
+    channels = dict((channel, np.zeros(image.shape)) for channel in "RGB")
+    for channel, (y, x) in zip(pattern.upper(), [(0, 0), (0, 1), (1, 0), (1, 1)]):
+        channels[channel][y::2, x::2] = 1
+
+    R_m, G_m, B_m = tuple(channels[c].astype(bool) for c in "RGB")
+
+    H_G = np.array([[0, 1, 0], [1, 4, 1], [0, 1, 0]], dtype=np.float64) / 4
+    H_RB = np.array([[1, 2, 1], [2, 4, 2], [1, 2, 1]], dtype=np.float64) / 4
+
+    R = convolve(image * R_m, H_RB)
+    G = convolve(image * G_m, H_G)
+    B = convolve(image * B_m, H_RB)
+
+    output = np.concatenate(
+        [x[..., np.newaxis] for x in np.array([R, G, B], dtype=np.float64)], axis=-1
+    )
+    return Image.fromarray((output * 255).astype(np.uint8), "RGB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--height", type=int, default=1920)
+    parser.add_argument("--width", type=int, default=2560)
+    parser.add_argument("--repeat", type=int, default=5)
+    arguments = parser.parse_args()
+
+    frame = synthetic_bayer_frame(arguments.height, arguments.width)
+    megapixels = arguments.height * arguments.width / 1e6
+    candidates = {
+        "legacy (float64 masks)": lambda: legacy_demosaic_image(frame),
+        "bilinear": lambda: demosaic_image(frame),
+        "malvar": lambda: demosaic_image(frame, method="malvar"),
+    }
+    baseline = None
+    for name, function in candidates.items():
+        seconds = best_time(function, arguments.repeat)
+        baseline = baseline or seconds
+        print(f"{name:>24}: {seconds * 1e3:8.1f} ms  {megapixels / seconds:7.1f} Mpx/s  x{baseline / seconds:.1f}")
+
+
+if __name__ == "__main__":
+    main()
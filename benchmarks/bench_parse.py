@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Measures ImageData.from_image_dictionary throughput and per-record memory over the recorded
+feed page in benchmarks/fixtures, replicated to `--records` records.
+
+    python benchmarks/bench_parse.py --records 20000
+"""
+import argparse
+import tracemalloc
+
+from dateutil.parser import parse as date_parser
+
+from common import best_time, load_records
+from mars2020.image_api import ImageData, parse_date
+
+
+def allocated_bytes(function) -> int:
+    tracemalloc.start()
+    result = function()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    arguments = parser.parse_args()
+
+    records = load_records(arguments.records)
+    dates = [record["date_taken_utc"] for record in records] + [record["date_received"] for record in records]
+    candidates = {
+        "dateutil timestamps": (lambda: [date_parser(date) for date in dates], len(dates)),
+        "parse_date timestamps": (lambda: [parse_date(date) for date in dates], len(dates)),
+        "eager records": (lambda: [ImageData.from_image_dictionary(r) for r in records], len(records)),
+        "lazy records": (lambda: [ImageData.from_image_dictionary(r, lazy=True) for r in records], len(records)),
+        "lazy records, sol+id read": (
+            lambda: [(x.sol, x.image_id) for x in (ImageData.from_image_dictionary(r, lazy=True) for r in records)],
+            len(records),
+        ),
+    }
+    for name, (function, count) in candidates.items():
+        seconds = best_time(function, arguments.repeat)
+        print(f"{name:>26}: {count / seconds:10.0f} items/s  {seconds / count * 1e6:7.2f} us/item")
+    for name in ("eager records", "lazy records"):
+        function, count = candidates[name]
+        print(f"{name:>26}: {allocated_bytes(function) / count:10.0f} bytes/record")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Offline fixtures and timing helpers shared by the benchmarks and the tests.
+"""
+import copy
+import io
+import json
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import typing as ty
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from PIL import Image
+
+# The benchmarks run from a checkout, without installing the package
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+FIXTURE = Path(__file__).parent / "fixtures" / "raw_images_page.json"
+
+
+def load_records(number_of_records: int) -> ty.List[dict]:
+    """
+    The recorded feed page, repeated up to `number_of_records` records.
+    """
+    page = json.loads(FIXTURE.read_text())["images"]
+    return [page[i % len(page)] for i in range(number_of_records)]
+
+
+def numbered_records(number_of_records: int, first: int = 0) -> ty.List[dict]:
+    """
+    Records with unique ids numbered from `first`, newest (highest number) first like the feed, ten per sol.
+    """
+    template = json.loads(FIXTURE.read_text())["images"][0]
+    records = []
+    for n in reversed(range(first, first + number_of_records)):
+        record = copy.deepcopy(template)
+        record["imageid"] = f"NLB_{n // 10:04d}_{671186153 + n:010d}_878ECM_T0030000NCAM08914_1101LUJ01"
+        record["sol"] = n // 10
+        record["date_received"] = f"2021-03-01T00:00:00.{n:06d}Z"
+        records.append(record)
+    return records
+
+
+def cluster_records(
+    number_of_clusters: int, cluster_length: int = 16, image_url: str = "", dimension: ty.Tuple[int, int] = (64, 64)
+) -> ty.List[dict]:
+    """
+    Records with unique ids forming `number_of_clusters` grid clusters, full-res files of `dimension`
+    (width, height) at `image_url`/<n>.png
+    """
+    template = json.loads(FIXTURE.read_text())["images"][0]
+    records = []
+    for n in range(number_of_clusters * cluster_length):
+        cluster, frame = divmod(n, cluster_length)
+        record = copy.deepcopy(template)
+        record["imageid"] = f"ELM_0045_{671186153 + cluster:010d}_000ECM_N0030000EDLC{cluster:05d}_0000LUJ01_{frame:02d}_{n % 10000:04d}"
+        record["image_files"]["full_res"] = f"{image_url}/{n}.png"
+        record["extended"]["dimension"] = f"({dimension[0]},{dimension[1]})"
+        records.append(record)
+    return records
+
+
+def synthetic_bayer_frame(height: int, width: int, seed: int = 0) -> Image.Image:
+    gray = np.random.RandomState(seed).randint(0, 256, (height, width), dtype=np.uint8)
+    return Image.fromarray(np.dstack([gray] * 3), "RGB")
+
+
+def png_bytes(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# A scripted failure answered to one request: {"status": 503, "headers": {"Retry-After": "1"}},
+# {"truncate": n} (a complete response with only the first n bytes of the body)
+# or {"disconnect": n} (n bytes of the body, then the connection is dropped)
+Fault = ty.Dict[str, ty.Any]
+
+
+class FeedServer:
+    """
+    Local stand-in for the raw_images feed and the image host, serving `records` page by page
+    (restricted to the sol range of image_api.sol_feed_url, if given) and `frame` for every
+    /images/<n>.png request. Runs while used as a context manager.
+
+    Feed pages in `fail_pages` answer 404, and `faults[page]` lists faults answered to the next
+    requests for that page, in order. `requests` counts the requests served and `request_times`
+    records when (time.monotonic) each arrived.
+    """
+
+    def __init__(self, records: ty.List[dict], frame: ty.Union[None, Image.Image] = None):
+        self.records = records
+        self.frame = png_bytes(frame if frame is not None else synthetic_bayer_frame(64, 64))
+        self.fail_pages: ty.Set[int] = set()
+        self.faults: ty.Dict[int, ty.List[Fault]] = {}
+        self.requests = 0
+        self.request_times: ty.List[float] = []
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests += 1
+                    server.request_times.append(time.monotonic())
+                url = urlparse(self.path)
+                if url.path.startswith("/images/"):
+                    self.respond(server.frame, {})
+                    return
+                query = parse_qs(url.query)
+                number, page = int(query["num"][0]), int(query["page"][0])
+                with server.lock:
+                    faults = server.faults.get(page)
+                    fault = faults.pop(0) if faults else {}
+                if page in server.fail_pages and number > 1:
+                    fault = {"status": 404}
+                records = server.records
+                for condition in ("condition_2", "condition_3"):
+                    if condition in query:
+                        value, _, operator = query[condition][0].split(":")
+                        records = [
+                            record for record in records
+                            if (record["sol"] >= int(value) if operator == "gte" else record["sol"] <= int(value))
+                        ]
+                body = json.dumps(
+                    {"images": records[page * number: (page + 1) * number], "total_results": len(records)}
+                ).encode("utf-8")
+                self.respond(body, fault)
+
+            def respond(self, body: bytes, fault: Fault):
+                status = fault.get("status", 200)
+                if status != 200:
+                    body = b""
+                body = body[: fault.get("truncate", len(body))]
+                self.send_response(status)
+                for name, value in fault.get("headers", {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if "disconnect" in fault:
+                    self.wfile.write(body[: fault["disconnect"]])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    @property
+    def feed_url(self) -> str:
+        return f"{self.base_url}/api/?feed=raw_images&category=mars2020&feedtype=json"
+
+    @property
+    def image_url(self) -> str:
+        return f"{self.base_url}/images"
+
+    def __enter__(self) -> "FeedServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def best_time(function, repeat: int) -> float:
+    return min(measure(function, repeat))
+
+
+def measure(function, repeat: int) -> ty.List[float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def peak_memory(function) -> int:
+    """
+    Peak bytes allocated (as seen by tracemalloc, which includes NumPy buffers) during one call.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def summarize(times: ty.List[float], items: int, peak_bytes: int) -> ty.Dict[str, float]:
+    quantiles = statistics.quantiles(times, n=100, method="inclusive") if len(times) > 1 else times * 99
+    return {
+        "throughput": items / statistics.median(times),
+        "p50_ms": quantiles[49] * 1e3,
+        "p90_ms": quantiles[89] * 1e3,
+        "p99_ms": quantiles[98] * 1e3,
+        "peak_mb": peak_bytes / 1024 ** 2,
+    }
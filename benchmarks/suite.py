@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Runs the offline benchmark suite and compares it against a stored baseline.
+
+Every case runs against local fixtures only: the recorded feed page in benchmarks/fixtures
+(served page by page from a local HTTP server), synthetic Bayer frames, and an image cache
+in a temporary directory. Each case reports throughput, latency percentiles and peak
+memory (tracemalloc, which includes NumPy buffers).
+
+    python benchmarks/suite.py                           # run everything, compare to baseline.json
+    python benchmarks/suite.py -k demosaic --repeat 10   # run the cases matching "demosaic"
+    python benchmarks/suite.py --save-baseline           # record a new baseline
+
+Exits with status 1 when a case is slower (or uses more memory) than the baseline by more
+than `--tolerance`. Baselines are machine specific, so none is checked in; record one before
+comparing. A baseline keeps the workload arguments it was recorded with (--records, --height, ...)
+and is only compared against runs with the same ones (status 2 otherwise).
+"""
+import argparse
+import json
+import sys
+import tempfile
+import typing as ty
+from pathlib import Path
+
+import numpy as np
+
+from common import FeedServer, cluster_records, load_records, measure, peak_memory, summarize, synthetic_bayer_frame
+
+from mars2020 import image_api as mapi
+from mars2020 import image_processing as imp
+from mars2020 import mosaic
+from mars2020.cache import ImageCache, set_image_cache
+from mars2020.client import HTTPClient
+from mars2020.geo_api import JezeroMap
+
+BASELINE = Path(__file__).parent / "baseline.json"
+# Arguments that change what the cases measure, stored with a baseline
+WORKLOAD_ARGUMENTS = ("records", "workers", "height", "width", "tile_height", "tile_width", "clusters", "points")
+
+# name -> setup(arguments, context) returning (function, items per call)
+Case = ty.Callable[[argparse.Namespace, dict], ty.Tuple[ty.Callable[[], ty.Any], int]]
+CASES: ty.Dict[str, Case] = {}
+
+
+def case(name: str):
+    def register(setup: Case) -> Case:
+        CASES[name] = setup
+        return setup
+    return register
+
+
+@case("fetch.pages")
+def fetch_pages(arguments, context):
+    records = load_records(arguments.records)
+    server = context["stack"](FeedServer(records))
+    client = HTTPClient(pool_size=arguments.workers)
+
+    def function():
+        return mapi.ImageDataCollection.fetch_all_mars2020_imagedata(
+            workers=arguments.workers, page_size=100, feed_url=server.feed_url, client=client, lazy=True
+        )
+    return function, len(records)
+
+
+@case("parse.eager")
+def parse_eager(arguments, context):
+    records = load_records(arguments.records)
+    return lambda: [mapi.ImageData.from_image_dictionary(r) for r in records], len(records)
+
+
+@case("parse.lazy")
+def parse_lazy(arguments, context):
+    records = load_records(arguments.records)
+    return lambda: [mapi.ImageData.from_image_dictionary(r, lazy=True) for r in records], len(records)
+
+
+@case("demosaic.bilinear")
+def demosaic_bilinear(arguments, context):
+    frame = synthetic_bayer_frame(arguments.height, arguments.width)
+    return lambda: imp.demosaic_image(frame), 1
+
+
+@case("demosaic.malvar")
+def demosaic_malvar(arguments, context):
+    frame = synthetic_bayer_frame(arguments.height, arguments.width)
+    return lambda: imp.demosaic_image(frame, method="malvar"), 1
+
+
+@case("clusters")
+def clusters(arguments, context):
+    images = [mapi.ImageData.from_image_dictionary(r) for r in cluster_records(arguments.clusters)]
+    return lambda: imp.get_image_clusters(images), len(images)
+
+
+def _cluster(arguments, context) -> ty.List[mapi.ImageData]:
+    """
+    One 4x4 cluster of synthetic frames, served locally and already in the image cache,
+    so the grid cases measure decoding and composing rather than the network.
+    """
+    if "cluster" not in context:
+        frame = synthetic_bayer_frame(arguments.tile_height, arguments.tile_width)
+        server = context["stack"](FeedServer([], frame))
+        records = cluster_records(
+            1, image_url=server.image_url, dimension=(arguments.tile_width, arguments.tile_height)
+        )
+        context["cluster"] = [mapi.ImageData.from_image_dictionary(r) for r in records]
+        imp.prefetch_images(context["cluster"])
+    return context["cluster"]
+
+
+@case("grid.imageset")
+def grid_imageset(arguments, context):
+    images = _cluster(arguments, context)
+    return lambda: imp.grid_from_imageset(images), len(images)
+
+
+@case("grid.imageset_with_layers")
+def grid_imageset_with_layers(arguments, context):
+    images = _cluster(arguments, context)
+    return lambda: imp.grid_from_imageset_with_layers(images), len(images)
+
+
+@case("mosaic.render")
+def mosaic_render(arguments, context):
+    frame = synthetic_bayer_frame(arguments.tile_height, arguments.tile_width)
+    server = context["stack"](FeedServer([], frame))
+    records = cluster_records(1, image_url=server.image_url, dimension=(arguments.tile_width, arguments.tile_height))
+    for k, record in enumerate(records):
+        # A 360 degree Mastcam-Z panorama, frames overlapping by a few degrees
+        record["camera"]["instrument"] = "MCZ_LEFT"
+        record["extended"].update(mastAz=str(22.5 * k), mastEl="0", subframeRect="(1,1,1648,1200)")
+        record["image_files"] = {"full_res": record["image_files"]["full_res"]}
+    images = [mapi.ImageData.from_image_dictionary(r) for r in records]
+    imp.prefetch_images(images)
+
+    def function():
+        with mosaic.Mosaic.from_images(images, scale=0.5) as result:
+            result.render()
+    return function, len(images)
+
+
+@case("projection.forward")
+def projection_forward(arguments, context):
+    points = np.random.RandomState(0).uniform([77.3, 18.4], [77.5, 18.5], (arguments.points, 2))
+    projection = JezeroMap.get_projection((1000, 500), (77.3, 18.4, 77.5, 18.5))
+    return lambda: projection.forward(points), len(points)
+
+
+@case("projection.coordinate_functions")
+def projection_coordinate_functions(arguments, context):
+    points = np.random.RandomState(0).uniform([77.3, 18.4], [77.5, 18.5], (arguments.points, 2))
+    normalize_long, normalize_lat = JezeroMap.get_coordinate_functions((1000, 500), (77.3, 18.4, 77.5, 18.5))
+    return lambda: (normalize_long(points[:, 0]), normalize_lat(points[:, 1])), len(points)
+
+
+def run(arguments) -> ty.Dict[str, ty.Dict[str, float]]:
+    results = {}
+    servers = []
+    with tempfile.TemporaryDirectory() as cache_directory:
+        set_image_cache(ImageCache(cache_directory))
+        context = {"stack": lambda server: servers.append(server.__enter__()) or server}
+        try:
+            for name, setup in CASES.items():
+                if arguments.k and arguments.k not in name:
+                    continue
+                function, items = setup(arguments, context)
+                function()  # warm up
+                times = measure(function, arguments.repeat)
+                results[name] = summarize(times, items, peak_memory(function))
+                print(format_result(name, results[name]), flush=True)
+        finally:
+            for server in servers:
+                server.__exit__(None, None, None)
+    return results
+
+
+def format_result(name: str, result: ty.Dict[str, float]) -> str:
+    return (
+        f"{name:>32}: {result['throughput']:12.1f} items/s"
+        f"  p50 {result['p50_ms']:9.2f} ms  p90 {result['p90_ms']:9.2f} ms  p99 {result['p99_ms']:9.2f} ms"
+        f"  peak {result['peak_mb']:8.1f} MB"
+    )
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> ty.List[str]:
+    """
+    Returns a line for every case whose throughput fell or peak memory grew by more than `tolerance`.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        reference = baseline[name]
+        speed = result["throughput"] / reference["throughput"]
+        memory = result["peak_mb"] / reference["peak_mb"] if reference["peak_mb"] else 1.0
+        print(f"{name:>32}: x{speed:5.2f} throughput  x{memory:5.2f} peak memory")
+        if speed < 1 - tolerance:
+            regressions.append(f"{name}: throughput x{speed:.2f} of baseline")
+        if memory > 1 + tolerance:
+            regressions.append(f"{name}: peak memory x{memory:.2f} of baseline")
+    return regressions
+
+
+def workload(arguments: argparse.Namespace) -> ty.Dict[str, ty.Any]:
+    return {name: getattr(arguments, name) for name in WORKLOAD_ARGUMENTS}
+
+
+def load_baseline(path: Path) -> ty.Union[None, dict]:
+    """
+    {"arguments": workload arguments, "results": {case: result}}, None if there is no baseline yet.
+    """
+    if not path.exists():
+        return None
+    baseline = json.loads(path.read_text())
+    if "results" not in baseline:
+        # Recorded before baselines kept their arguments
+        return {"arguments": None, "results": baseline}
+    return baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-k", help="only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--records", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--width", type=int, default=1648)
+    parser.add_argument("--tile-height", type=int, default=480)
+    parser.add_argument("--tile-width", type=int, default=640)
+    parser.add_argument("--clusters", type=int, default=500)
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--output", type=Path, help="also write the results as JSON here")
+    arguments = parser.parse_args()
+
+    baseline = load_baseline(arguments.baseline)
+    if not arguments.save_baseline and baseline is not None and baseline["arguments"] != workload(arguments):
+        recorded = baseline["arguments"]
+        if recorded is None:
+            difference = "was recorded without its arguments"
+        else:
+            difference = "was recorded with " + ", ".join(
+                f"--{name.replace('_', '-')} {recorded.get(name)} (not {value})"
+                for name, value in workload(arguments).items()
+                if recorded.get(name) != value
+            )
+        print(
+            f"{arguments.baseline} {difference}; run with the same arguments or record a new baseline "
+            "with --save-baseline",
+            file=sys.stderr,
+        )
+        sys.exit(2)
+    results = run(arguments)
+    if arguments.output:
+        arguments.output.write_text(json.dumps(results, indent=2))
+    if arguments.save_baseline:
+        if baseline is None or baseline["arguments"] != workload(arguments):
+            baseline = {"arguments": workload(arguments), "results": {}}
+        baseline["results"].update(results)
+        arguments.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        return
+    if baseline is None:
+        print(f"No baseline at {arguments.baseline} to compare with, record one with --save-baseline")
+        return
+    regressions = compare(results, baseline["results"], arguments.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import os
+import typing as ty
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from mars2020 import cache, instrumentation
+from mars2020 import image_api as mapi
+from mars2020 import image_processing as imp
+from mars2020.client import HTTPClient, set_client
+
+# (shared memory block name, shape, dtype) of an array handed back by a worker
+SharedArray = ty.Tuple[str, ty.Tuple[int, ...], str]
+
+
+def _to_shared(array: np.ndarray) -> SharedArray:
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    block.close()
+    # The parent unlinks the block once it has copied it out, so the worker mustn't clean it up too
+    resource_tracker.unregister(block._name, "shared_memory")
+    return block.name, array.shape, array.dtype.str
+
+
+def _from_shared(shared: SharedArray) -> np.ndarray:
+    name, shape, dtype = shared
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf).copy()
+    finally:
+        block.close()
+        block.unlink()
+
+
+def _init_worker(cache_directory: str, max_bytes: int, client_settings: ty.Dict[str, ty.Any]):
+    # Forked workers inherit the parent's listeners, but their events are forwarded to the parent instead
+    instrumentation.clear_listeners()
+    # A forked worker must not reuse the parent's pooled connections, so it gets a client of its own
+    client = HTTPClient(**client_settings)
+    set_client(client)
+    # Workers share the parent's on-disk cache, writes to it are atomic
+    cache.set_image_cache(cache.ImageCache(cache_directory, max_bytes=max_bytes, memory_items=4, client=client))
+
+
+def _instrumented(task: ty.Callable, forward_events: bool, *args) -> ty.Tuple[ty.Any, ty.List[instrumentation.Event]]:
+    # Listeners live in the parent, so events measured here are returned with the result for it to emit
+    if not forward_events:
+        return task(*args), []
+    events: ty.List[instrumentation.Event] = []
+    listener = instrumentation.add_listener(events.append)
+    try:
+        return task(*args), events
+    finally:
+        instrumentation.remove_listener(listener)
+
+
+def _decode_frame(image_url: str, demosaic: bool, pattern: str, method: str) -> np.ndarray:
+    image = cache.get_image_cache().get_image(image_url)
+    if demosaic:
+        image = imp.demosaic_image(image, pattern=pattern, method=method)
+    return np.asarray(image)
+
+
+def _demosaic_task(image_url: str, demosaic: bool, pattern: str, method: str) -> SharedArray:
+    return _to_shared(_decode_frame(image_url, demosaic, pattern, method))
+
+
+def _save_grid_task(
+    cluster: ty.List[mapi.ImageData], path: str, layers: bool, pattern: str, method: str
+) -> str:
+    if layers:
+        imp.save_grid_layers(cluster, path, pattern=pattern, method=method)
+    else:
+        imp.save_grid(cluster, path, format="PNG", pattern=pattern, method=method)
+    return path
+
+
+def _grid_task(frames: ty.List[ty.Tuple[str, bool]], pattern: str, method: str) -> SharedArray:
+    return _to_shared(
+        imp.grid_from_frames(
+            [_decode_frame(image_url, demosaic, pattern, method) for image_url, demosaic in frames]
+        )
+    )
+
+
+class BatchProcessor:
+    """
+    Runs decoding, demosaicing and grid composition in a pool of `workers` processes.
+
+    Workers download through the current image cache directory, each with its own HTTP client
+    configured like the cache's (the rate limit split between them), and hand result arrays
+    back through shared memory rather than pickling them. Results come back in input order,
+    or as they complete with `ordered=False`. With `return_exceptions=True` a failed item is
+    yielded with its exception in place of the image, instead of ending the iteration.
+    Events measured in the workers are emitted to the parent's `instrumentation` listeners
+    as each result is collected (those of failed items are lost).
+    """
+
+    def __init__(
+        self,
+        workers: ty.Union[None, int] = None,
+        pattern: str = "RGGB",
+        method: str = "bilinear",
+    ):
+        image_cache = cache.get_image_cache()
+        self.pattern = pattern
+        self.method = method
+        workers = workers or os.cpu_count() or 1
+        client_settings = image_cache.client.settings()
+        rate_limiter = image_cache.client.rate_limiter
+        if rate_limiter is not None:
+            client_settings["rate"] = rate_limiter.rate / workers
+            client_settings["burst"] = max(1, int(rate_limiter.capacity) // workers)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(str(Path(image_cache.directory)), image_cache.max_bytes, client_settings),
+        )
+
+    def __enter__(self) -> "BatchProcessor":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def _submit(self, task: ty.Callable, *args) -> Future:
+        return self.executor.submit(_instrumented, task, instrumentation.enabled(), *args)
+
+    @staticmethod
+    def _results(
+        futures: ty.Dict[Future, ty.Any], ordered: bool, return_exceptions: bool = False, shared: bool = True
+    ) -> ty.Iterator[ty.Tuple[ty.Any, ty.Any]]:
+        pending = dict(futures)
+        try:
+            for future in (futures if ordered else as_completed(futures)):
+                del pending[future]
+                try:
+                    result, events = future.result()
+                except Exception as error:
+                    if not return_exceptions:
+                        raise
+                    yield futures[future], error
+                    continue
+                for event in events:
+                    instrumentation.emit(event)
+                yield futures[future], Image.fromarray(_from_shared(result)) if shared else result
+        finally:
+            # Free the shared memory of results that were never collected
+            for future in pending:
+                if not future.cancel() and shared and future.exception() is None:
+                    _from_shared(future.result()[0])
+
+    def decode(
+        self, images: ty.Iterable[mapi.ImageData], ordered: bool = True, return_exceptions: bool = False
+    ) -> ty.Iterator[ty.Tuple[mapi.ImageData, ty.Union[Image.Image, Exception]]]:
+        """
+        Yields (image, decoded image) pairs, demosaicing Filter-E frames like `ImageData.image_data`.
+        """
+        futures = {
+            self._submit(
+                _demosaic_task,
+                image.image_url,
+                image.instrument_metadata.filter_number == "E",
+                self.pattern,
+                self.method,
+            ): image
+            for image in images
+        }
+        return self._results(futures, ordered, return_exceptions)
+
+    def grids(
+        self,
+        clusters: ty.Iterable[ty.List[mapi.ImageData]],
+        ordered: bool = True,
+        return_exceptions: bool = False,
+    ) -> ty.Iterator[ty.Tuple[ty.List[mapi.ImageData], ty.Union[Image.Image, Exception]]]:
+        """
+        Yields (cluster, grid image) pairs, see `image_processing.grid_from_imageset`.
+        """
+        futures = {}
+        for cluster in clusters:
+            frames = [
+                (image.image_url, image.instrument_metadata.filter_number == "E")
+                for image in imp.sort_cluster(cluster)
+            ]
+            futures[self._submit(_grid_task, frames, self.pattern, self.method)] = cluster
+        return self._results(futures, ordered, return_exceptions)
+
+    def save_grids(
+        self,
+        jobs: ty.Iterable[ty.Tuple[ty.List[mapi.ImageData], ty.Union[str, Path]]],
+        layers: bool = False,
+        ordered: bool = True,
+        return_exceptions: bool = False,
+    ) -> ty.Iterator[ty.Tuple[ty.List[mapi.ImageData], ty.Union[Path, Exception]]]:
+        """
+        Saves the grid of each (cluster, path) in a worker with `image_processing.save_grid` (as PNG),
+        or its tiles with `save_grid_layers` if `layers` is set, and yields (cluster, path) pairs.
+        Only the path comes back from the workers.
+        """
+        futures = {
+            self._submit(_save_grid_task, cluster, str(path), layers, self.pattern, self.method): cluster
+            for cluster, path in jobs
+        }
+        results = self._results(futures, ordered, return_exceptions, shared=False)
+        return ((cluster, result if isinstance(result, Exception) else Path(result)) for cluster, result in results)
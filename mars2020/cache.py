@@ -0,0 +1,303 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import typing as ty
+from collections import OrderedDict
+from pathlib import Path
+
+from PIL import Image
+
+from mars2020 import instrumentation
+from mars2020.client import HTTPClient, get_client
+
+DEFAULT_CACHE_DIRECTORY = Path.home() / ".mars2020" / "images"
+
+
+class MemoryLRU:
+    """
+    Thread-safe mapping holding at most `max_items` entries, dropping the least recently used.
+    Lookups are reported to `instrumentation` under `name`, if given.
+    """
+
+    def __init__(self, max_items: int, name: ty.Union[None, str] = None):
+        self.max_items = max_items
+        self.name = name
+        self._items: ty.OrderedDict[ty.Hashable, ty.Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key: ty.Hashable) -> ty.Any:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+        if self.name is not None:
+            instrumentation.cache_lookup(self.name, value is not None)
+        return value
+
+    def put(self, key: ty.Hashable, value: ty.Any):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class DiskCache:
+    """
+    Files stored under `directory` by the sha256 of a string key, bounded by `max_bytes` with
+    least-recently-used eviction (file mtimes are bumped on every hit). Files are written
+    atomically, so several processes can share one cache directory.
+    """
+
+    def __init__(self, directory: ty.Union[str, Path], max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        # Cache lookups are reported to `instrumentation` under the directory's name
+        self.name = self.directory.name
+        self._lock = threading.Lock()
+        self._size = sum(path.stat().st_size for path in self._data_files())
+
+    @staticmethod
+    def key(name: str) -> str:
+        return hashlib.sha256(name.encode("utf-8")).hexdigest()
+
+    def path_for(self, name: str) -> Path:
+        key = self.key(name)
+        return self.directory / key[:2] / key
+
+    def _data_files(self) -> ty.Iterator[Path]:
+        return (
+            path
+            for path in self.directory.glob("*/*")
+            if path.suffix not in (".meta", ".tmp")
+        )
+
+    def _write_atomic(self, path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def __contains__(self, name: str) -> bool:
+        return self.path_for(name).exists()
+
+    def read(self, name: str) -> ty.Union[None, bytes]:
+        path = self.path_for(name)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            instrumentation.cache_lookup(self.name, False)
+            return None
+        instrumentation.cache_lookup(self.name, True)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass  # evicted by another process sharing the directory since it was read
+        return data
+
+    def write(self, name: str, data: bytes, meta: ty.Union[None, dict] = None):
+        """
+        Stores `data` under `name`, with an optional JSON-serializable `meta` dictionary next to it.
+        """
+        path = self.path_for(name)
+        previous_size = path.stat().st_size if path.exists() else 0
+        self._write_atomic(path, data)
+        if meta is not None:
+            self._write_atomic(path.with_suffix(".meta"), json.dumps(meta).encode("utf-8"))
+        with self._lock:
+            self._size += len(data) - previous_size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def read_meta(self, name: str) -> ty.Union[None, dict]:
+        try:
+            return json.loads(self.path_for(name).with_suffix(".meta").read_text())
+        except FileNotFoundError:
+            return None
+
+    def evict(self):
+        """
+        Removes least recently used files until the cache fits in `max_bytes`.
+        """
+        with self._lock:
+            entries = []
+            for path in self._data_files():
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            self._size = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+                if self._size <= self.max_bytes:
+                    break
+                for stale in (path, path.with_suffix(".meta")):
+                    try:
+                        stale.unlink()
+                    except FileNotFoundError:
+                        pass
+                self._size -= size
+
+    def clear(self):
+        max_bytes, self.max_bytes = self.max_bytes, 0
+        self.evict()
+        self.max_bytes = max_bytes
+
+
+class HTTPCache(DiskCache):
+    """
+    Downloads cached on disk by URL (see DiskCache). The ETag and Last-Modified headers of each
+    download are kept next to it and, with `revalidate=True`, sent back as a conditional GET
+    before a cached copy is reused. Downloads go through `client` (the shared client by default).
+    """
+
+    def __init__(
+        self,
+        directory: ty.Union[str, Path],
+        max_bytes: int,
+        revalidate: bool = False,
+        client: ty.Union[None, HTTPClient] = None,
+    ):
+        super().__init__(directory, max_bytes)
+        self.revalidate = revalidate
+        self.client = get_client() if client is None else client
+
+    def get_bytes(self, url: str) -> bytes:
+        """
+        Returns the bytes behind `url`, downloading them only if they aren't cached
+        (or, when revalidating, if the server says the cached copy is stale).
+        """
+        if not self.revalidate:
+            data = self.read(url)
+            if data is not None:
+                return data
+        headers = {}
+        meta = self.read_meta(url) if url in self else None
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        response = self.client.get(url, headers=headers)
+        if response.status_code == 304:
+            data = self.read(url)
+            if data is not None:
+                return data
+            response = self.client.get(url)
+        elif self.revalidate:
+            instrumentation.cache_lookup(self.name, False)
+        self.client.raise_for_status(response)
+        data = response.content
+        self.write(
+            url,
+            data,
+            meta={
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            },
+        )
+        return data
+
+
+class ImageCache(HTTPCache):
+    """
+    Content cache for downloaded images, keyed by image URL.
+
+    Raw bytes are stored on disk under `directory`, bounded by `max_bytes` and optionally
+    revalidated (see HTTPCache). On top of that, up to `memory_items` decoded images are kept
+    in an in-memory LRU; callers get a copy of the cached image, which is theirs to modify.
+    """
+
+    def __init__(
+        self,
+        directory: ty.Union[str, Path] = DEFAULT_CACHE_DIRECTORY,
+        max_bytes: int = 2 * 1024 ** 3,
+        memory_items: int = 32,
+        revalidate: bool = False,
+        client: ty.Union[None, HTTPClient] = None,
+    ):
+        super().__init__(directory, max_bytes, revalidate=revalidate, client=client)
+        self.memory_items = memory_items
+        self._decoded = MemoryLRU(memory_items, name=f"{self.name}.decoded")
+
+    def open(self, url: str) -> Image.Image:
+        """
+        Lazily opens the cached file behind `url` (downloading it if needed), without going
+        through the in-memory LRU. Only the header is read until the pixels are accessed.
+        """
+        path = self.path_for(url)
+        if not path.exists() or self.revalidate:
+            self.get_bytes(url)
+        try:
+            return Image.open(path)
+        except FileNotFoundError:
+            # Evicted by another process sharing the directory in the meantime
+            return Image.open(io.BytesIO(self.get_bytes(url)))
+
+    def get_image(
+        self, url: str, demosaic: bool = False, size: ty.Union[None, ty.Tuple[int, int]] = None
+    ) -> Image.Image:
+        """
+        Returns the decoded image behind `url`, demosaiced if `demosaic` is set and scaled down
+        to fit in `size` (width, height) if given. JPEGs are then decoded at the smallest
+        resolution still at least `size`.
+        """
+        from mars2020.image_processing import demosaic_image
+
+        key = (url, demosaic, size)
+        image = self._decoded.get(key)
+        if image is not None:
+            return image.copy()
+        if size is None:
+            image = Image.open(io.BytesIO(self.get_bytes(url)))
+        else:
+            image = self.open(url)
+            if not demosaic:
+                image.draft(None, size)
+        with instrumentation.timed("decode", "image", size=image.width * image.height):
+            image.load()
+        if demosaic:
+            image = demosaic_image(image)
+        if size is not None:
+            image.thumbnail(size)
+        self._decoded.put(key, image)
+        return image.copy()
+
+    def clear(self):
+        self._decoded.clear()
+        super().clear()
+
+
+_image_cache: ty.Union[None, ImageCache] = None
+
+
+def get_image_cache() -> ImageCache:
+    """
+    Returns the cache used by `ImageData.image_data`, creating the default one on first use.
+    """
+    global _image_cache
+    if _image_cache is None:
+        _image_cache = ImageCache()
+    return _image_cache
+
+
+def set_image_cache(cache: ImageCache):
+    global _image_cache
+    _image_cache = cache
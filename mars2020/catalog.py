@@ -0,0 +1,290 @@
+import json
+import math
+import sqlite3
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from mars2020 import image_api as mapi
+from mars2020 import instrumentation
+from mars2020.client import HTTPClient, get_client
+
+DEFAULT_CATALOG_PATH = Path.home() / ".mars2020" / "catalog.sqlite"
+# A sol, or an inclusive (first, last) range of sols
+Sols = ty.Union[int, ty.Tuple[int, int]]
+
+
+class Catalog:
+    """
+    Persistent local copy of the raw_images feed, stored in SQLite and keyed by image_id.
+
+    The raw feed records are kept as JSON so that `ImageData` can be rebuilt from them
+    without touching the network. `sync` only fetches feed pages until it reaches records
+    that are already known, and resumes an interrupted first sync where it stopped.
+    """
+
+    def __init__(self, path: ty.Union[str, Path] = DEFAULT_CATALOG_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS images (
+                image_id TEXT PRIMARY KEY,
+                sol INTEGER,
+                date_received TEXT,
+                record TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS images_sol ON images (sol);
+            CREATE INDEX IF NOT EXISTS images_date_received ON images (date_received);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+        )
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def __enter__(self) -> "Catalog":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @property
+    def last_date_received(self) -> ty.Union[None, str]:
+        return self.connection.execute(
+            "SELECT MAX(date_received) FROM images"
+        ).fetchone()[0]
+
+    @property
+    def last_sol(self) -> ty.Union[None, int]:
+        return self.connection.execute("SELECT MAX(sol) FROM images").fetchone()[0]
+
+    def _get_state(self, key: str) -> ty.Any:
+        row = self.connection.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _set_state(self, key: str, value: ty.Any):
+        self.connection.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?)", (key, json.dumps(value)))
+
+    @property
+    def complete(self) -> bool:
+        """
+        Whether a full sync has finished (catalogs from before sync state was kept count as complete).
+        """
+        state = self._get_state("full_sync")
+        return bool(len(self)) if state is None else state.get("complete", False)
+
+    def upsert(self, records: ty.Iterable[dict]) -> int:
+        """
+        Inserts or replaces raw feed records, returns the number of records written.
+        """
+        with self.connection:
+            return self._write(records)
+
+    def _write(self, records: ty.Iterable[dict]) -> int:
+        rows = [
+            (
+                record["imageid"],
+                record.get("sol"),
+                record.get("date_received"),
+                json.dumps(record, separators=(",", ":")),
+            )
+            for record in records
+        ]
+        self.connection.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def known_image_ids(self, image_ids: ty.Iterable[str]) -> ty.Set[str]:
+        image_ids = list(image_ids)
+        known: ty.Set[str] = set()
+        # Stay below SQLite's default limit on host parameters
+        for start in range(0, len(image_ids), 500):
+            chunk = image_ids[start : start + 500]
+            known.update(
+                row[0]
+                for row in self.connection.execute(
+                    f"SELECT image_id FROM images WHERE image_id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+        return known
+
+    def sync(
+        self,
+        page_size: int = 100,
+        workers: int = 8,
+        retries: ty.Union[None, int] = None,
+        feed_url: str = mapi.RAW_IMAGES_FEED,
+        client: ty.Union[None, HTTPClient] = None,
+    ) -> int:
+        """
+        Brings the catalog up to date with the feed and returns the number of new records.
+
+        An empty catalog is filled with a concurrent full fetch, which records the pages it has
+        stored so that an interrupted one is resumed by the next call rather than left incomplete.
+        Otherwise pages are fetched newest first and the sync stops at the first page that holds
+        nothing newer than the last seen date_received, so a warm start costs one or two requests.
+        """
+        client = get_client() if client is None else client
+        if not self.complete:
+            return self._full_sync(page_size, workers, retries, feed_url, client)
+        return self._sync_newer(self.last_date_received or "", page_size, retries, feed_url, client)
+
+    def _full_sync(
+        self, page_size: int, workers: int, retries: ty.Union[None, int], feed_url: str, client: HTTPClient
+    ) -> int:
+        before = len(self)
+        newest = mapi.fetch_feed_page(1, 0, client=client, feed_url=feed_url, retries=retries)
+        total = newest["total_results"]
+        state = self._get_state("full_sync")
+        if state is None or "page_size" not in state:
+            state = {
+                "page_size": page_size,
+                "total": total,
+                "newest": newest["images"][0].get("date_received") if newest["images"] else None,
+                "done": [],
+            }
+            remaining = set(range(math.ceil(total / page_size)))
+        else:
+            # Images published since the interrupted sync push older ones down the feed, so the
+            # pages still missing are looked up by offset. Newer images are fetched afterwards.
+            page_size = state["page_size"]
+            shift = total - state["total"]
+            remaining = set()
+            for page in set(range(math.ceil(state["total"] / page_size))) - set(state["done"]):
+                first = max(0, page * page_size + shift)
+                last = max(0, (page + 1) * page_size + shift - 1)
+                remaining.update(range(first // page_size, last // page_size + 1))
+            state["total"] = total
+            state["done"] = sorted(set(range(math.ceil(total / page_size))) - remaining)
+        with self.connection:
+            self._set_state("full_sync", state)
+
+        def fetch_page(page_number: int) -> ty.Tuple[int, dict]:
+            return page_number, mapi.fetch_feed_page(
+                page_size, page_number, client=client, feed_url=feed_url, retries=retries
+            )
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fetch_page, page_number) for page_number in sorted(remaining)]
+            try:
+                for future in as_completed(futures):
+                    page_number, json_data = future.result()
+                    state["done"].append(page_number)
+                    with self.connection:
+                        self._write(json_data["images"])
+                        self._set_state("full_sync", state)
+            finally:
+                for future in futures:
+                    future.cancel()
+        if state["newest"] is not None:
+            self._sync_newer(state["newest"], page_size, retries, feed_url, client)
+        with self.connection:
+            self._set_state("full_sync", {"complete": True})
+        return len(self) - before
+
+    def sync_sols(
+        self,
+        sols: ty.Iterable[Sols],
+        page_size: int = 100,
+        workers: int = 8,
+        retries: ty.Union[None, int] = None,
+        feed_url: str = mapi.RAW_IMAGES_FEED,
+        client: ty.Union[None, HTTPClient] = None,
+    ) -> int:
+        """
+        Fetches only the records of the given sols or inclusive (first, last) ranges of sols, and
+        returns the number of new records. A catalog filled this way still gets a full `sync`.
+        """
+        client = get_client() if client is None else client
+        before = len(self)
+        if not before:
+            with self.connection:
+                self._set_state("full_sync", {"complete": False})
+        for sol in sols:
+            first, last = sol if isinstance(sol, tuple) else (sol, sol)
+            for json_data in mapi.fetch_all_feed_pages(
+                workers=workers,
+                page_size=page_size,
+                retries=retries,
+                feed_url=mapi.sol_feed_url(first, last, feed_url),
+                client=client,
+            ):
+                self.upsert(json_data["images"])
+        return len(self) - before
+
+    def _sync_newer(
+        self,
+        last_date_received: str,
+        page_size: int,
+        retries: ty.Union[None, int],
+        feed_url: str,
+        client: HTTPClient,
+    ) -> int:
+        new_records = 0
+        page_number = 0
+        while True:
+            records = mapi.fetch_feed_page(
+                page_size,
+                page_number,
+                client=client,
+                feed_url=feed_url,
+                retries=retries,
+            )["images"]
+            if not records:
+                break
+            known = self.known_image_ids(record["imageid"] for record in records)
+            new_records += sum(record["imageid"] not in known for record in records)
+            self.upsert(records)
+            if not any(
+                (record.get("date_received") or "") > last_date_received
+                for record in records
+            ):
+                break
+            page_number += 1
+        return new_records
+
+    def records(
+        self,
+        sol: ty.Union[None, Sols] = None,
+    ) -> ty.Iterator[dict]:
+        """
+        Yields the stored records, all of them or those of one sol or an inclusive (first, last) range of sols.
+        """
+        if sol is None:
+            rows = self.connection.execute("SELECT record FROM images ORDER BY rowid")
+        elif isinstance(sol, tuple):
+            rows = self.connection.execute(
+                "SELECT record FROM images WHERE sol BETWEEN ? AND ? ORDER BY rowid", sol
+            )
+        else:
+            rows = self.connection.execute(
+                "SELECT record FROM images WHERE sol = ? ORDER BY rowid", (sol,)
+            )
+        return (json.loads(row[0]) for row in rows)
+
+    def to_table(self, sol: ty.Union[None, Sols] = None):
+        """
+        Returns an `ImageTable` over the stored records; `ImageData` objects are only built on access.
+        """
+        from mars2020.table import ImageTable
+
+        return ImageTable.from_records(list(self.records(sol=sol)))
+
+    def to_collection(
+        self, sol: ty.Union[None, Sols] = None, lazy: bool = False
+    ) -> mapi.ImageDataCollection:
+        with instrumentation.timed("parse", "lazy" if lazy else "eager") as timer:
+            images = [
+                mapi.ImageData.from_image_dictionary(record, lazy=lazy)
+                for record in self.records(sol=sol)
+            ]
+            timer.size = len(images)
+        return mapi.ImageDataCollection(images, None, len(images), len(images))
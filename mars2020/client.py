@@ -0,0 +1,290 @@
+"""
+The HTTP client every request in the library goes through: the raw_images feed, image downloads
+(via `ImageCache`), the waypoint/traverse GeoJSON and the Jezero WMS.
+
+One `HTTPClient` keeps a pool of keep-alive connections (HTTP/2 when httpx and h2 are installed),
+limits the request rate with a token bucket, retries connection errors, 429 and 5xx responses with
+jittered exponential backoff, and applies connect/read timeouts. Configure the shared one with
+`set_client`, or pass a client explicitly where functions accept one:
+
+    set_client(HTTPClient(pool_size=32, rate=10, burst=20))
+
+Whichever backend is used, failures are raised as `requests` exceptions.
+"""
+import contextlib
+import email.utils
+import importlib.util
+import json
+import random
+import threading
+import time
+import typing as ty
+
+import requests as rq
+from requests.adapters import HTTPAdapter
+
+from mars2020 import instrumentation
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class TokenBucket:
+    """
+    Allows `rate` acquisitions per second on average and bursts of up to `burst`. Thread-safe;
+    `acquire` blocks until a token is available.
+    """
+
+    def __init__(self, rate: float, burst: ty.Union[None, int] = None):
+        self.rate = rate
+        self.capacity = float(burst if burst is not None else max(1, int(rate)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        # Tokens are reserved under the lock and waited for outside it, so callers queue in order
+        if wait:
+            time.sleep(wait)
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("httpx") is not None and importlib.util.find_spec("h2") is not None
+
+
+class HTTPClient:
+    """
+    Shared, thread-safe HTTP client, see the module docstring.
+
+    `rate` is in requests per second (None for no limit), `retries` is the number of retries after
+    the first attempt, and the n-th retry waits a random time up to `backoff * 2 ** n` seconds
+    (capped at `max_backoff`), or as long as a Retry-After header asks.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 16,
+        rate: ty.Union[None, float] = None,
+        burst: ty.Union[None, int] = None,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+        timeout: float = 30.0,
+        connect_timeout: float = 10.0,
+        http2: bool = True,
+        headers: ty.Union[None, ty.Dict[str, str]] = None,
+    ):
+        self._settings = dict(
+            pool_size=pool_size, rate=rate, burst=burst, retries=retries, backoff=backoff,
+            max_backoff=max_backoff, timeout=timeout, connect_timeout=connect_timeout,
+            http2=http2, headers=headers,
+        )
+        self.pool_size = pool_size
+        self.rate_limiter = None if rate is None else TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.http2 = http2 and http2_available()
+        if self.http2:
+            import httpx
+
+            self._client = httpx.Client(
+                http2=True,
+                headers=headers,
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                follow_redirects=True,
+            )
+        else:
+            self._client = rq.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self._client.mount("http://", adapter)
+            self._client.mount("https://", adapter)
+            if headers:
+                self._client.headers.update(headers)
+
+    def settings(self) -> ty.Dict[str, ty.Any]:
+        """
+        The arguments this client was created with, e.g. to build an equivalent one in another process.
+        """
+        return dict(self._settings)
+
+    def _timeout(self, timeout: ty.Union[None, float]):
+        read = self.timeout if timeout is None else timeout
+        if self.http2:
+            import httpx
+
+            return httpx.Timeout(read, connect=self.connect_timeout)
+        return self.connect_timeout, read
+
+    def retry_delay(self, attempt: int, response=None) -> float:
+        """
+        Seconds to wait before retry number `attempt` (from 0): full jitter, or the response's Retry-After.
+        """
+        retry_after = None if response is None else response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0.0), self.max_backoff)
+        return random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+
+    def _send(self, url: str, params, headers, timeout, stream: bool):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        start = time.perf_counter()
+        if self.http2:
+            import httpx
+
+            try:
+                request = self._client.build_request(
+                    "GET", url, params=params, headers=headers, timeout=self._timeout(timeout)
+                )
+                response = self._client.send(request, stream=stream)
+            except httpx.TimeoutException as error:
+                raise rq.Timeout(str(error)) from error
+            except httpx.HTTPError as error:
+                raise rq.ConnectionError(str(error)) from error
+        else:
+            response = self._client.get(
+                url, params=params, headers=headers, timeout=self._timeout(timeout), stream=stream
+            )
+        if instrumentation.enabled():
+            size = int(response.headers.get("Content-Length") or 0) if stream else len(response.content)
+            instrumentation.emit(
+                instrumentation.Event(
+                    "http",
+                    instrumentation.endpoint(url),
+                    time.perf_counter() - start,
+                    size,
+                    status=response.status_code,
+                )
+            )
+        return response
+
+    def get(
+        self,
+        url: str,
+        params: ty.Union[None, dict] = None,
+        headers: ty.Union[None, dict] = None,
+        timeout: ty.Union[None, float] = None,
+        retries: ty.Union[None, int] = None,
+        stream: bool = False,
+    ):
+        """
+        GETs `url`, retrying connection errors and 429/5xx responses. Other responses, including
+        errors, are returned as they are (a requests or httpx Response); see `raise_for_status`.
+        """
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                response = self._send(url, params, headers, timeout, stream)
+            except rq.RequestException:
+                if attempt == retries:
+                    raise
+                time.sleep(self.retry_delay(attempt))
+                continue
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                return response
+            response.close()
+            time.sleep(self.retry_delay(attempt, response))
+
+    @staticmethod
+    def raise_for_status(response):
+        if response.status_code >= 400:
+            raise rq.HTTPError(f"{response.status_code} error for url: {response.url}", response=response)
+
+    def get_bytes(self, url: str, params: ty.Union[None, dict] = None, **kwargs) -> bytes:
+        response = self.get(url, params=params, **kwargs)
+        self.raise_for_status(response)
+        return response.content
+
+    def get_json(
+        self, url: str, params: ty.Union[None, dict] = None, retries: ty.Union[None, int] = None, **kwargs
+    ) -> ty.Any:
+        """
+        GETs and decodes a JSON document. A body that doesn't decode (e.g. a truncated response)
+        is retried like a failed request.
+        """
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            data = self.get_bytes(url, params=params, retries=retries, **kwargs)
+            try:
+                return json.loads(data)
+            except ValueError:
+                if attempt == retries:
+                    raise
+                time.sleep(self.retry_delay(attempt))
+
+    @contextlib.contextmanager
+    def stream(
+        self,
+        url: str,
+        params: ty.Union[None, dict] = None,
+        chunk_size: int = 64 * 1024,
+        timeout: ty.Union[None, float] = None,
+        retries: ty.Union[None, int] = None,
+    ) -> ty.Iterator[ty.Iterator[bytes]]:
+        """
+        Context manager giving the body of `url` as an iterator of byte chunks. Only establishing
+        the response is retried; errors while reading the body propagate as requests exceptions.
+        """
+        response = self.get(url, params=params, timeout=timeout, retries=retries, stream=True)
+        try:
+            self.raise_for_status(response)
+            if self.http2:
+                yield self._iter_httpx(response.iter_bytes(chunk_size))
+            else:
+                yield response.iter_content(chunk_size)
+        finally:
+            response.close()
+
+    @staticmethod
+    def _iter_httpx(chunks: ty.Iterator[bytes]) -> ty.Iterator[bytes]:
+        import httpx
+
+        try:
+            yield from chunks
+        except httpx.HTTPError as error:
+            raise rq.ConnectionError(str(error)) from error
+
+    def close(self):
+        self._client.close()
+
+    def __enter__(self) -> "HTTPClient":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_client: ty.Union[None, HTTPClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> HTTPClient:
+    """
+    Returns the client used wherever none is passed explicitly, creating a default one on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HTTPClient()
+        return _client
+
+
+def set_client(client: HTTPClient):
+    global _client
+    with _client_lock:
+        _client = client
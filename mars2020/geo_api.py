@@ -1,12 +1,15 @@
 import typing as ty
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from enum import Enum
-import requests as rq
 from owslib.wms import WebMapService
 from owslib.map import wms111, wms130
 import numpy as np
-from PIL import Image
+from mars2020.client import HTTPClient, get_client
+from mars2020.map_tiles import TileCache, TiledWMSLayer
+
+WAYPOINTS_URL = "https://mars.nasa.gov/mmgis-maps/M20/Layers/json/M20_waypoints.json"
+TRAVERSE_URL = "https://mars.nasa.gov/mmgis-maps/M20/Layers/json/M20_traverse.json"
 
 Longitude = float
 Latitude = float
@@ -104,63 +107,170 @@ class Path:
         return Path(coordinates, properties)
 
 
-def load_elements() -> Elements:
-    waypoints = rq.get("https://mars.nasa.gov/mmgis-maps/M20/Layers/json/M20_waypoints.json").json()["features"]
+def load_elements(client: ty.Union[None, HTTPClient] = None) -> Elements:
+    waypoints = (get_client() if client is None else client).get_json(WAYPOINTS_URL)["features"]
     return (Element.from_element_dict(element) for element in waypoints)
 
 
 Paths = ty.Iterable[Path]
 
 
-def load_paths() -> Paths:
-    paths = rq.get("https://mars.nasa.gov/mmgis-maps/M20/Layers/json/M20_traverse.json").json()["features"]
+def load_paths(client: ty.Union[None, HTTPClient] = None) -> Paths:
+    paths = (get_client() if client is None else client).get_json(TRAVERSE_URL)["features"]
     return (Path.from_path_dict(path) for path in paths)
 
 
 BBox = ty.Tuple[float, float, float, float]
 
 
+def elements_to_array(elements: Elements) -> np.ndarray:
+    """
+    Returns the (N, 2) lon/lat array of waypoint coordinates.
+    """
+    return np.array([element.geometry.coordinate[:2] for element in elements], dtype=np.float64).reshape(-1, 2)
+
+
+def paths_to_arrays(paths: Paths) -> ty.Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the (M, 2) lon/lat coordinates of all paths, concatenated, and the (P + 1,) offsets
+    such that path i is coordinates[offsets[i]:offsets[i + 1]].
+    """
+    arrays = [np.array([coordinate[:2] for coordinate in path.coordinates], dtype=np.float64).reshape(-1, 2)
+              for path in paths]
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum([len(array) for array in arrays], out=offsets[1:])
+    coordinates = np.concatenate(arrays) if arrays else np.empty((0, 2))
+    return coordinates, offsets
+
+
+@dataclass
+class Projection:
+    """
+    Linear mapping between lon/lat in `bbox` (min_lon, min_lat, max_lon, max_lat) and pixel
+    coordinates (x to the right, y down) of a map image of `image_size` (height, width).
+    Works on whole (N, 2) arrays at once.
+    """
+    image_size: ty.Tuple[int, int]
+    bbox: BBox
+
+    @property
+    def scale(self) -> np.ndarray:
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        return np.array([self.image_size[1] / (max_lon - min_lon), -self.image_size[0] / (max_lat - min_lat)])
+
+    @property
+    def origin(self) -> np.ndarray:
+        """
+        lon/lat of the top left corner
+        """
+        return np.array([self.bbox[0], self.bbox[3]])
+
+    def __call__(self, coordinates) -> np.ndarray:
+        return self.forward(coordinates)
+
+    def forward(self, coordinates) -> np.ndarray:
+        """
+        Maps lon/lat (an (N, 2) array, or anything `np.asarray` turns into one) to pixel x/y.
+        """
+        coordinates = np.asarray(coordinates, dtype=np.float64)
+        return (coordinates[..., :2] - self.origin) * self.scale
+
+    def inverse(self, pixels) -> np.ndarray:
+        """
+        Maps pixel x/y back to lon/lat.
+        """
+        return np.asarray(pixels, dtype=np.float64) / self.scale + self.origin
+
+    def project_elements(self, elements: Elements) -> np.ndarray:
+        return self.forward(elements_to_array(elements))
+
+    def project_paths(self, paths: Paths) -> ty.Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the projected coordinates of all paths and their offsets, see `paths_to_arrays`.
+        """
+        coordinates, offsets = paths_to_arrays(paths)
+        return self.forward(coordinates), offsets
+
+
+JEZERO_WMS_URL = "https://maps.planet.fu-berlin.de/jez-bin/wms"
+JEZERO_LAYER = "Jezero Landing Site"
+
+# Capabilities documents already fetched in this process, by (url, version)
+_capabilities: ty.Dict[ty.Tuple[str, str], bytes] = {}
+
+
+def get_capabilities(url: str, version: str = "1.1.1",
+                     tile_cache: ty.Union[None, TileCache] = None,
+                     refresh: bool = False,
+                     client: ty.Union[None, HTTPClient] = None) -> bytes:
+    """
+    Returns the WMS GetCapabilities document, cached in memory and in the tile cache's directory.
+    """
+    key = (url, version)
+    if not refresh and key in _capabilities:
+        return _capabilities[key]
+    disk_key = f"capabilities|{url}|{version}"
+    document = None if (refresh or tile_cache is None) else tile_cache.disk.read(disk_key)
+    if document is None:
+        document = (get_client() if client is None else client).get_bytes(
+            url, params={"service": "WMS", "request": "GetCapabilities", "version": version}
+        )
+        if tile_cache is not None:
+            tile_cache.disk.write(disk_key, document)
+    _capabilities[key] = document
+    return document
+
+
 @dataclass
 class JezeroMap:
     map: ty.Union[wms111.WebMapService_1_1_1, wms130.WebMapService_1_3_0]
+    tiles: ty.Union[None, TiledWMSLayer] = field(default=None, repr=False)
+    client: ty.Union[None, HTTPClient] = field(default=None, repr=False)
 
-    @classmethod
-    def from_wms_url(cls, url: str = "https://maps.planet.fu-berlin.de/jez-bin/wms") -> "JezeroMap":
-        web_map = WebMapService(url)
-        return JezeroMap(web_map)
+    def __post_init__(self):
+        if self.tiles is None:
+            self.tiles = TiledWMSLayer(self.map, JEZERO_LAYER, client=self.client)
 
-    def center_and_return_map_image(self, points: ty.List[Coordinate],
+    @classmethod
+    def from_wms_url(cls, url: str = JEZERO_WMS_URL,
+                     version: str = "1.1.1",
+                     tile_cache: ty.Union[None, TileCache] = None,
+                     refresh: bool = False,
+                     client: ty.Union[None, HTTPClient] = None) -> "JezeroMap":
+        tile_cache = TileCache() if tile_cache is None else tile_cache
+        web_map = WebMapService(url, version=version,
+                                xml=get_capabilities(url, version, tile_cache, refresh=refresh, client=client))
+        return JezeroMap(web_map, TiledWMSLayer(web_map, JEZERO_LAYER, tile_cache=tile_cache, client=client), client)
+
+    def center_and_return_map_image(self, points: ty.Union[ty.List[Coordinate], np.ndarray],
                                     gap: float = .0005,
                                     x: int = 500) -> ty.Tuple[np.ndarray, BBox, ty.Tuple[int, int]]:
-        max_lon: float = max(x[0] for x in points) + gap
-        min_lon: float = min(x[0] for x in points) - gap
-        max_lat: float = max(x[1] for x in points) + gap
-        min_lat: float = min(x[1] for x in points) - gap
+        coordinates = np.asarray(points, dtype=np.float64)[:, :2]
+        max_lon, max_lat = np.nanmax(coordinates, axis=0) + gap
+        min_lon, min_lat = np.nanmin(coordinates, axis=0) - gap
         y = ((max_lat - min_lat) / (max_lon - min_lon)) * x
         bbox: BBox = (min_lon, min_lat, max_lon, max_lat)
-        img = self.map.getmap(layers=['Jezero Landing Site'],
-                              srs='EPSG:4326',
-                              bbox=bbox,
-                              size=(x, y),
-                              format='image/png',
-                              transparent=True)
-        with open("temp_image.png", "wb") as temp_file:
-            temp_file.write(img.read())
-        map_image = Image.open("temp_image.png")
+        map_image = self.tiles.render(bbox, (x, int(y)))
         return np.array(map_image), bbox, (int(y), int(x))
 
+    @staticmethod
+    def get_projection(image_size: ty.Tuple[int, int], image_bbox: BBox) -> Projection:
+        return Projection(image_size, image_bbox)
+
     @staticmethod
     def get_coordinate_functions(image_size: ty.Tuple[int, int],
                                  image_bbox: BBox) -> ty.Tuple[ty.Callable, ty.Callable]:
+        """
+        Per-axis versions of `get_projection`, for longitudes and latitudes separately
+        (scalars or arrays).
+        """
+        projection = Projection(image_size, image_bbox)
+        scale, origin = projection.scale, projection.origin
 
-        def lin_func_x(x_min, x_max):
-            return lambda x: image_size[1] - ((image_size[1] / (x_max - x_min)) * (x - x_min))
-
-        def lin_func_y(x_min, x_max):
-            return lambda x: (image_size[0] / (x_max - x_min)) * (x - x_min)
+        def normalize_long(longitude):
+            return (longitude - origin[0]) * scale[0]
 
-        normalize_long = lin_func_x(image_bbox[2], image_bbox[0])
-        normalize_lat = lin_func_y(image_bbox[3], image_bbox[1])
+        def normalize_lat(latitude):
+            return (latitude - origin[1]) * scale[1]
 
         return normalize_long, normalize_lat
-
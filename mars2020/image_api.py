@@ -1,28 +1,271 @@
+import codecs
+import json
+import math
+import re
+import time
 import typing as ty
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from datetime import datetime
-from pathlib import Path
 from enum import Enum
+from pathlib import Path
 import requests as rq
-from PIL import Image
 from dateutil.parser import parse as date_parser
+from dateutil.tz import tzutc
+
+from mars2020 import instrumentation
+from mars2020.client import HTTPClient, get_client
+
+RAW_IMAGES_FEED = "https://mars.nasa.gov/rss/api/?feed=raw_images&category=mars2020&feedtype=json"
+
+
+def sol_feed_url(first: int, last: int, feed_url: str = RAW_IMAGES_FEED) -> str:
+    """
+    `feed_url` restricted to the inclusive range of sols from `first` to `last`.
+    """
+    return f"{feed_url}&condition_2={first}:sol:gte&condition_3={last}:sol:lte"
+
+
+def fetch_feed_page(
+    number_of_images: int,
+    page_number: int,
+    client: ty.Union[None, HTTPClient] = None,
+    feed_url: str = RAW_IMAGES_FEED,
+    retries: ty.Union[None, int] = None,
+    timeout: ty.Union[None, float] = None,
+) -> dict:
+    """
+    Fetches one page of the raw_images feed as JSON through `client` (the shared client by default),
+    retrying failed requests and undecodable responses up to `retries` times (the client's setting by default).
+    """
+    client = get_client() if client is None else client
+    return client.get_json(
+        f"{feed_url}&num={number_of_images}&page={page_number}", retries=retries, timeout=timeout
+    )
+
+
+_NUMBER = re.compile(r"[-+0-9.eE]*")
+
+
+class _JsonStream:
+    """
+    Minimal incremental JSON reader over a stream of byte chunks: values are decoded one
+    at a time with `json.JSONDecoder.raw_decode` as soon as enough bytes have arrived.
+    """
+
+    def __init__(self, chunks: ty.Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+
+    def _fill(self) -> bool:
+        for chunk in self.chunks:
+            text = self.text_decoder.decode(chunk)
+            if text:
+                self.buffer = self.buffer[self.position :] + text
+                self.position = 0
+                return True
+        self.finished = True
+        return False
+
+    def peek(self) -> str:
+        """
+        Returns the next non-whitespace character without consuming it, "" at the end of the stream.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in " \t\r\n":
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ""
+
+    def expect(self, character: str):
+        if self.peek() != character:
+            raise ValueError(f"Expected {character!r} at {self.buffer[self.position : self.position + 20]!r}")
+        self.position += 1
+
+    def value(self) -> ty.Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number running to the end of the buffer may continue in the next chunk
+            if (
+                isinstance(value, (int, float))
+                and _NUMBER.match(self.buffer, self.position).end() == len(self.buffer)
+                and self._fill()
+            ):
+                continue
+            self.position = end
+            return value
+
+
+def iter_json_array(chunks: ty.Iterable[bytes], key: str) -> ty.Iterator[ty.Any]:
+    """
+    Yields the items of the array under `key` in a streamed top-level JSON object,
+    each as soon as it has been received.
+    """
+    stream = _JsonStream(chunks)
+    stream.expect("{")
+    while stream.peek() not in ("}", ""):
+        if stream.peek() == ",":
+            stream.expect(",")
+        name = stream.value()
+        stream.expect(":")
+        if name != key:
+            stream.value()
+            continue
+        stream.expect("[")
+        while stream.peek() != "]":
+            if stream.peek() == ",":
+                stream.expect(",")
+            yield stream.value()
+        return
+
+
+def stream_feed_page(
+    number_of_images: int,
+    page_number: int,
+    client: ty.Union[None, HTTPClient] = None,
+    feed_url: str = RAW_IMAGES_FEED,
+    retries: ty.Union[None, int] = None,
+    timeout: ty.Union[None, float] = None,
+    chunk_size: int = 64 * 1024,
+) -> ty.Iterator[dict]:
+    """
+    Yields the raw records of one feed page as they are received. Failed requests are retried
+    with the client's backoff, skipping records that were already yielded.
+    """
+    client = get_client() if client is None else client
+    retries = client.retries if retries is None else retries
+    yielded = 0
+    for attempt in range(retries + 1):
+        try:
+            with client.stream(
+                f"{feed_url}&num={number_of_images}&page={page_number}",
+                chunk_size=chunk_size,
+                timeout=timeout,
+                retries=0,
+            ) as chunks:
+                for index, record in enumerate(iter_json_array(chunks, "images")):
+                    if index >= yielded:
+                        yielded += 1
+                        yield record
+            return
+        except (rq.RequestException, ValueError):
+            if attempt == retries:
+                raise
+            time.sleep(client.retry_delay(attempt))
+
+
+def fetch_all_feed_pages(
+    workers: int = 8,
+    page_size: int = 100,
+    retries: ty.Union[None, int] = None,
+    feed_url: str = RAW_IMAGES_FEED,
+    client: ty.Union[None, HTTPClient] = None,
+) -> ty.Iterator[dict]:
+    """
+    Yields every page of the raw_images feed in order, with up to `workers` pages in flight at once
+    (bounded in turn by the client's connection pool and rate limit).
+    """
+    client = get_client() if client is None else client
+    total: int = fetch_feed_page(
+        1, 0, client=client, feed_url=feed_url, retries=retries
+    )["total_results"]
+
+    def fetch_page(page_number: int) -> dict:
+        return fetch_feed_page(
+            page_size, page_number, client=client, feed_url=feed_url, retries=retries
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(fetch_page, range(math.ceil(total / page_size)))
 
 
 def check_none(dictionary: dict, value: str):
-    if value not in dictionary:
+    item = dictionary.get(value)
+    return None if item is None or item == "UNK" else str(item)
+
+
+# Timestamps in the feed look like 2021-02-28T10:22:45.000 or 2021-03-01T01:23:42Z
+_ISO_DATE = re.compile(r"(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?(Z)?$")
+_UTC = tzutc()
+
+
+def parse_date(date_string: str) -> datetime:
+    """
+    Parses the feed's fixed-format ISO timestamps directly, falling back to dateutil for anything else.
+    """
+    match = _ISO_DATE.match(date_string)
+    if match is None:
+        return date_parser(date_string)
+    year, month, day, hour, minute, second, fraction, utc = match.groups()
+    return datetime(
+        int(year),
+        int(month),
+        int(day),
+        int(hour),
+        int(minute),
+        int(second),
+        int(fraction.ljust(6, "0")) if fraction else 0,
+        tzinfo=_UTC if utc else None,
+    )
+
+
+def format_tuple(values: ty.Union[None, ty.Sequence[ty.Union[int, float]]]) -> ty.Union[None, str]:
+    """
+    Formats (1.0, 2.0, 3.0) as "(1.0,2.0,3.0)", the inverse of parse_float_tuple and parse_int_tuple
+    """
+    if values is None:
         return None
-    return None if dictionary[value] == "UNK" else str(dictionary[value])
+    return f"({','.join(map(str, values))})"
+
+
+def format_date(date: ty.Union[None, datetime]) -> ty.Union[None, str]:
+    """
+    Formats a datetime like the feed's timestamps, the inverse of parse_date
+    """
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        return date.strftime("%Y-%m-%dT%H:%M:%S.%f")
+    return date.astimezone(_UTC).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
 
 
 def check_date(dictionary: dict, value: str):
     date_string = check_none(dictionary, value)
     if date_string is not None:
-        return date_parser(date_string)
+        return parse_date(date_string)
     return None
 
 
+def parse_float_tuple(string: ty.Union[None, str]) -> ty.Union[None, ty.Tuple[float, ...]]:
+    """
+    Parses "(1.0,2.0,3.0)" into (1.0, 2.0, 3.0)
+    """
+    if string is None:
+        return None
+    return tuple(map(float, string[1:-1].split(",")))
+
+
+def parse_int_tuple(string: ty.Union[None, str]) -> ty.Union[None, ty.Tuple[int, ...]]:
+    if string is None:
+        return None
+    return tuple(map(int, string[1:-1].split(",")))
+
+
 @dataclass
 class ExtendedInfo:
+    __slots__ = ("mast_az", "mast_el", "scale_factor", "xyz", "subframe_rect", "dimension")
     mast_az: ty.Union[None, str]
     mast_el: ty.Union[None, str]
     scale_factor: ty.Union[None, float]
@@ -32,25 +275,27 @@ class ExtendedInfo:
 
     @classmethod
     def from_extended_info_dict(cls, extended_info: dict):
-        mast_az = check_none(extended_info, "mastAz")
-        mast_el = check_none(extended_info, "mastEl")
         scale_factor = check_none(extended_info, "scaleFactor")
-        if scale_factor is not None:
-            scale_factor = float(scale_factor)
-        xyz = check_none(extended_info, "xyz")
-        if xyz is not None:
-            xyz = tuple(map(float, xyz[1:-1].split(",")))
-        subframe_rect = check_none(extended_info, "subframeRect")
-        if subframe_rect is not None:
-            subframe_rect = tuple(map(int, subframe_rect[1:-1].split(",")))
-        dimension = check_none(extended_info, "dimension")
-        if dimension is not None:
-            dimension = tuple(map(int, dimension[1:-1].split(",")))
-        return cls(mast_az, mast_el, scale_factor, xyz, subframe_rect, dimension)
+        return cls(
+            check_none(extended_info, "mastAz"),
+            check_none(extended_info, "mastEl"),
+            None if scale_factor is None else float(scale_factor),
+            parse_float_tuple(check_none(extended_info, "xyz")),
+            parse_int_tuple(check_none(extended_info, "subframeRect")),
+            parse_int_tuple(check_none(extended_info, "dimension")),
+        )
 
 
 @dataclass
 class Camera:
+    __slots__ = (
+        "filter_name",
+        "camera_vector",
+        "camera_model_component_list",
+        "camera_position",
+        "instrument",
+        "camera_model_type",
+    )
     filter_name: ty.Union[None, str]
     camera_vector: ty.Union[None, ty.Tuple[float, float, float]]
     camera_model_component_list: ty.Union[None, ty.List[str]]
@@ -60,32 +305,24 @@ class Camera:
 
     @classmethod
     def from_camera_dictionary(cls, camera_dictionary: dict):
-        filter_name = check_none(camera_dictionary, "filter_name")
-        camera_vector = check_none(camera_dictionary, "camera_vector")
-        if camera_vector is not None:
-            camera_vector = tuple(map(float, camera_vector[1:-1].split(",")))
         camera_model_component_list = check_none(
             camera_dictionary, "camera_model_component_list"
         )
         if camera_model_component_list is not None:
-            camera_model_component_list = list(camera_model_component_list.split(";"))
-        camera_position = check_none(camera_dictionary, "camera_position")
-        if camera_position is not None:
-            camera_position = tuple(map(float, camera_position[1:-1].split(",")))
-        instrument = check_none(camera_dictionary, "instrument")
-        camera_model_type = check_none(camera_dictionary, "camera_model_type")
+            camera_model_component_list = camera_model_component_list.split(";")
         return cls(
-            filter_name=filter_name,
-            camera_vector=camera_vector,
+            filter_name=check_none(camera_dictionary, "filter_name"),
+            camera_vector=parse_float_tuple(check_none(camera_dictionary, "camera_vector")),
             camera_model_component_list=camera_model_component_list,
-            camera_position=camera_position,
-            instrument=instrument,
-            camera_model_type=camera_model_type,
+            camera_position=parse_float_tuple(check_none(camera_dictionary, "camera_position")),
+            instrument=check_none(camera_dictionary, "instrument"),
+            camera_model_type=check_none(camera_dictionary, "camera_model_type"),
         )
 
 
 @dataclass
 class SpacecraftClockTime:
+    __slots__ = ("sol", "spacecraft_clock_time", "spacecraft_clock_time_miliseconds")
     sol: int
     spacecraft_clock_time: str
     spacecraft_clock_time_miliseconds: str
@@ -102,12 +339,38 @@ class SpacecraftClockTime:
 
 @dataclass
 class VehicleLocation:
+    __slots__ = ("site_location", "site_location_drive_position")
     site_location: str
     site_location_drive_position: str
 
 
+# From https://mastcamz.asu.edu/decoding-the-raw-publicly-released-mastcam-z-image-filenames/
+_IMAGE_ID_LENGTHS = [3, 4, 10, 3 + 3, 1 + 3 + 4 + 9, 3 + 1 + 2 + 1 + 2]
+_IMAGE_ID_FIELDS = [
+    slice(start, start + length)
+    for start, length in zip(
+        [sum(_IMAGE_ID_LENGTHS[:i]) + i for i in range(len(_IMAGE_ID_LENGTHS))],
+        _IMAGE_ID_LENGTHS,
+    )
+]
+
+
 @dataclass
 class InstrumentMeta:
+    __slots__ = (
+        "instrument_identifier",
+        "spacecraft_time",
+        "filter_number",
+        "vehicle_location",
+        "thumbnail",
+        "sequence_id",
+        "product_type_identifier",
+        "focal_length",
+        "downsampling_factor",
+        "jpeg_quality",
+        "producer",
+        "version",
+    )
     instrument_identifier: str
     spacecraft_time: SpacecraftClockTime
     filter_number: str
@@ -123,13 +386,7 @@ class InstrumentMeta:
 
     @classmethod
     def from_image_id(cls, image_id: str):
-        # From https://mastcamz.asu.edu/decoding-the-raw-publicly-released-mastcam-z-image-filenames/
-        lengths = [3, 4, 10, 3 + 3, 1 + 3 + 4 + 9, 3 + 1 + 2 + 1 + 2]
-        index = 0
-        codes = []
-        for length in lengths:
-            codes.append(image_id[index : index + length])
-            index += length + 1
+        codes = [image_id[field] for field in _IMAGE_ID_FIELDS]
         (instrument_code, sol_code, time_code, product_code, code, image_code,) = codes
         instrument_identifier = instrument_code[:2]
         spacecraft_time = SpacecraftClockTime.from_time_field(
@@ -165,7 +422,41 @@ class InstrumentMeta:
         )
 
 
-@dataclass
+# ImageData field name -> how to decode it from a raw feed record
+_IMAGE_DATA_PARSERS: ty.Dict[str, ty.Callable[[dict], ty.Any]] = {
+    "camera_type": lambda record: Camera.from_camera_dictionary(record["camera"]),
+    "instrument_metadata": lambda record: InstrumentMeta.from_image_id(record["imageid"]),
+    "extended_info": lambda record: ExtendedInfo.from_extended_info_dict(record["extended"]),
+    "image_url": lambda record: str(record["image_files"]["full_res"]),
+    "attitude": lambda record: parse_float_tuple(check_none(record, "attitude")),
+    "dimension": lambda record: parse_int_tuple(check_none(record["extended"], "dimension")),
+    "caption": lambda record: str(record["caption"]),
+    "title": lambda record: record["title"],
+    "image_id": lambda record: record["imageid"],
+    "sol": lambda record: int(check_none(record, "sol")),
+    "sample_type": lambda record: check_none(record, "sample_type"),
+    "mars_date": lambda record: check_none(record, "date_taken_mars"),
+    "earth_date_utc": lambda record: check_date(record, "date_taken_utc"),
+    "date_received_on_earth_utc": lambda record: check_date(record, "date_received"),
+    "image_files": lambda record: {
+        str(name): str(url) for name, url in (record.get("image_files") or {}).items() if url
+    },
+}
+
+# ImageData.load modes -> image_files renditions, smallest first
+LOAD_MODES = {"thumbnail": "small", "medium": "medium", "large": "large", "full": "full_res"}
+# Approximate width of the feed's scaled-down renditions
+RENDITION_WIDTHS = {"small": 320, "medium": 800, "large": 1200}
+ImageSize = ty.Union[int, ty.Tuple[int, int]]
+
+
+def _box(size: ty.Union[None, ImageSize]) -> ty.Union[None, ty.Tuple[int, int]]:
+    if size is None or isinstance(size, tuple):
+        return size
+    return size, size
+
+
+@dataclass(slots=True)
 class ImageData:
     camera_type: Camera
     instrument_metadata: InstrumentMeta
@@ -181,104 +472,509 @@ class ImageData:
     mars_date: ty.Union[None, str]
     earth_date_utc: ty.Union[None, datetime]
     date_received_on_earth_utc: ty.Union[None, datetime]
+    image_files: ty.Dict[str, str] = field(default_factory=dict)
 
     @classmethod
-    def from_image_dictionary(cls, image_dictionary: dict):
-        camera: Camera = Camera.from_camera_dictionary(image_dictionary["camera"])
-        extended_info: ExtendedInfo = ExtendedInfo.from_extended_info_dict(
-            image_dictionary["extended"]
-        )
-        image_url = str(image_dictionary["image_files"]["full_res"])
-        caption = str(image_dictionary["caption"])
-        dimension = extended_info.dimension
-        title = image_dictionary["title"]
-        image_id = image_dictionary["imageid"]
-        attitude = check_none(image_dictionary, "attitude")
-        if attitude is not None:
-            attitude = tuple(map(float, attitude[1:-1].split(",")))
-        sol = int(check_none(image_dictionary, "sol"))
-        mars_date = check_none(image_dictionary, "date_taken_mars")
-        earth_date = check_date(image_dictionary, "date_taken_utc")
-        date_received_on_earth_utc = check_date(image_dictionary, "date_received")
-        sample_type = check_none(image_dictionary, "sample_type")
-        instrument_metadata = InstrumentMeta.from_image_id(image_id)
-        return cls(
-            camera_type=camera,
-            image_url=image_url,
-            attitude=attitude,
-            dimension=dimension,
-            caption=caption,
-            title=title,
-            image_id=image_id,
-            sol=sol,
-            mars_date=mars_date,
-            earth_date_utc=earth_date,
-            extended_info=extended_info,
-            date_received_on_earth_utc=date_received_on_earth_utc,
-            sample_type=sample_type,
-            instrument_metadata=instrument_metadata,
-        )
+    def from_image_dictionary(cls, image_dictionary: dict, lazy: bool = False):
+        """
+        With `lazy=True` returns a LazyImageData that only decodes fields when they're first read.
+        """
+        if lazy:
+            return LazyImageData(image_dictionary)
+        return cls(**{name: parse(image_dictionary) for name, parse in _IMAGE_DATA_PARSERS.items()})
+
+    def to_image_dictionary(self) -> dict:
+        """
+        Returns the image as a raw feed record, which `from_image_dictionary` turns back into an equal image.
+        """
+        camera, extended = self.camera_type, self.extended_info
+        return {
+            "camera": {
+                "filter_name": camera.filter_name,
+                "camera_vector": format_tuple(camera.camera_vector),
+                "camera_model_component_list": None
+                if camera.camera_model_component_list is None
+                else ";".join(camera.camera_model_component_list),
+                "camera_position": format_tuple(camera.camera_position),
+                "instrument": camera.instrument,
+                "camera_model_type": camera.camera_model_type,
+            },
+            "extended": {
+                "mastAz": extended.mast_az,
+                "mastEl": extended.mast_el,
+                "scaleFactor": None if extended.scale_factor is None else str(extended.scale_factor),
+                "xyz": format_tuple(extended.xyz),
+                "subframeRect": format_tuple(extended.subframe_rect),
+                "dimension": format_tuple(self.dimension),
+            },
+            "image_files": {**self.image_files, "full_res": self.image_url},
+            "attitude": format_tuple(self.attitude),
+            "caption": self.caption,
+            "title": self.title,
+            "imageid": self.image_id,
+            "sol": self.sol,
+            "sample_type": self.sample_type,
+            "date_taken_mars": self.mars_date,
+            "date_taken_utc": format_date(self.earth_date_utc),
+            "date_received": format_date(self.date_received_on_earth_utc),
+        }
 
     @property
     def image_data(self):
-        tmp_folder = Path("./tmp")
-        if not tmp_folder.exists():
-            tmp_folder.mkdir()
-        with open(tmp_folder / "nasa_image_temp.png", "wb") as temp_file:
-            temp_file.write(rq.get(self.image_url).content)
-        if self.instrument_metadata.filter_number == "E":
-            from mars2020.image_processing import demosaic_image
-            return demosaic_image(Image.open(tmp_folder / "nasa_image_temp.png"))
-        return Image.open(tmp_folder / "nasa_image_temp.png")
+        return self.load(mode="full")
+
+    def rendition_size(self, rendition: str = "full_res") -> ty.Union[None, ty.Tuple[int, int]]:
+        """
+        Estimated (width, height) of one of the `image_files` renditions, from the record's
+        dimension alone, None if that isn't known. Nothing is downloaded.
+        """
+        if self.dimension is None:
+            return None
+        width, height = self.dimension
+        target = RENDITION_WIDTHS.get(rendition)
+        if target is None or target >= width:
+            return width, height
+        return target, max(1, round(height * target / width))
+
+    def select_rendition(self, size: ty.Union[None, ImageSize] = None, mode: ty.Union[None, str] = None) -> str:
+        """
+        Returns the `image_files` key `load` would download, see there.
+        """
+        renditions = list(LOAD_MODES.values())
+        if mode is not None:
+            if mode not in LOAD_MODES:
+                raise ValueError(f"mode should be one of {tuple(LOAD_MODES)}, got {mode}")
+            candidates = renditions[renditions.index(LOAD_MODES[mode]):]
+        elif size is not None and self.dimension is not None:
+            box_width, box_height = _box(size)
+            width, height = self.dimension
+            # Width of the full-res image once fitted into the box
+            needed = width * min(box_width / width, box_height / height, 1.0)
+            candidates = [
+                rendition for rendition in renditions if self.rendition_size(rendition)[0] >= needed - 0.5
+            ]
+        else:
+            candidates = ["full_res"]
+        return next(
+            rendition for rendition in candidates if rendition == "full_res" or rendition in self.image_files
+        )
+
+    def load(self, size: ty.Union[None, ImageSize] = None, mode: ty.Union[None, str] = None):
+        """
+        Returns the image, downloading the smallest of the feed's renditions that serves the request.
+
+        `mode` ("thumbnail", "medium", "large" or "full") picks a rendition, falling back to larger ones
+        the record doesn't have. Otherwise, with `size` (width, height), or an int for both, the smallest
+        rendition at least that big is used and the image is scaled down to fit in `size`; JPEG renditions
+        are decoded at reduced resolution. Only full-res Bayer frames (filter "E") are demosaiced.
+        """
+        from mars2020.cache import get_image_cache
+
+        rendition = self.select_rendition(size, mode)
+        url = self.image_url if rendition == "full_res" else self.image_files[rendition]
+        demosaic = rendition == "full_res" and self.instrument_metadata.filter_number == "E"
+        return get_image_cache().get_image(url, demosaic=demosaic, size=_box(size))
+
+
+class LazyImageData(ImageData):
+    """
+    ImageData that keeps the raw feed record and decodes each field the first time it's read.
+    It compares equal to an ImageData with the same fields. Fields can also be given directly,
+    as `dataclasses.replace` does, in which case there is no record.
+    """
+    __slots__ = ("_record",)
+
+    def __init__(self, record: ty.Union[None, dict] = None, **fields):
+        if record is not None:
+            self._record = record
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        if not isinstance(other, ImageData):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in _IMAGE_DATA_PARSERS)
+
+    def __getattr__(self, name: str):
+        # Only called for fields that haven't been decoded yet
+        parse = _IMAGE_DATA_PARSERS.get(name)
+        if parse is None:
+            raise AttributeError(name)
+        value = parse(self._record)
+        setattr(self, name, value)
+        return value
+
+    def to_image_dictionary(self) -> dict:
+        try:
+            return self._record
+        except AttributeError:
+            return super().to_image_dictionary()
+
+
+@dataclass
+class DownloadResult:
+    image: ImageData
+    data: ty.Union[None, bytes]
+    error: ty.Union[None, Exception]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def download_images(
+    images: ty.Iterable[ImageData],
+    max_concurrency: int = 8,
+    progress: ty.Union[None, ty.Callable[[int, int, DownloadResult], None]] = None,
+) -> ty.Iterator[DownloadResult]:
+    """
+    Downloads the full-res files of `images` concurrently through the image cache and yields
+    a DownloadResult per image in completion order. A failed download is reported in its
+    result instead of aborting the batch. `progress(done, total, result)` is called after each one.
+    """
+    from mars2020.cache import get_image_cache
+
+    cache = get_image_cache()
+    images = list(images)
+
+    def fetch(image: ImageData) -> DownloadResult:
+        try:
+            return DownloadResult(image, cache.get_bytes(image.image_url), None)
+        except Exception as error:
+            return DownloadResult(image, None, error)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(fetch, image) for image in images]
+        for done, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            if progress is not None:
+                progress(done, len(images), result)
+            yield result
+
+
+def cluster_id(image_id: str) -> ty.Union[None, str]:
+    """
+    Returns the id shared by all frames of a grid cluster, None if the image isn't part of one.
+    """
+    parts = image_id.split("_")
+    if len(parts[-1]) == 4:
+        return "_".join(parts[:-2])
+    return None
+
+
+def site_drive(vehicle_location: VehicleLocation) -> ty.Union[None, ty.Tuple[int, int]]:
+    """
+    Returns (site, drive) as integers, None if the image id doesn't encode them.
+    """
+    try:
+        return int(vehicle_location.site_location), int(vehicle_location.site_location_drive_position)
+    except ValueError:
+        return None
+
+
+INDEXED_FIELDS: ty.Dict[str, ty.Callable[[ImageData], ty.Hashable]] = {
+    "sol": lambda image: image.sol,
+    "instrument": lambda image: image.camera_type.instrument,
+    "filter_number": lambda image: image.instrument_metadata.filter_number,
+    "thumbnail": lambda image: image.instrument_metadata.thumbnail,
+    "sequence_id": lambda image: image.instrument_metadata.sequence_id,
+    "cluster_id": lambda image: cluster_id(image.image_id),
+    "vehicle_location": lambda image: site_drive(image.instrument_metadata.vehicle_location),
+}
 
 
 @dataclass
 class ImageDataCollection:
+    """
+    A list of images with lazily built secondary indexes (see INDEXED_FIELDS) and columnar table.
+
+    Appending through `append`/`extend` and replacing `images` with a new list are picked up
+    automatically; after changing `images` in place in any other way (sorting, inserting,
+    assigning or removing items) call `invalidate()`.
+    """
+
     images: ty.List[ImageData]
     page_number: ty.Union[None, int]
     number_of_images: ty.Union[None, int]
     total_images_in_database: int
+    # field name -> value -> positions in `images`, see INDEXED_FIELDS; each built on first use
+    _index: ty.Dict[str, ty.Dict[ty.Hashable, ty.List[int]]] = field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
+    # field name -> number of images indexed
+    _indexed: ty.Dict[str, int] = field(default_factory=dict, init=False, repr=False, compare=False)
+    _indexed_list: int = field(default=0, init=False, repr=False, compare=False)
+    # ImageTable known to match `images`, with the id and length of `images` it was made for
+    _table: ty.Any = field(default=None, init=False, repr=False, compare=False)
+    _table_for: ty.Tuple[int, int] = field(default=(0, 0), init=False, repr=False, compare=False)
 
     @classmethod
-    def fetch_all_mars2020_imagedata(cls) -> "ImageDataCollection":
-        all_data = cls.empty()
-        total: int = cls.fetch_partial_mars2020_imagedata(
-            number_of_images=1, page_number=1
-        ).total_images_in_database
-        for step in range(int(total / 100) + 1):
-            all_data += cls.fetch_partial_mars2020_imagedata(
-                number_of_images=100, page_number=step
-            )
-        return all_data
+    def fetch_all_mars2020_imagedata(
+        cls,
+        workers: int = 8,
+        page_size: int = 100,
+        retries: ty.Union[None, int] = None,
+        feed_url: str = RAW_IMAGES_FEED,
+        client: ty.Union[None, HTTPClient] = None,
+        lazy: bool = False,
+    ) -> "ImageDataCollection":
+        """
+        Fetches the whole raw_images feed, `page_size` images per request,
+        with up to `workers` pages in flight at once over the client's connection pool.
+        Pages are merged in feed order. With `lazy=True` images are LazyImageData.
+        """
+        pages = fetch_all_feed_pages(
+            workers=workers,
+            page_size=page_size,
+            retries=retries,
+            feed_url=feed_url,
+            client=client,
+        )
+        return cls.concatenate(
+            cls.from_feed_page(json_data, page_number, page_size, lazy=lazy)
+            for page_number, json_data in enumerate(pages)
+        )
+
+    @classmethod
+    def iter_mars2020_imagedata(
+        cls,
+        page_size: int = 100,
+        start_page: int = 0,
+        retries: ty.Union[None, int] = None,
+        feed_url: str = RAW_IMAGES_FEED,
+        client: ty.Union[None, HTTPClient] = None,
+        lazy: bool = False,
+    ) -> ty.Iterator[ImageData]:
+        """
+        Yields images from the raw_images feed one at a time as they are received, page after page,
+        until the feed runs out. Only one record is decoded in memory at a time.
+        """
+        page_number = start_page
+        while True:
+            number_of_records = 0
+            for record in stream_feed_page(
+                page_size, page_number, client=client, feed_url=feed_url, retries=retries
+            ):
+                number_of_records += 1
+                if instrumentation.enabled():
+                    with instrumentation.timed("parse", "lazy" if lazy else "eager", size=1):
+                        image = ImageData.from_image_dictionary(record, lazy=lazy)
+                    yield image
+                else:
+                    yield ImageData.from_image_dictionary(record, lazy=lazy)
+            if number_of_records < page_size:
+                return
+            page_number += 1
 
     @classmethod
     def empty(cls) -> "ImageDataCollection":
         return cls([], None, 0, 0)
 
+    @classmethod
+    def concatenate(
+        cls, collections: ty.Iterable["ImageDataCollection"]
+    ) -> "ImageDataCollection":
+        """
+        Merges collections in linear time (unlike repeated `+`, which copies the image list each time).
+        """
+        all_data = cls.empty()
+        for collection in collections:
+            all_data.images.extend(collection.images)
+            all_data.number_of_images += len(collection.images)
+            all_data.total_images_in_database = collection.total_images_in_database
+        return all_data
+
     @classmethod
     def fetch_partial_mars2020_imagedata(
-        cls, number_of_images: int, page_number: int
+        cls,
+        number_of_images: int,
+        page_number: int,
+        client: ty.Union[None, HTTPClient] = None,
+        feed_url: str = RAW_IMAGES_FEED,
+        retries: ty.Union[None, int] = None,
+        lazy: bool = False,
     ) -> "ImageDataCollection":
-        json_data = rq.get(
-            f"https://mars.nasa.gov/rss/api/?feed=raw_images&category=mars2020&feedtype=json&num={number_of_images}&page={page_number}"
-        ).json()
-        images: ty.List[ImageData] = [
-            ImageData.from_image_dictionary(x) for x in json_data["images"]
-        ]
+        json_data = fetch_feed_page(
+            number_of_images,
+            page_number,
+            client=client,
+            feed_url=feed_url,
+            retries=retries,
+        )
+        return cls.from_feed_page(json_data, page_number, number_of_images, lazy=lazy)
+
+    @classmethod
+    def from_feed_page(
+        cls, json_data: dict, page_number: int, number_of_images: int, lazy: bool = False
+    ) -> "ImageDataCollection":
+        with instrumentation.timed("parse", "lazy" if lazy else "eager", size=len(json_data["images"])):
+            images: ty.List[ImageData] = [
+                ImageData.from_image_dictionary(x, lazy=lazy) for x in json_data["images"]
+            ]
         total_images_in_database = json_data["total_results"]
         return cls(images, page_number, number_of_images, total_images_in_database)
 
+    def download(
+        self,
+        images: ty.Union[None, ty.Iterable[ImageData]] = None,
+        max_concurrency: int = 8,
+        progress: ty.Union[None, ty.Callable[[int, int, DownloadResult], None]] = None,
+    ) -> ty.Iterator[DownloadResult]:
+        """
+        Downloads `images` (all images in the collection by default), see `download_images`.
+        """
+        return download_images(
+            self.images if images is None else images,
+            max_concurrency=max_concurrency,
+            progress=progress,
+        )
+
+    def to_table(self):
+        """
+        Returns an `ImageTable`, a columnar view of the collection for fast filtering and grouping.
+        """
+        from mars2020.table import ImageTable
+
+        if self._table is None or self._table_for != (id(self.images), len(self.images)):
+            self.set_table(ImageTable.from_images(self.images))
+        return self._table
+
+    def set_table(self, table):
+        self._table = table
+        self._table_for = (id(self.images), len(self.images))
+
+    def save(self, path: ty.Union[str, Path]) -> Path:
+        """
+        Writes a binary snapshot of the collection to the directory `path`, see `mars2020.snapshot`.
+        """
+        from mars2020 import snapshot
+
+        return snapshot.save(self, path)
+
+    @classmethod
+    def load(cls, path: ty.Union[str, Path], mmap: bool = True) -> "ImageDataCollection":
+        """
+        Loads a snapshot written by `save`. With `mmap=True` its columns and records are memory-mapped,
+        and images are only decoded from their records when their fields are first read.
+        """
+        from mars2020 import snapshot
+
+        return snapshot.load(path, mmap=mmap)
+
+    def invalidate(self):
+        """
+        Drops the secondary indexes and the table, so they are rebuilt from `images` on next use.
+        """
+        self._index = {}
+        self._indexed = {}
+        self._indexed_list = 0
+        self._table = None
+        self._table_for = (0, 0)
+
+    def _ensure_index(self, name: str) -> ty.Dict[ty.Hashable, ty.List[int]]:
+        """
+        Builds the secondary index on `name` on first use, and afterwards only indexes images appended
+        since (indexes are rebuilt if `images` was replaced, shrunk or `invalidate`d).
+        """
+        if self._indexed_list != id(self.images) or any(
+            indexed > len(self.images) for indexed in self._indexed.values()
+        ):
+            self._index = {}
+            self._indexed = {}
+            self._indexed_list = id(self.images)
+        index = self._index.setdefault(name, {})
+        key = INDEXED_FIELDS[name]
+        images = self.images
+        for position in range(self._indexed.get(name, 0), len(images)):
+            index.setdefault(key(images[position]), []).append(position)
+        self._indexed[name] = len(images)
+        return index
+
+    def _lookup(self, name: str, value: ty.Hashable) -> ty.List[ImageData]:
+        return [self.images[position] for position in self._ensure_index(name).get(value, ())]
+
+    def index_keys(self, name: str) -> ty.Set[ty.Hashable]:
+        """
+        Returns the distinct values of an indexed field (see INDEXED_FIELDS).
+        """
+        return set(self._ensure_index(name))
+
+    def by_sol(self, sol: int) -> ty.List[ImageData]:
+        return self._lookup("sol", sol)
+
+    def by_instrument(self, instrument: str) -> ty.List[ImageData]:
+        return self._lookup("instrument", instrument)
+
+    def by_filter(self, filter_number: str) -> ty.List[ImageData]:
+        return self._lookup("filter_number", filter_number)
+
+    def by_sequence(self, sequence_id: ty.Tuple[str, str]) -> ty.List[ImageData]:
+        return self._lookup("sequence_id", sequence_id)
+
+    def by_vehicle_location(self, site: int, drive: int) -> ty.List[ImageData]:
+        return self._lookup("vehicle_location", (site, drive))
+
+    def thumbnails(self, thumbnail: bool = True) -> ty.List[ImageData]:
+        return self._lookup("thumbnail", thumbnail)
+
+    def query(self, **conditions) -> ty.List[ImageData]:
+        """
+        Returns the images matching all given indexed fields, in collection order,
+        e.g. `query(sol=10, instrument="MCZ_LEFT", thumbnail=False)`.
+        """
+        candidates = sorted(
+            (self._ensure_index(name).get(value, []) for name, value in conditions.items()), key=len
+        )
+        if not candidates:
+            return list(self.images)
+        positions = set(candidates[0])
+        for other in candidates[1:]:
+            positions.intersection_update(other)
+        return [self.images[position] for position in sorted(positions)]
+
+    def clusters(self, cluster_length: int = 16) -> ty.List[ty.List[ImageData]]:
+        """
+        Returns the grid clusters (frames sharing a cluster id) of exactly `cluster_length` frames.
+        """
+        return [
+            [self.images[position] for position in positions]
+            for key, positions in self._ensure_index("cluster_id").items()
+            if key is not None and len(positions) == cluster_length
+        ]
+
+    @property
+    def sols(self) -> ty.Set[int]:
+        return self.index_keys("sol")
+
     @property
     def instrument_names(self) -> ty.Set[str]:
-        return {x.camera_type.instrument for x in self.images}
+        return self.index_keys("instrument")
+
+    def append(self, image: ImageData):
+        self.images.append(image)
+        if self.number_of_images is not None:
+            self.number_of_images += 1
+
+    def extend(self, images: ty.Iterable[ImageData]):
+        for image in images:
+            self.append(image)
 
     def __add__(self, other: "ImageDataCollection") -> "ImageDataCollection":
-        return ImageDataCollection(
+        collection = ImageDataCollection(
             images=self.images + other.images,
             page_number=None,
             number_of_images=self.number_of_images + other.number_of_images,
             total_images_in_database=other.total_images_in_database,
         )
+        if self._index and self._indexed_list == id(self.images):
+            # Carry over the existing indexes, only the other collection's images get indexed
+            collection._index = {
+                name: {key: list(positions) for key, positions in values.items()}
+                for name, values in self._index.items()
+            }
+            collection._indexed = dict(self._indexed)
+            collection._indexed_list = id(collection.images)
+        return collection
 
     def __len__(self):
         return len(self.images)
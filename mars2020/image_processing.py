@@ -1,104 +1,354 @@
+import json
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+
 import numpy as np
 from PIL import Image
-from scipy.ndimage.filters import convolve
 from mars2020 import image_api as mapi
+from mars2020 import instrumentation
 import typing as ty
 
 
-def demosaic_image(pil_image: Image, pattern="RGGB"):
+BAYER_PATTERNS = ("RGGB", "BGGR", "GRBG", "GBRG")
+DEMOSAIC_METHODS = ("bilinear", "malvar")
+
+# Sparse kernels as ((dy, dx), weight) terms, with a common divisor.
+# Bilinear kernels are the non-zero taps of H_G and H_RB restricted to one Bayer sub-lattice.
+_BILINEAR_CROSS = ((((-1, 0), 1), ((1, 0), 1), ((0, -1), 1), ((0, 1), 1)), 4)
+_BILINEAR_DIAGONAL = ((((-1, -1), 1), ((-1, 1), 1), ((1, -1), 1), ((1, 1), 1)), 4)
+_BILINEAR_HORIZONTAL = ((((0, -1), 1), ((0, 1), 1)), 2)
+_BILINEAR_VERTICAL = ((((-1, 0), 1), ((1, 0), 1)), 2)
+
+# Malvar, He and Cutler (2004) gradient-corrected kernels
+_MALVAR_G_AT_RB = (
+    (((0, 0), 4), ((-1, 0), 2), ((1, 0), 2), ((0, -1), 2), ((0, 1), 2),
+     ((-2, 0), -1), ((2, 0), -1), ((0, -2), -1), ((0, 2), -1)),
+    8,
+)
+_MALVAR_RB_AT_G_HORIZONTAL = (
+    (((0, 0), 5), ((0, -1), 4), ((0, 1), 4), ((0, -2), -1), ((0, 2), -1),
+     ((-1, -1), -1), ((-1, 1), -1), ((1, -1), -1), ((1, 1), -1),
+     ((-2, 0), 0.5), ((2, 0), 0.5)),
+    8,
+)
+_MALVAR_RB_AT_G_VERTICAL = (
+    tuple(((dx, dy), weight) for (dy, dx), weight in _MALVAR_RB_AT_G_HORIZONTAL[0]),
+    8,
+)
+_MALVAR_RB_AT_BR = (
+    (((0, 0), 6), ((-1, -1), 2), ((-1, 1), 2), ((1, -1), 2), ((1, 1), 2),
+     ((-2, 0), -1.5), ((2, 0), -1.5), ((0, -2), -1.5), ((0, 2), -1.5)),
+    8,
+)
+
+
+def _lattice_sum(padded: np.ndarray, pad: int, shape: ty.Tuple[int, int],
+                 site: ty.Tuple[int, int], terms) -> np.ndarray:
+    """
+    Evaluates a sparse kernel on one Bayer sub-lattice (every second pixel starting at `site`),
+    using strided views of the padded frame instead of full-frame masks and convolutions.
+    """
+    height, width = shape
+    y, x = site
+    total = None
+    for (dy, dx), weight in terms:
+        view = padded[pad + y + dy: pad + height + dy: 2, pad + x + dx: pad + width + dx: 2]
+        if total is None:
+            total = view * weight if weight != 1 else view.copy()
+        elif weight == 1:
+            total += view
+        else:
+            total += view * weight
+    return total
+
+
+def _demosaic_kernels(pattern: str, method: str):
+    """
+    Returns, for each of the four sub-lattice sites, the kernel computing each of R, G and B
+    (None where the site already holds that colour).
+    """
+    sites = [(0, 0), (0, 1), (1, 0), (1, 1)]
+    colour_sites = {colour: site for colour, site in zip(pattern, sites) if colour != "G"}
+    kernels = {}
+    for native, site in zip(pattern, sites):
+        kernels[site] = {}
+        for channel in "RGB":
+            if channel == native:
+                kernels[site][channel] = None
+            elif channel == "G":
+                kernels[site][channel] = _BILINEAR_CROSS if method == "bilinear" else _MALVAR_G_AT_RB
+            else:
+                same_row = colour_sites[channel][0] == site[0]
+                same_column = colour_sites[channel][1] == site[1]
+                if method == "bilinear":
+                    kernels[site][channel] = (_BILINEAR_HORIZONTAL if same_row
+                                              else _BILINEAR_VERTICAL if same_column
+                                              else _BILINEAR_DIAGONAL)
+                else:
+                    kernels[site][channel] = (_MALVAR_RB_AT_G_HORIZONTAL if same_row
+                                              else _MALVAR_RB_AT_G_VERTICAL if same_column
+                                              else _MALVAR_RB_AT_BR)
+    return kernels
+
+
+def demosaic_image(pil_image: Image, pattern="RGGB", method="bilinear"):
     """
     Adapted from https://github.com/colour-science/colour-demosaicing/blob/develop/colour_demosaicing/bayer/demosaicing/bilinear.py
 
 
-    Returns the demosaiced *RGB* colourspace array from given *Bayer* CFA using
-    bilinear interpolation.
+    Returns the demosaiced *RGB* image from given *Bayer* CFA image.
+    Each of the four Bayer sub-lattices is interpolated directly through strided views of the
+    frame and written into a single preallocated uint8 output. Bilinear interpolation runs in
+    integer arithmetic, the Malvar-He-Cutler (2004) mode in float32.
     Parameters
     ----------
-    CFA : array_like
-        *Bayer* CFA.
+    pil_image : Image
+        *Bayer* CFA, channels are averaged if there are several.
     pattern : unicode, optional
         **{'RGGB', 'BGGR', 'GRBG', 'GBRG'}**,
         Arrangement of the colour filters on the pixel array.
+    method : unicode, optional
+        **{'bilinear', 'malvar'}**,
+        Bilinear interpolation or gradient-corrected linear interpolation (higher quality).
     Returns
     -------
-    ndarray
-        *RGB* colourspace array.
+    Image
+        *RGB* image.
     """
-    image: np.ndarray = np.array(pil_image, dtype=np.float64).mean(axis=2)
-    image /= 255.0
+    pattern = pattern.upper()
+    if pattern not in BAYER_PATTERNS:
+        raise ValueError(f"pattern should be one of {BAYER_PATTERNS}, got {pattern}")
+    if method not in DEMOSAIC_METHODS:
+        raise ValueError(f"method should be one of {DEMOSAIC_METHODS}, got {method}")
+    frame = np.asarray(pil_image)
+    if frame.ndim == 2:
+        frame = frame[..., np.newaxis]
+    with instrumentation.timed("demosaic", method, size=frame.shape[0] * frame.shape[1]):
+        return Image.fromarray(_demosaic_frame(frame, pattern, method), "RGB")
 
-    channels = dict((channel, np.zeros(image.shape)) for channel in "RGB")
-    for channel, (y, x) in zip(pattern.upper(), [(0, 0), (0, 1), (1, 0), (1, 1)]):
-        channels[channel][y::2, x::2] = 1
 
-    R_m, G_m, B_m = tuple(channels[c].astype(bool) for c in "RGB")
+def _demosaic_frame(frame: np.ndarray, pattern: str, method: str) -> np.ndarray:
+    number_of_channels = frame.shape[2]
+    if method == "bilinear":
+        # Channel sums stay exact in integers: the divisor folds in the channel average
+        image = frame.sum(axis=2, dtype=np.uint16) if number_of_channels > 1 else frame[..., 0].astype(np.uint16)
+        pad = 1
+    else:
+        image = frame.sum(axis=2, dtype=np.float32)
+        image /= number_of_channels
+        number_of_channels = 1
+        pad = 2
+    shape = image.shape
+    # "reflect" mirrors around the edge pixel, so every mirrored pixel keeps its Bayer colour
+    padded = np.pad(image, pad, mode="reflect")
+    output = np.empty(shape + (3,), dtype=np.uint8)
+    for (y, x), channel_kernels in _demosaic_kernels(pattern, method).items():
+        native = padded[pad + y: pad + shape[0]: 2, pad + x: pad + shape[1]: 2]
+        for index, channel in enumerate("RGB"):
+            kernel = channel_kernels[channel]
+            if kernel is None:
+                values, divisor = native, number_of_channels
+            else:
+                terms, divisor = kernel
+                values = _lattice_sum(padded, pad, shape, (y, x), terms)
+                divisor *= number_of_channels
+            if method == "bilinear":
+                output[y::2, x::2, index] = values // divisor
+            else:
+                values = values / divisor
+                output[y::2, x::2, index] = np.clip(values, 0, 255, out=values)
+    return output
 
-    H_G = (
-            np.array([[0, 1, 0], [1, 4, 1], [0, 1, 0]], dtype=np.float64) / 4
-    )  # yapf: disable
 
-    H_RB = (
-            np.array([[1, 2, 1], [2, 4, 2], [1, 2, 1]], dtype=np.float64) / 4
-    )  # yapf: disable
+def get_image_clusters(image_collection: ty.Union[mapi.ImageDataCollection, ty.List[mapi.ImageData]],
+                       cluster_length: int = 16) -> ty.List[ty.List[mapi.ImageData]]:
+    if type(image_collection) != mapi.ImageDataCollection:
+        images: ty.List[mapi.ImageData] = list(image_collection)
+        image_collection = mapi.ImageDataCollection(images, None, len(images), len(images))
+    return image_collection.clusters(cluster_length)
 
-    R = convolve(image * R_m, H_RB)
-    G = convolve(image * G_m, H_G)
-    B = convolve(image * B_m, H_RB)
 
-    output = np.concatenate(
-        [x[..., np.newaxis] for x in np.array([R, G, B], dtype=np.float64)], axis=-1
-    )
-    return Image.fromarray((output * 255).astype(np.uint8), "RGB")
+def prefetch_images(images: ty.List[mapi.ImageData], max_concurrency: int = 8):
+    """
+    Downloads all frames concurrently into the image cache, so decoding them afterwards
+    doesn't cost one round trip per frame. Failures are left for `image_data` to raise.
+    """
+    for _ in mapi.download_images(images, max_concurrency=max_concurrency):
+        pass
 
 
-def get_image_clusters(image_collection: ty.Union[mapi.ImageDataCollection, ty.List[mapi.ImageData]],
-                       cluster_length: int = 16) -> ty.List[ty.List[mapi.ImageData]]:
-    if type(image_collection) == mapi.ImageDataCollection:
-        images: ty.List[mapi.ImageData] = image_collection.images
-    else:
-        images = image_collection
-    clusters: ty.Dict[str, ty.List[mapi.ImageData]] = {}
-    for image in images:
-        if len(image.image_id.split("_")[-1]) == 4:
-            common_id: str = "_".join(image.image_id.split("_")[:-2])
-            if common_id not in clusters:
-                clusters[common_id] = [image]
-            else:
-                clusters[common_id].append(image)
-    return [list(v) for k, v in clusters.items() if len(v) == cluster_length]
+def sort_cluster(images: ty.List[mapi.ImageData]) -> ty.List[mapi.ImageData]:
+    return sorted(images, key=lambda x: int(x.image_id.split("_")[-2]))
 
 
-def grid_from_imageset(images: ty.List[mapi.ImageData]) -> Image:
-    for im in images:
-        im.order = int(im.image_id.split("_")[-2])
-    images = sorted(images, key=lambda x: x.order)
-    image_frames = [np.array(x.image_data) for x in images]
+def grid_from_frames(image_frames: ty.List[np.ndarray]) -> np.ndarray:
+    """
+    Tiles a square number of frames (in row-major order) into one RGBA array,
+    cropping each to the smallest frame minus a 1 pixel border.
+    """
     d1 = min(x.shape[0] for x in image_frames) - 2
     d2 = min(x.shape[1] for x in image_frames) - 2
-    size = int(np.sqrt(len(images)))
+    size = int(np.sqrt(len(image_frames)))
     grid_image = np.zeros((d1 * size, d2 * size, 4), dtype="uint8")
     for i in range(size):
         for j in range(size):
             current = image_frames[i * size + j]
             grid_image[d1 * i: d1 * (i + 1), d2 * j: d2 * (j + 1), :3] = current[1:d1+1, 1:d2+1]
             grid_image[d1 * i: d1 * (i + 1), d2 * j: d2 * (j + 1), -1] = 255
-    return Image.fromarray(grid_image)
+    return grid_image
 
 
-def grid_from_imageset_with_layers(images: ty.List[mapi.ImageData]):
-    for im in images:
-        im.order = int(im.image_id.split("_")[-2])
-    images = sorted(images, key=lambda x: x.order)
-    image_frames = [np.array(x.image_data) for x in images]
-    d1 = min(x.shape[0] for x in image_frames) - 2
-    d2 = min(x.shape[1] for x in image_frames) - 2
-    layers = []
-    size = int(np.sqrt(len(images)))
+def _decode_tile(image: mapi.ImageData, pattern: str = "RGGB", method: str = "bilinear") -> np.ndarray:
+    from mars2020.cache import get_image_cache
+
+    frame = get_image_cache().open(image.image_url)
+    with instrumentation.timed("decode", "tile", size=frame.width * frame.height):
+        frame.load()
+    if image.instrument_metadata.filter_number == "E":
+        frame = demosaic_image(frame, pattern=pattern, method=method)
+    return np.asarray(frame)
+
+
+# Sorted frames, tile height, tile width, tiles per side
+GridGeometry = ty.Tuple[ty.List[mapi.ImageData], int, int, int]
+
+
+def _grid_geometry(images: ty.List[mapi.ImageData]) -> GridGeometry:
+    """
+    Returns the sorted frames, tile height, tile width and number of tiles per side, from the
+    image headers. A record's dimension can disagree with the file, so it isn't used here.
+    """
+    from mars2020.cache import get_image_cache
+
+    prefetch_images(images)
+    images = sort_cluster(images)
+    cache = get_image_cache()
+    sizes = []
+    for image in images:
+        with cache.open(image.image_url) as frame:
+            sizes.append(frame.size)
+    d1 = min(height for _, height in sizes) - 2
+    d2 = min(width for width, _ in sizes) - 2
+    return images, d1, d2, int(np.sqrt(len(images)))
+
+
+def compose_grid(
+    images: ty.List[mapi.ImageData],
+    grid_image: ty.Union[None, np.ndarray] = None,
+    pattern: str = "RGGB",
+    method: str = "bilinear",
+    geometry: ty.Union[None, GridGeometry] = None,
+) -> np.ndarray:
+    """
+    Decodes the frames of a cluster one at a time and writes each straight into `grid_image`
+    (an RGBA uint8 array of the grid's shape, e.g. a np.memmap), allocating one if not given.
+    Filter-E frames are demosaiced with `pattern` and `method`. `geometry` skips reading the
+    frame headers again when the caller already has it from `_grid_geometry(images)`.
+    """
+    images, d1, d2, size = _grid_geometry(images) if geometry is None else geometry
+    if grid_image is None:
+        grid_image = np.zeros((d1 * size, d2 * size, 4), dtype="uint8")
+    with instrumentation.timed("grid", "compose", size=d1 * d2 * size * size):
+        for i in range(size):
+            for j in range(size):
+                current = _decode_tile(images[i * size + j], pattern, method)
+                grid_image[d1 * i: d1 * (i + 1), d2 * j: d2 * (j + 1), :3] = current[1:d1+1, 1:d2+1]
+                grid_image[d1 * i: d1 * (i + 1), d2 * j: d2 * (j + 1), -1] = 255
+    return grid_image
+
+
+def grid_from_imageset(images: ty.List[mapi.ImageData]) -> Image:
+    return Image.fromarray(compose_grid(images))
+
+
+def save_grid(
+    images: ty.List[mapi.ImageData],
+    path: ty.Union[str, Path],
+    format: ty.Union[None, str] = None,
+    pattern: str = "RGGB",
+    method: str = "bilinear",
+) -> Path:
+    """
+    Writes the grid of a cluster to `path` through a memory-mapped canvas, so peak memory is
+    one decoded frame no matter the grid size. A `.npy` path is kept as the memory-mapped array itself.
+    """
+    path = Path(path)
+    geometry = _grid_geometry(images)
+    _, d1, d2, size = geometry
+    shape = (d1 * size, d2 * size, 4)
+    if path.suffix == ".npy":
+        canvas = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape)
+        compose_grid(images, canvas, pattern, method, geometry).flush()
+        return path
+    with tempfile.TemporaryFile() as scratch:
+        canvas = np.memmap(scratch, dtype=np.uint8, mode="w+", shape=shape)
+        compose_grid(images, canvas, pattern, method, geometry)
+        # frombuffer shares the memory map rather than copying it
+        Image.frombuffer("RGBA", (shape[1], shape[0]), canvas, "raw", "RGBA", 0, 1).save(path, format=format)
+        del canvas
+    return path
+
+
+@dataclass
+class GridLayer:
+    """
+    One frame of a grid, placed with its top left corner at `offset` (x, y) on a transparent
+    canvas of `canvas_size` (width, height).
+    """
+    image: mapi.ImageData
+    tile: Image
+    offset: ty.Tuple[int, int]
+    canvas_size: ty.Tuple[int, int]
+
+    def to_canvas(self) -> Image:
+        canvas = Image.new("RGBA", self.canvas_size, (0, 0, 0, 0))
+        canvas.paste(self.tile, self.offset)
+        return canvas
+
+
+def iter_grid_layers(
+    images: ty.List[mapi.ImageData], pattern: str = "RGGB", method: str = "bilinear"
+) -> ty.Iterator[GridLayer]:
+    """
+    Yields the grid of a cluster one tile at a time, with each tile's position on the grid.
+    """
+    images, d1, d2, size = _grid_geometry(images)
     for i in range(size):
         for j in range(size):
-            grid_image = np.zeros((d1 * size, d2 * size, 4), dtype="uint8")
-            current = image_frames[i * size + j]
-            grid_image[d1 * i: d1 * (i + 1), d2 * j: d2 * (j + 1), :3] = current[1:d1+1, 1:d2+1]
-            grid_image[d1 * i: d1 * (i + 1), d2 * j: d2 * (j + 1), -1] = 255
-            layers.append(Image.fromarray(grid_image))
-    return layers
+            image = images[i * size + j]
+            with instrumentation.timed("grid", "layer", size=d1 * d2):
+                tile = np.full((d1, d2, 4), 255, dtype="uint8")
+                tile[..., :3] = _decode_tile(image, pattern, method)[1:d1+1, 1:d2+1]
+            yield GridLayer(image, Image.fromarray(tile), (d2 * j, d1 * i), (d2 * size, d1 * size))
+
+
+def save_grid_layers(
+    images: ty.List[mapi.ImageData],
+    directory: ty.Union[str, Path],
+    pattern: str = "RGGB",
+    method: str = "bilinear",
+) -> Path:
+    """
+    Saves each tile of a grid as `layer-<n>.png` in `directory`, with their offsets and the canvas
+    size in `layers.json`, holding only one tile in memory at a time.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    manifest = {"canvas_size": None, "layers": []}
+    for layer_id, layer in enumerate(iter_grid_layers(images, pattern, method)):
+        layer.tile.save(directory / f"layer-{layer_id}.png", format="PNG")
+        manifest["canvas_size"] = list(layer.canvas_size)
+        manifest["layers"].append(
+            {"file": f"layer-{layer_id}.png", "image_id": layer.image.image_id, "offset": list(layer.offset)}
+        )
+    (directory / "layers.json").write_text(json.dumps(manifest, indent=2))
+    return directory
+
+
+def grid_from_imageset_with_layers(images: ty.List[mapi.ImageData]):
+    """
+    Returns each tile of the grid on its own full-size canvas.
+    `iter_grid_layers` avoids holding all of these in memory.
+    """
+    return [layer.to_canvas() for layer in iter_grid_layers(images)]
@@ -0,0 +1,309 @@
+"""
+Measurements of where time goes: HTTP requests, cache lookups, record parsing, image decoding,
+demosaicing and grid composition.
+
+Nothing is measured until a listener is added; with none, instrumented code only pays for a
+truthiness check. A listener is any callable taking an `Event`:
+
+    recorder = instrumentation.add_listener(instrumentation.MetricsRecorder())
+    collection = ImageDataCollection.fetch_all_mars2020_imagedata()
+    print(recorder.summary())
+    print(recorder.to_prometheus())
+
+`serve_prometheus` exposes a recorder on a /metrics endpoint and `StatsDListener` forwards
+events to a StatsD server over UDP. Events measured in `BatchProcessor` workers are handed back
+with each result and emitted in the parent process, if it had listeners when the work was submitted.
+"""
+import bisect
+import socket
+import threading
+import time
+import typing as ty
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# What `Event.size` counts for each kind of event
+SIZE_UNITS = {
+    "http": "bytes",
+    "cache": "lookups",
+    "parse": "records",
+    "decode": "pixels",
+    "demosaic": "pixels",
+    "grid": "pixels",
+}
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+@dataclass
+class Event:
+    kind: str  # one of SIZE_UNITS
+    name: str  # endpoint, cache or operation
+    duration: float = 0.0  # seconds
+    size: int = 0  # see SIZE_UNITS
+    hit: ty.Union[None, bool] = None  # cache events
+    status: ty.Union[None, int] = None  # HTTP events
+
+
+Listener = ty.Callable[[Event], ty.Any]
+_listeners: ty.Tuple[Listener, ...] = ()
+_listeners_lock = threading.Lock()
+
+
+def add_listener(listener: Listener) -> Listener:
+    global _listeners
+    with _listeners_lock:
+        _listeners = _listeners + (listener,)
+    return listener
+
+
+def remove_listener(listener: Listener):
+    global _listeners
+    with _listeners_lock:
+        _listeners = tuple(existing for existing in _listeners if existing is not listener)
+
+
+def clear_listeners():
+    global _listeners
+    with _listeners_lock:
+        _listeners = ()
+
+
+def enabled() -> bool:
+    return bool(_listeners)
+
+
+def emit(event: Event):
+    for listener in _listeners:
+        listener(event)
+
+
+class _Timer:
+    __slots__ = ("kind", "name", "size", "start")
+
+    def __init__(self, kind: str, name: str, size: int):
+        self.kind = kind
+        self.name = name
+        self.size = size
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        emit(Event(self.kind, self.name, time.perf_counter() - self.start, self.size))
+
+
+class _NullTimer:
+    __slots__ = ("size",)
+
+    def __enter__(self) -> "_NullTimer":
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timed(kind: str, name: str, size: int = 0) -> ty.Union[_Timer, _NullTimer]:
+    """
+    Context manager emitting an event with the duration of its block, or doing nothing
+    when there are no listeners.
+    """
+    if not _listeners:
+        return _NULL_TIMER
+    return _Timer(kind, name, size)
+
+
+def cache_lookup(name: str, hit: bool):
+    if _listeners:
+        emit(Event("cache", name, size=1, hit=hit))
+
+
+def endpoint(url: str) -> str:
+    """
+    Host and first directory of a URL, e.g. https://mars.nasa.gov/rss/api/?feed=... -> mars.nasa.gov/rss/,
+    so requests group by where they come from without a series per image directory.
+    """
+    parts = urlsplit(url)
+    directory, slash, _ = parts.path.lstrip("/").partition("/")
+    return f"{parts.netloc}/{directory}{slash}" if slash else f"{parts.netloc}/"
+
+
+@dataclass
+class Metric:
+    count: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    size: int = 0
+    hits: int = 0
+    misses: int = 0
+    errors: int = 0
+    buckets: ty.Union[None, ty.List[int]] = None
+
+    def __post_init__(self):
+        if self.buckets is None:
+            self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+class MetricsRecorder:
+    """
+    Listener aggregating events into counts, total and maximum durations, sizes, cache hit rates
+    and latency histograms per (kind, name).
+    """
+
+    def __init__(self):
+        self.metrics: ty.Dict[ty.Tuple[str, str], Metric] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Event):
+        with self._lock:
+            metric = self.metrics.get((event.kind, event.name))
+            if metric is None:
+                metric = self.metrics[(event.kind, event.name)] = Metric()
+            metric.count += 1
+            metric.seconds += event.duration
+            metric.max_seconds = max(metric.max_seconds, event.duration)
+            metric.size += event.size
+            metric.buckets[bisect.bisect_left(LATENCY_BUCKETS, event.duration)] += 1
+            if event.hit is not None:
+                if event.hit:
+                    metric.hits += 1
+                else:
+                    metric.misses += 1
+            if event.status is not None and event.status >= 400:
+                metric.errors += 1
+
+    def reset(self):
+        with self._lock:
+            self.metrics.clear()
+
+    def summary(self) -> ty.Dict[str, ty.Dict[str, ty.Dict[str, float]]]:
+        """
+        Returns {kind: {name: {...}}} with counts, mean/max milliseconds, sizes (plus the
+        time per size unit, e.g. per record for "parse") and cache hit rates.
+        """
+        summary: ty.Dict[str, ty.Dict[str, ty.Dict[str, float]]] = {}
+        with self._lock:
+            for (kind, name), metric in sorted(self.metrics.items()):
+                if kind == "cache":
+                    summary.setdefault(kind, {})[name] = {
+                        "count": metric.count,
+                        "hits": metric.hits,
+                        "misses": metric.misses,
+                        "hit_rate": metric.hits / metric.count,
+                    }
+                    continue
+                entry = {
+                    "count": metric.count,
+                    "total_ms": metric.seconds * 1e3,
+                    "mean_ms": metric.seconds / metric.count * 1e3,
+                    "max_ms": metric.max_seconds * 1e3,
+                }
+                unit = SIZE_UNITS.get(kind, "size")
+                if metric.size:
+                    entry[unit] = metric.size
+                    entry[f"us_per_{unit[:-1]}"] = metric.seconds / metric.size * 1e6
+                if kind == "http":
+                    entry["errors"] = metric.errors
+                summary.setdefault(kind, {})[name] = entry
+        return summary
+
+    def to_prometheus(self, prefix: str = "mars2020") -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            by_kind: ty.Dict[str, ty.List[ty.Tuple[str, Metric]]] = {}
+            for (kind, name), metric in sorted(self.metrics.items()):
+                by_kind.setdefault(kind, []).append((name, metric))
+            for kind, metrics in by_kind.items():
+                base = f"{prefix}_{kind}"
+                if kind == "cache":
+                    lines.append(f"# TYPE {base}_hits_total counter")
+                    lines += [f'{base}_hits_total{{name="{_escape(n)}"}} {m.hits}' for n, m in metrics]
+                    lines.append(f"# TYPE {base}_misses_total counter")
+                    lines += [f'{base}_misses_total{{name="{_escape(n)}"}} {m.misses}' for n, m in metrics]
+                    continue
+                lines.append(f"# TYPE {base}_seconds histogram")
+                for name, metric in metrics:
+                    label = f'name="{_escape(name)}"'
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), metric.buckets):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f'{base}_seconds_bucket{{{label},le="{le}"}} {cumulative}')
+                    lines.append(f"{base}_seconds_sum{{{label}}} {metric.seconds!r}")
+                    lines.append(f"{base}_seconds_count{{{label}}} {metric.count}")
+                unit = SIZE_UNITS.get(kind, "size")
+                lines.append(f"# TYPE {base}_{unit}_total counter")
+                lines += [f'{base}_{unit}_total{{name="{_escape(n)}"}} {m.size}' for n, m in metrics]
+                if kind == "http":
+                    lines.append(f"# TYPE {base}_errors_total counter")
+                    lines += [f'{base}_errors_total{{name="{_escape(n)}"}} {m.errors}' for n, m in metrics]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def serve_prometheus(recorder: MetricsRecorder, port: int = 9108, address: str = "") -> ThreadingHTTPServer:
+    """
+    Serves `recorder.to_prometheus()` at http://address:port/metrics from a background thread.
+    Call `shutdown()` on the returned server to stop it.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = recorder.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StatsDListener:
+    """
+    Listener sending each event to a StatsD server over UDP: durations as timers
+    (`<prefix>.<kind>.<name>:<ms>|ms`), sizes and cache hits/misses as counters.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 8125, prefix: str = "mars2020"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    @staticmethod
+    def _metric_name(name: str) -> str:
+        return "".join(c if c.isalnum() or c in "-_" else "_" for c in name.strip("/")) or "_"
+
+    def __call__(self, event: Event):
+        base = f"{self.prefix}.{event.kind}.{self._metric_name(event.name)}"
+        if event.kind == "cache":
+            lines = [f"{base}.{'hit' if event.hit else 'miss'}:1|c"]
+        else:
+            lines = [f"{base}.duration:{event.duration * 1e3:.3f}|ms"]
+            if event.size:
+                lines.append(f"{base}.{SIZE_UNITS.get(event.kind, 'size')}:{event.size}|c")
+        try:
+            self.socket.sendto("\n".join(lines).encode("utf-8"), self.address)
+        except OSError:
+            pass
+
+    def close(self):
+        self.socket.close()
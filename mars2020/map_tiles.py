@@ -0,0 +1,187 @@
+import io
+import math
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from owslib.util import ServiceException
+from PIL import Image
+
+from mars2020.cache import DiskCache, MemoryLRU
+from mars2020.client import HTTPClient, get_client
+
+DEFAULT_TILE_DIRECTORY = Path.home() / ".mars2020" / "tiles"
+
+BBox = ty.Tuple[float, float, float, float]
+# (level, column, row) of a tile; at level n tiles span 1 / 2 ** n degrees
+TileIndex = ty.Tuple[int, int, int]
+
+
+class TileCache:
+    """
+    Map tiles as PNG bytes on disk (size-bounded LRU, see DiskCache) and decoded in an in-memory LRU.
+    """
+
+    def __init__(
+        self,
+        directory: ty.Union[str, Path] = DEFAULT_TILE_DIRECTORY,
+        max_bytes: int = 512 * 1024 ** 2,
+        memory_items: int = 256,
+    ):
+        self.disk = DiskCache(directory, max_bytes)
+        self.memory = MemoryLRU(memory_items, name=f"{self.disk.name}.decoded")
+
+    def get(self, key: str) -> ty.Union[None, Image.Image]:
+        tile = self.memory.get(key)
+        if tile is not None:
+            return tile
+        data = self.disk.read(key)
+        if data is None:
+            return None
+        tile = Image.open(io.BytesIO(data)).convert("RGBA")
+        self.memory.put(key, tile)
+        return tile
+
+    def put(self, key: str, data: bytes) -> Image.Image:
+        tile = Image.open(io.BytesIO(data)).convert("RGBA")
+        self.disk.write(key, data)
+        self.memory.put(key, tile)
+        return tile
+
+
+class TiledWMSLayer:
+    """
+    Serves arbitrary bounding boxes of a WMS layer from a fixed grid of `tile_size` pixel tiles
+    in EPSG:4326. Only tiles missing from the cache are requested (up to `workers` at once,
+    through `client` rather than owslib so they share its connection pool and rate limit),
+    and the result is stitched and resampled in memory.
+    """
+
+    def __init__(
+        self,
+        web_map,
+        layer: str,
+        tile_cache: ty.Union[None, TileCache] = None,
+        tile_size: int = 256,
+        max_level: int = 24,
+        workers: int = 8,
+        client: ty.Union[None, HTTPClient] = None,
+    ):
+        self.web_map = web_map
+        self.client = get_client() if client is None else client
+        self.layer = layer
+        self.tile_cache = TileCache() if tile_cache is None else tile_cache
+        self.tile_size = tile_size
+        self.max_level = max_level
+        self.workers = workers
+
+    @staticmethod
+    def tile_degrees(level: int) -> float:
+        return 1.0 / 2 ** level
+
+    def level_for(self, degrees_per_pixel: float) -> int:
+        """
+        Returns the coarsest level whose tiles are at least as detailed as `degrees_per_pixel`.
+        """
+        level = math.ceil(math.log2(1.0 / (self.tile_size * degrees_per_pixel)))
+        return min(max(level, 0), self.max_level)
+
+    def tile_bbox(self, tile: TileIndex) -> BBox:
+        level, column, row = tile
+        degrees = self.tile_degrees(level)
+        return column * degrees, row * degrees, (column + 1) * degrees, (row + 1) * degrees
+
+    def tiles_for(self, bbox: BBox, level: int) -> ty.List[TileIndex]:
+        degrees = self.tile_degrees(level)
+        min_lon, min_lat, max_lon, max_lat = bbox
+        columns = range(math.floor(min_lon / degrees), math.ceil(max_lon / degrees))
+        rows = range(math.floor(min_lat / degrees), math.ceil(max_lat / degrees))
+        return [(level, column, row) for row in rows for column in columns]
+
+    def _key(self, tile: TileIndex) -> str:
+        level, column, row = tile
+        version = getattr(self.web_map, "version", "1.1.1")
+        return f"{getattr(self.web_map, 'url', '')}|{version}|{self.layer}|{self.tile_size}|{level}/{column}/{row}"
+
+    def _getmap_url(self) -> str:
+        try:
+            return next(
+                method["url"]
+                for method in self.web_map.getOperationByName("GetMap").methods
+                if method.get("type", "").lower() == "get"
+            )
+        except (AttributeError, KeyError, StopIteration):
+            return self.web_map.url
+
+    def getmap_params(self, tile: TileIndex) -> ty.Dict[str, str]:
+        """
+        WMS GetMap parameters for `tile`, as owslib's `getmap` would send them.
+        """
+        version = getattr(self.web_map, "version", "1.1.1")
+        bbox = self.tile_bbox(tile)
+        if version == "1.3.0":
+            # WMS 1.3.0 follows EPSG:4326's axis order, latitude first
+            min_lon, min_lat, max_lon, max_lat = bbox
+            bbox = min_lat, min_lon, max_lat, max_lon
+        return {
+            "service": "WMS",
+            "version": version,
+            "request": "GetMap",
+            "layers": self.layer,
+            "styles": "",
+            "width": str(self.tile_size),
+            "height": str(self.tile_size),
+            "crs" if version == "1.3.0" else "srs": "EPSG:4326",
+            "bbox": ",".join(str(x) for x in bbox),
+            "format": "image/png",
+            "transparent": "TRUE",
+            "exceptions": "XML" if version == "1.3.0" else "application/vnd.ogc.se_xml",
+        }
+
+    def _fetch(self, tile: TileIndex) -> Image.Image:
+        response = self.client.get(self._getmap_url(), params=self.getmap_params(tile))
+        self.client.raise_for_status(response)
+        if "xml" in response.headers.get("Content-Type", ""):
+            raise ServiceException(response.content.decode("utf-8", "replace"))
+        return self.tile_cache.put(self._key(tile), response.content)
+
+    def get_tiles(self, tiles: ty.List[TileIndex]) -> ty.Dict[TileIndex, Image.Image]:
+        images = {}
+        missing = []
+        for tile in tiles:
+            image = self.tile_cache.get(self._key(tile))
+            if image is None:
+                missing.append(tile)
+            else:
+                images[tile] = image
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                images.update(zip(missing, executor.map(self._fetch, missing)))
+        return images
+
+    def render(self, bbox: BBox, size: ty.Tuple[int, int]) -> Image.Image:
+        """
+        Returns the `bbox` (min_lon, min_lat, max_lon, max_lat) part of the layer as an RGBA image
+        of `size` (width, height).
+        """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        width, height = size
+        level = self.level_for(min((max_lon - min_lon) / width, (max_lat - min_lat) / height))
+        tiles = self.tiles_for(bbox, level)
+        columns = sorted({column for _, column, _ in tiles})
+        rows = sorted({row for _, _, row in tiles})
+        mosaic = Image.new("RGBA", (len(columns) * self.tile_size, len(rows) * self.tile_size))
+        for (_, column, row), tile in self.get_tiles(tiles).items():
+            # Rows count up from the south, images from the top
+            mosaic.paste(tile, ((column - columns[0]) * self.tile_size, (rows[-1] - row) * self.tile_size))
+        degrees = self.tile_degrees(level)
+        pixels_per_degree = self.tile_size / degrees
+        north = (rows[-1] + 1) * degrees
+        west = columns[0] * degrees
+        extent = (
+            (min_lon - west) * pixels_per_degree,
+            (north - max_lat) * pixels_per_degree,
+            (max_lon - west) * pixels_per_degree,
+            (north - min_lat) * pixels_per_degree,
+        )
+        return mosaic.transform((width, height), Image.EXTENT, extent, resample=Image.BILINEAR)
@@ -0,0 +1,505 @@
+"""
+Panoramas and collages of any number of frames, placed by where the camera was pointing
+rather than in a fixed grid.
+
+A frame is positioned with its CAHV camera model (`Camera.camera_model_component_list`), or,
+for records without one, a pinhole model pointed along `mast_az`/`mast_el` or
+`Camera.camera_vector` with a nominal field of view for the camera, and its `subframe_rect`
+on the sensor. Frames are reprojected onto an azimuth/elevation canvas kept in a tiled memory
+map and feather-blended one at a time, so only a few decoded frames are in memory however many
+there are:
+
+    for frames in group_by_position(images):
+        mosaic = Mosaic.from_images(frames, scale=0.5)
+        mosaic.render()
+        mosaic.save(f"panorama-{frames[0].sol}.png")
+
+Directions are in the rover frame (x forward, y right, z down). Azimuth is in degrees clockwise
+from forward, elevation in degrees up from the horizon. Frames are treated as seen from a single
+point, so parallax between camera positions is ignored.
+"""
+import collections
+import math
+import tempfile
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from mars2020 import image_api as mapi
+from mars2020 import instrumentation
+
+# Horizontal field of view (degrees) and sensor (width, height) by instrument name part,
+# for frames without a camera model
+NOMINAL_CAMERAS = {
+    "NAVCAM": (96.0, (5120, 3840)),
+    "HAZCAM": (136.0, (5120, 3840)),
+    "MCZ": (25.6, (1648, 1200)),  # at the widest zoom
+}
+_DOWN = np.array([0.0, 0.0, 1.0])
+
+
+def directions(azimuth: np.ndarray, elevation: np.ndarray) -> np.ndarray:
+    """
+    Unit vectors (..., 3) for azimuths and elevations in degrees (broadcast against each other).
+    """
+    azimuth, elevation = np.radians(azimuth), np.radians(elevation)
+    cos_elevation = np.cos(elevation)
+    return np.stack(np.broadcast_arrays(
+        cos_elevation * np.cos(azimuth), cos_elevation * np.sin(azimuth), -np.sin(elevation)
+    ), axis=-1)
+
+
+def angles(vectors: np.ndarray) -> ty.Tuple[np.ndarray, np.ndarray]:
+    """
+    Azimuths and elevations in degrees of vectors (..., 3).
+    """
+    x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
+    return np.degrees(np.arctan2(y, x)), np.degrees(np.arctan2(-z, np.hypot(x, y)))
+
+
+@dataclass
+class FramePlacement:
+    """
+    A frame on the sensor of a CAHV camera: a direction d falls on sensor pixel (d.H / d.A, d.V / d.A),
+    and the frame covers the sensor from pixel `origin` in steps of `scale` sensor pixels.
+    """
+    image: mapi.ImageData
+    a: np.ndarray
+    h: np.ndarray
+    v: np.ndarray
+    origin: ty.Tuple[float, float]  # sensor pixel (x, y) of the frame's top left pixel
+    scale: float  # sensor pixels per frame pixel
+    size: ty.Tuple[int, int]  # frame width and height
+
+    @property
+    def resolution(self) -> float:
+        """
+        Degrees per frame pixel at the center of the sensor.
+        """
+        return math.degrees(self.scale / np.linalg.norm(np.cross(self.a, self.h)))
+
+    def resized(self, size: ty.Tuple[int, int]) -> "FramePlacement":
+        """
+        The same frame, decoded at `size` (e.g. a smaller rendition).
+        """
+        return replace(self, scale=self.scale * self.size[0] / size[0], size=size)
+
+    def to_frame(self, vectors: np.ndarray) -> ty.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Frame pixel coordinates (x, y) of directions (..., 3), and whether each is in front of the camera.
+        """
+        along = vectors @ self.a
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = ((vectors @ self.h) / along - self.origin[0] + 0.5) / self.scale - 0.5
+            y = ((vectors @ self.v) / along - self.origin[1] + 0.5) / self.scale - 0.5
+        return x, y, along > 1e-6
+
+    def to_directions(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Unit directions (..., 3) of frame pixel coordinates.
+        """
+        sensor_x = (np.asarray(x, dtype=float)[..., None] + 0.5) * self.scale + self.origin[0] - 0.5
+        sensor_y = (np.asarray(y, dtype=float)[..., None] + 0.5) * self.scale + self.origin[1] - 0.5
+        vectors = np.cross(self.h - sensor_x * self.a, self.v - sensor_y * self.a)
+        vectors *= np.sign(vectors @ self.a)[..., None]
+        return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+    def border(self, samples: int = 16) -> np.ndarray:
+        """
+        Directions of points around the edge of the frame.
+        """
+        width, height = self.size
+        steps = np.linspace(0, 1, samples)
+        x = np.concatenate([steps * width, np.full(samples, width), steps * width, np.zeros(samples)]) - 0.5
+        y = np.concatenate([np.zeros(samples), steps * height, np.full(samples, height), steps * height]) - 0.5
+        return self.to_directions(x, y)
+
+    def center(self) -> np.ndarray:
+        return self.to_directions((self.size[0] - 1) / 2, (self.size[1] - 1) / 2)
+
+
+def camera_model(image: mapi.ImageData) -> ty.Union[None, ty.Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    The A, H and V vectors of a frame's CAHV(ORE) camera model, if it has a usable one.
+    """
+    camera = image.camera_type
+    components = camera.camera_model_component_list
+    if not (camera.camera_model_type or "").startswith("CAHV") or not components or len(components) < 4:
+        return None
+    try:
+        a, h, v = (np.array(mapi.parse_float_tuple(component)) for component in components[1:4])
+    except ValueError:
+        return None
+    if any(vector.shape != (3,) for vector in (a, h, v)) or abs(np.linalg.norm(a) - 1) > 1e-3:
+        return None
+    return a, h, v
+
+
+def pointing(image: mapi.ImageData) -> ty.Union[None, np.ndarray]:
+    """
+    Unit vector the camera was pointing along, from the mast azimuth/elevation or the camera vector.
+    """
+    extended_info = image.extended_info
+    try:
+        return directions(float(extended_info.mast_az), float(extended_info.mast_el))
+    except (TypeError, ValueError):
+        pass
+    vector = image.camera_type.camera_vector
+    if vector is None or not np.any(vector):
+        return None
+    return np.array(vector) / np.linalg.norm(vector)
+
+
+def _nominal_model(
+    image: mapi.ImageData, fields_of_view: ty.Dict[str, ty.Tuple[float, ty.Tuple[int, int]]]
+) -> ty.Union[None, ty.Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    a = pointing(image)
+    instrument = image.camera_type.instrument or ""
+    camera = next((value for name, value in fields_of_view.items() if name in instrument), None)
+    if a is None or camera is None:
+        return None
+    field_of_view, (width, height) = camera
+    focal_length = width / 2 / math.tan(math.radians(field_of_view) / 2)
+    right = np.cross(_DOWN, a)
+    if np.linalg.norm(right) < 1e-6:
+        # Looking straight up or down, take forward as the top of the frame
+        right = np.array([0.0, 1.0, 0.0])
+    right /= np.linalg.norm(right)
+    below = np.cross(a, right)
+    return a, focal_length * right + (width - 1) / 2 * a, focal_length * below + (height - 1) / 2 * a
+
+
+def place(
+    image: mapi.ImageData,
+    fields_of_view: ty.Dict[str, ty.Tuple[float, ty.Tuple[int, int]]] = NOMINAL_CAMERAS,
+) -> ty.Union[None, FramePlacement]:
+    """
+    Where a frame points, or None if it has neither a camera model nor a pointing and nominal
+    field of view. Frames without a dimension in their record are sized from their header.
+    """
+    model = camera_model(image) or _nominal_model(image, fields_of_view)
+    if model is None:
+        return None
+    size = image.rendition_size()
+    if size is None:
+        from mars2020.cache import get_image_cache
+
+        with get_image_cache().open(image.image_url) as frame:
+            size = frame.size
+    subframe = image.extended_info.subframe_rect
+    if subframe is not None:
+        origin, scale = (subframe[0] - 1, subframe[1] - 1), subframe[2] / size[0]
+    else:
+        origin, scale = (0, 0), image.extended_info.scale_factor or 1.0
+    return FramePlacement(image, *model, origin=origin, scale=scale, size=size)
+
+
+def group_by_position(images: ty.Iterable[mapi.ImageData], tolerance: float = 1.0) -> ty.List[ty.List[mapi.ImageData]]:
+    """
+    Groups frames taken from the same place (`ExtendedInfo.xyz` within `tolerance` metres), as
+    only those line up in one panorama. Frames without a position are grouped last.
+    """
+    positions: ty.List[np.ndarray] = []
+    groups: ty.List[ty.List[mapi.ImageData]] = []
+    unknown = []
+    for image in images:
+        xyz = image.extended_info.xyz
+        if xyz is None:
+            unknown.append(image)
+            continue
+        xyz = np.array(xyz)
+        for position, group in zip(positions, groups):
+            if np.linalg.norm(position - xyz) <= tolerance:
+                group.append(image)
+                break
+        else:
+            positions.append(xyz)
+            groups.append([image])
+    return groups + ([unknown] if unknown else [])
+
+
+class TiledCanvas:
+    """
+    A float32 (height, width, channels) array stored tile by tile in a memory map (a temporary
+    file, or a .npy at `path`), so a frame's footprint is a few contiguous blocks of the file
+    rather than a slice of every row it crosses.
+    """
+
+    def __init__(
+        self,
+        shape: ty.Tuple[int, int],
+        channels: int = 4,
+        tile_size: int = 256,
+        path: ty.Union[None, str, Path] = None,
+    ):
+        self.shape = shape
+        self.channels = channels
+        self.tile_size = tile_size
+        tiles_shape = (-(-shape[0] // tile_size), -(-shape[1] // tile_size), tile_size, tile_size, channels)
+        if path is None:
+            self._file = tempfile.TemporaryFile()
+            self.tiles = np.memmap(self._file, dtype=np.float32, mode="w+", shape=tiles_shape)
+        else:
+            self._file = None
+            self.tiles = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=tiles_shape)
+
+    def _blocks(self, y0: int, y1: int, x0: int, x1: int):
+        size = self.tile_size
+        for i in range(y0 // size, -(-y1 // size)):
+            rows = slice(max(y0, i * size), min(y1, (i + 1) * size))
+            for j in range(x0 // size, -(-x1 // size)):
+                columns = slice(max(x0, j * size), min(x1, (j + 1) * size))
+                tile = (i, j, slice(rows.start - i * size, rows.stop - i * size),
+                        slice(columns.start - j * size, columns.stop - j * size))
+                yield tile, (slice(rows.start - y0, rows.stop - y0), slice(columns.start - x0, columns.stop - x0))
+
+    def add(self, y0: int, x0: int, values: np.ndarray):
+        for tile, region in self._blocks(y0, y0 + values.shape[0], x0, x0 + values.shape[1]):
+            self.tiles[tile] += values[region]
+
+    def read(self, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+        values = np.empty((y1 - y0, x1 - x0, self.channels), dtype=np.float32)
+        for tile, region in self._blocks(y0, y1, x0, x1):
+            values[region] = self.tiles[tile]
+        return values
+
+    def flush(self):
+        self.tiles.flush()
+
+    def close(self):
+        del self.tiles
+        if self._file is not None:
+            self._file.close()
+
+
+def _sample(frame: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Bilinear samples of `frame` (height, width, channels) at pixel coordinates inside it.
+    """
+    height, width = frame.shape[:2]
+    x0 = np.floor(x).astype(np.intp)
+    y0 = np.floor(y).astype(np.intp)
+    x1, y1 = np.minimum(x0 + 1, width - 1), np.minimum(y0 + 1, height - 1)
+    fx, fy = (x - x0)[..., None], (y - y0)[..., None]
+    top = frame[y0, x0] * (1 - fx) + frame[y0, x1] * fx
+    bottom = frame[y1, x0] * (1 - fx) + frame[y1, x1] * fx
+    return top * (1 - fy) + bottom * fy
+
+
+class Mosaic:
+    """
+    Frames reprojected onto an equirectangular canvas of `shape` (height, width) pixels of
+    `resolution` degrees, whose top left corner is at `origin` (azimuth, elevation).
+
+    Overlapping frames are blended with weights falling off towards each frame's edges
+    (raised to `feather`; 0 averages them evenly), accumulated in a `TiledCanvas`.
+    """
+
+    def __init__(
+        self,
+        placements: ty.List[FramePlacement],
+        resolution: float,
+        origin: ty.Tuple[float, float],
+        shape: ty.Tuple[int, int],
+        feather: float = 1.0,
+        tile_size: int = 256,
+        path: ty.Union[None, str, Path] = None,
+        prefetch: int = 4,
+    ):
+        self.placements = placements
+        self.resolution = resolution
+        self.origin = origin
+        self.shape = shape
+        self.feather = feather
+        self.prefetch = prefetch
+        self.canvas = TiledCanvas(shape, channels=4, tile_size=tile_size, path=path)
+        self.skipped: ty.List[mapi.ImageData] = []
+
+    @classmethod
+    def from_images(
+        cls,
+        images: ty.Iterable[mapi.ImageData],
+        resolution: ty.Union[None, float] = None,
+        scale: float = 1.0,
+        fields_of_view: ty.Dict[str, ty.Tuple[float, ty.Tuple[int, int]]] = NOMINAL_CAMERAS,
+        **kwargs,
+    ) -> "Mosaic":
+        """
+        A mosaic just big enough for `images`. `resolution` (degrees per pixel) defaults to the
+        median of the frames' own, divided by `scale`. Frames that can't be placed are left out
+        and listed in `skipped`.
+        """
+        placements, skipped = [], []
+        for image in images:
+            placement = place(image, fields_of_view)
+            if placement is None:
+                skipped.append(image)
+            else:
+                placements.append(placement)
+        if not placements:
+            raise ValueError("none of the frames have a camera model or pointing to place them with")
+        if resolution is None:
+            resolution = float(np.median([placement.resolution for placement in placements])) / scale
+
+        centers = np.array([angles(placement.center())[0] for placement in placements])
+        # Start the canvas at the frame after the widest gap in azimuth, so it doesn't cut through the middle
+        ordered = np.sort(centers)
+        gaps = np.diff(np.append(ordered, ordered[0] + 360))
+        start = ordered[(np.argmax(gaps) + 1) % len(ordered)]
+        azimuths, elevations = [], []
+        for placement, center in zip(placements, centers):
+            azimuth, elevation = angles(placement.border())
+            azimuths.append(start + (center - start) % 360 + _wrap(azimuth - center))
+            elevations.append(elevation)
+        azimuths, elevations = np.concatenate(azimuths), np.concatenate(elevations)
+        left, top = azimuths.min(), elevations.max()
+        width = min(azimuths.max() - left, 360.0)
+        shape = (max(1, math.ceil((top - elevations.min()) / resolution)), max(1, math.ceil(width / resolution)))
+        mosaic = cls(placements, resolution, (float(left), float(top)), shape, **kwargs)
+        mosaic.skipped = skipped
+        return mosaic
+
+    @property
+    def full_circle(self) -> bool:
+        return self.shape[1] * self.resolution >= 360.0
+
+    def windows(self, placement: FramePlacement) -> ty.List[ty.Tuple[int, int, int, int]]:
+        """
+        Canvas rows and columns (y0, y1, x0, x1) covered by a frame; two windows if it crosses
+        the seam of a full-circle panorama.
+        """
+        center = angles(placement.center())[0]
+        azimuth, elevation = angles(placement.border())
+        azimuth = self.origin[0] + (center - self.origin[0]) % 360 + _wrap(azimuth - center)
+        x0 = math.floor((azimuth.min() - self.origin[0]) / self.resolution)
+        x1 = math.ceil((azimuth.max() - self.origin[0]) / self.resolution)
+        y0 = max(0, math.floor((self.origin[1] - elevation.max()) / self.resolution))
+        y1 = min(self.shape[0], math.ceil((self.origin[1] - elevation.min()) / self.resolution))
+        turn = round(360 / self.resolution)
+        shifts = (0, -turn, turn) if self.full_circle else (0,)
+        windows = []
+        for shift in shifts:
+            left, right = max(0, x0 + shift), min(self.shape[1], x1 + shift)
+            if left < right and y0 < y1:
+                windows.append((y0, y1, left, right))
+        return windows
+
+    def _load(self, placement: FramePlacement) -> ty.Tuple[FramePlacement, np.ndarray]:
+        # Decode no more pixels than the canvas can show
+        shrink = placement.resolution / self.resolution
+        if shrink < 0.9:
+            width, height = placement.size
+            frame = placement.image.load(size=(math.ceil(width * shrink) + 1, math.ceil(height * shrink) + 1))
+        else:
+            frame = placement.image.load(mode="full")
+        return placement.resized(frame.size), np.asarray(frame.convert("RGB"), dtype=np.float32)
+
+    def add(self, placement: FramePlacement, frame: np.ndarray, max_pixels: int = 1 << 20):
+        """
+        Blends a decoded frame (height, width, 3) into the canvas, `max_pixels` canvas pixels at a time.
+        """
+        width, height = placement.size
+        for y0, y1, x0, x1 in self.windows(placement):
+            azimuth = self.origin[0] + (np.arange(x0, x1) + 0.5) * self.resolution
+            rows = max(1, max_pixels // (x1 - x0))
+            with instrumentation.timed("grid", "mosaic", size=(y1 - y0) * (x1 - x0)):
+                for row in range(y0, y1, rows):
+                    elevation = self.origin[1] - (np.arange(row, min(row + rows, y1)) + 0.5) * self.resolution
+                    x, y, in_front = placement.to_frame(directions(azimuth[None, :], elevation[:, None]))
+                    inside = in_front & (x >= -0.5) & (x <= width - 0.5) & (y >= -0.5) & (y <= height - 0.5)
+                    if not inside.any():
+                        continue
+                    x, y = np.clip(np.nan_to_num(x), 0, width - 1), np.clip(np.nan_to_num(y), 0, height - 1)
+                    if self.feather:
+                        weight = (np.minimum(x + 0.5, width - 0.5 - x) / (width / 2)) * (
+                            np.minimum(y + 0.5, height - 0.5 - y) / (height / 2)
+                        )
+                        weight = np.maximum(weight, 1e-6) ** self.feather
+                    else:
+                        weight = np.ones(x.shape)
+                    weight = np.where(inside, weight, 0).astype(np.float32)[..., None]
+                    self.canvas.add(row, x0, np.concatenate([_sample(frame, x, y) * weight, weight], axis=-1))
+
+    def render(self, progress: ty.Union[None, ty.Callable[[int, int, FramePlacement], None]] = None) -> "Mosaic":
+        """
+        Decodes and blends every frame, decoding up to `prefetch` frames ahead in background threads.
+        `progress(done, total, placement)` is called after each one.
+        """
+        total = len(self.placements)
+        with ThreadPoolExecutor(max_workers=max(1, self.prefetch)) as executor:
+            pending = collections.deque()
+            placements = iter(self.placements)
+            for placement in placements:
+                pending.append(executor.submit(self._load, placement))
+                if len(pending) >= self.prefetch:
+                    break
+            done = 0
+            while pending:
+                placement, frame = pending.popleft().result()
+                next_placement = next(placements, None)
+                if next_placement is not None:
+                    pending.append(executor.submit(self._load, next_placement))
+                self.add(placement, frame)
+                done += 1
+                if progress is not None:
+                    progress(done, total, placement)
+        self.canvas.flush()
+        return self
+
+    def to_array(self, out: ty.Union[None, np.ndarray] = None) -> np.ndarray:
+        """
+        The blended canvas as RGBA uint8 (transparent where no frame reaches), written strip by
+        strip into `out` (e.g. a np.memmap) if given.
+        """
+        height, width = self.shape
+        if out is None:
+            out = np.zeros((height, width, 4), dtype=np.uint8)
+        step = self.canvas.tile_size
+        for y0 in range(0, height, step):
+            y1 = min(height, y0 + step)
+            values = self.canvas.read(y0, y1, 0, width)
+            weight = values[..., 3:]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rgb = np.where(weight > 0, values[..., :3] / weight, 0)
+            out[y0:y1, :, :3] = np.clip(np.rint(rgb), 0, 255)
+            out[y0:y1, :, 3] = np.where(weight[..., 0] > 0, 255, 0)
+        return out
+
+    def to_image(self) -> Image:
+        return Image.fromarray(self.to_array())
+
+    def save(self, path: ty.Union[str, Path], format: ty.Union[None, str] = None) -> Path:
+        """
+        Writes the mosaic to `path` through a memory-mapped canvas. A `.npy` path is kept as the
+        memory-mapped array itself.
+        """
+        path = Path(path)
+        shape = (*self.shape, 4)
+        if path.suffix == ".npy":
+            self.to_array(np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape)).flush()
+            return path
+        with tempfile.TemporaryFile() as scratch:
+            canvas = self.to_array(np.memmap(scratch, dtype=np.uint8, mode="w+", shape=shape))
+            Image.frombuffer("RGBA", (shape[1], shape[0]), canvas, "raw", "RGBA", 0, 1).save(path, format=format)
+            del canvas
+        return path
+
+    def close(self):
+        self.canvas.close()
+
+    def __enter__(self) -> "Mosaic":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _wrap(degrees: np.ndarray) -> np.ndarray:
+    """
+    Angles wrapped to [-180, 180).
+    """
+    return (degrees + 180) % 360 - 180
@@ -0,0 +1,137 @@
+"""
+Binary snapshots of an image catalog, see `ImageDataCollection.save` and `ImageDataCollection.load`.
+
+A snapshot is a directory holding
+    columns.npy  - the `ImageTable` columns as a structured array, memory-mapped on load
+    records.bin  - the raw feed record of every image as JSON, back to back, memory-mapped on load
+    offsets.npy  - start of each record in records.bin (plus the end of the last one)
+    meta.json    - format version, instrument names and collection counters
+Several processes loading the same snapshot share its pages instead of each holding a copy.
+Images are rebuilt from their records lazily, field by field, see `LazyImageData`.
+"""
+import json
+import mmap as mmap_module
+import typing as ty
+from pathlib import Path
+
+import numpy as np
+
+from mars2020 import image_api as mapi
+from mars2020.table import ImageTable
+
+FORMAT_VERSION = 3
+
+
+class RecordStore(ty.Sequence[mapi.ImageData]):
+    """
+    Read-only sequence of the images in a snapshot, see SnapshotImageData.
+    """
+
+    def __init__(self, path: ty.Union[str, Path], mmap: bool = True):
+        path = Path(path)
+        self.offsets = np.load(path / "offsets.npy", mmap_mode="r" if mmap else None)
+        with open(path / "records.bin", "rb") as records_file:
+            if mmap and self.offsets[-1] > 0:
+                self.buffer = mmap_module.mmap(records_file.fileno(), 0, access=mmap_module.ACCESS_READ)
+            else:
+                self.buffer = records_file.read()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, index: int) -> bytes:
+        return self.buffer[int(self.offsets[index]): int(self.offsets[index + 1])]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return SnapshotImageData(self, index)
+
+    def record(self, index: int) -> dict:
+        return json.loads(bytes(self.raw(index)))
+
+
+class SnapshotImageData(mapi.LazyImageData):
+    """
+    LazyImageData backed by a snapshot, whose record is only decoded the first time any field is read.
+    Without a store it takes fields like LazyImageData (see `dataclasses.replace`).
+    """
+    __slots__ = ("_store", "_index")
+
+    def __init__(self, store: ty.Union[None, RecordStore] = None, index: int = 0, **fields):
+        super().__init__(**fields)
+        if store is not None:
+            self._store = store
+            self._index = index
+
+    def __getattr__(self, name: str):
+        if name == "_record":
+            self._record = self._store.record(self._index)
+            return self._record
+        return super().__getattr__(name)
+
+    def __reduce__(self):
+        # Pickled (e.g. for worker processes) as a plain LazyImageData, without the memory-mapped store
+        return mapi.LazyImageData, (self.to_image_dictionary(),)
+
+
+def _record_bytes(image: mapi.ImageData) -> bytes:
+    if isinstance(image, SnapshotImageData) and getattr(image, "_store", None) is not None:
+        return bytes(image._store.raw(image._index))
+    return json.dumps(image.to_image_dictionary(), separators=(",", ":")).encode("utf-8")
+
+
+def save(collection: mapi.ImageDataCollection, path: ty.Union[str, Path]) -> Path:
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    offsets = np.zeros(len(collection.images) + 1, dtype=np.int64)
+    with open(path / "records.bin", "wb") as records_file:
+        for index, image in enumerate(collection.images):
+            offsets[index + 1] = offsets[index] + records_file.write(_record_bytes(image))
+    np.save(path / "offsets.npy", offsets)
+    table = collection.to_table()
+    np.save(path / "columns.npy", table.columns)
+    (path / "meta.json").write_text(
+        json.dumps(
+            {
+                "format_version": FORMAT_VERSION,
+                "instruments": list(table.instruments),
+                "page_number": collection.page_number,
+                "number_of_images": collection.number_of_images,
+                "total_images_in_database": collection.total_images_in_database,
+            }
+        )
+    )
+    return path
+
+
+def _read_meta(path: Path) -> dict:
+    meta = json.loads((path / "meta.json").read_text())
+    if meta.get("format_version") != FORMAT_VERSION:
+        raise ValueError(
+            f"{path} is a version {meta.get('format_version')} snapshot, expected version {FORMAT_VERSION}"
+        )
+    return meta
+
+
+def load_table(path: ty.Union[str, Path], mmap: bool = True) -> ImageTable:
+    path = Path(path)
+    meta = _read_meta(path)
+    columns = np.load(path / "columns.npy", mmap_mode="r" if mmap else None)
+    return ImageTable(columns, RecordStore(path, mmap=mmap), meta["instruments"])
+
+
+def load(path: ty.Union[str, Path], mmap: bool = True) -> mapi.ImageDataCollection:
+    path = Path(path)
+    meta = _read_meta(path)
+    table = load_table(path, mmap=mmap)
+    images: ty.List[mapi.ImageData] = [
+        SnapshotImageData(table.source, index) for index in range(len(table.source))
+    ]
+    collection = mapi.ImageDataCollection(
+        images, meta["page_number"], meta["number_of_images"], meta["total_images_in_database"]
+    )
+    collection.set_table(table)
+    return collection
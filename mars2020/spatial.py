@@ -0,0 +1,90 @@
+import re
+import typing as ty
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from mars2020 import image_api as mapi
+from mars2020.geo_api import BBox, Coordinate
+from mars2020.traverse import Traverse
+
+MARS_RADIUS_M = 3389.5e3
+
+
+def parse_site_position(site_position: str) -> ty.Union[None, ty.Tuple[int, int]]:
+    """
+    Returns (site, drive) from a waypoint's site position, e.g. "3_120" -> (3, 120).
+    """
+    numbers = re.findall(r"\d+", site_position)
+    if len(numbers) != 2:
+        return None
+    return int(numbers[0]), int(numbers[1])
+
+
+class RoverIndex:
+    """
+    Spatial index over rover waypoints, joined to the images taken at each waypoint's site/drive.
+
+    Waypoints are projected to local equirectangular metres around the traverse and put in a
+    KD-tree for radius and nearest-neighbour queries; bounding boxes are a vectorized mask.
+    """
+
+    def __init__(self, traverse: Traverse, images: mapi.ImageDataCollection):
+        self.traverse = traverse
+        self.images = images
+        self.reference_latitude = float(np.mean(traverse.coordinates[:, 1])) if len(traverse) else 0.0
+        self.tree = cKDTree(self.to_metres(traverse.coordinates))
+        self.site_drive = [parse_site_position(site) for site in traverse.site_position.tolist()]
+
+    def to_metres(self, coordinates) -> np.ndarray:
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        scale = np.radians(1.0) * MARS_RADIUS_M
+        return coordinates * [scale * np.cos(np.radians(self.reference_latitude)), scale]
+
+    def waypoints_in_bbox(self, bbox: BBox) -> np.ndarray:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        lon, lat = self.traverse.coordinates[:, 0], self.traverse.coordinates[:, 1]
+        return np.flatnonzero((lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat))
+
+    def waypoints_within(self, point: Coordinate, radius_m: float) -> np.ndarray:
+        return np.array(sorted(self.tree.query_ball_point(self.to_metres(point)[0], radius_m)), dtype=np.int64)
+
+    def nearest_waypoints(self, point: Coordinate, k: int = 1) -> np.ndarray:
+        _, indices = self.tree.query(self.to_metres(point)[0], k=min(k, len(self.traverse)))
+        return np.atleast_1d(indices)
+
+    def images_at(self, waypoints: ty.Iterable[int]) -> ty.List[mapi.ImageData]:
+        """
+        Images taken at the site/drive of any of the given waypoints.
+        """
+        locations = dict.fromkeys(
+            self.site_drive[waypoint] for waypoint in waypoints if self.site_drive[waypoint] is not None
+        )
+        return [image for location in locations for image in self.images.by_vehicle_location(*location)]
+
+    def images_in_bbox(self, bbox: BBox) -> ty.List[mapi.ImageData]:
+        return self.images_at(self.waypoints_in_bbox(bbox))
+
+    def images_within(self, point: Coordinate, radius_m: float) -> ty.List[mapi.ImageData]:
+        return self.images_at(self.waypoints_within(point, radius_m))
+
+    def nearest_images(self, point: Coordinate, k: int = 1) -> ty.List[mapi.ImageData]:
+        """
+        Images taken at the `k` waypoints nearest to `point`.
+        """
+        return self.images_at(self.nearest_waypoints(point, k))
+
+    def locate(self, images: ty.Iterable[mapi.ImageData]) -> np.ndarray:
+        """
+        Returns the (N, 2) lon/lat of each image's site/drive, NaN where no waypoint matches.
+        Can be passed straight to `JezeroMap.center_and_return_map_image`.
+        """
+        location_index = {location: index for index, location in enumerate(self.site_drive) if location is not None}
+        positions = [
+            location_index.get(mapi.site_drive(image.instrument_metadata.vehicle_location), -1) for image in images
+        ]
+        coordinates = np.full((len(positions), 2), np.nan)
+        positions = np.array(positions, dtype=np.int64)
+        found = positions >= 0
+        coordinates[found] = self.traverse.coordinates[positions[found]]
+        return coordinates
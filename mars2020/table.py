@@ -0,0 +1,195 @@
+import typing as ty
+from datetime import datetime, timezone
+
+import numpy as np
+
+from mars2020 import image_api as mapi
+
+COLUMNS = np.dtype(
+    [
+        ("row", np.int64),
+        ("sol", np.int32),
+        ("instrument", np.int16),
+        ("filter_number", "U1"),
+        ("thumbnail", np.bool_),
+        ("earth_date_utc", "datetime64[ms]"),
+        ("date_received_on_earth_utc", "datetime64[ms]"),
+        ("width", np.int32),
+        ("height", np.int32),
+        ("xyz", np.float64, (3,)),
+    ]
+)
+
+# Stand-in for missing integers, missing dates are NaT and missing floats NaN
+MISSING = -1
+
+Source = ty.Union[ty.Sequence[mapi.ImageData], ty.Sequence[dict]]
+
+
+def _to_datetime64(value: ty.Union[None, str, datetime]) -> np.datetime64:
+    if value is None or value == "UNK":
+        return np.datetime64("NaT", "ms")
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return np.datetime64(value, "ms")
+    try:
+        return np.datetime64(value.rstrip("Z"), "ms")
+    except ValueError:
+        return _to_datetime64(mapi.check_date({"date": value}, "date"))
+
+
+def _parse_tuple(value: ty.Union[None, str], length: int) -> ty.Tuple[float, ...]:
+    if value is None or value == "UNK":
+        return (np.nan,) * length
+    return tuple(map(float, value[1:-1].split(",")))
+
+
+class ImageTable:
+    """
+    Columnar view of image metadata as a structured NumPy array (see `COLUMNS`), for vectorized
+    filtering and grouping.
+
+    Instruments are stored as codes into `instruments`. Each row keeps the index of its record in
+    `source` (either `ImageData` objects or raw feed records); `ImageData` objects are only
+    built when asked for. Subsets share `source` and only copy the small columns.
+    """
+
+    def __init__(self, columns: np.ndarray, source: Source, instruments: ty.Sequence[str]):
+        self.columns = columns
+        self.source = source
+        self.instruments = tuple(instruments)
+
+    @classmethod
+    def from_images(cls, images: ty.Sequence[mapi.ImageData]) -> "ImageTable":
+        instruments: ty.Dict[str, int] = {}
+        columns = np.empty(len(images), dtype=COLUMNS)
+        for row, image in enumerate(images):
+            dimension = image.dimension or (MISSING, MISSING)
+            columns[row] = (
+                row,
+                MISSING if image.sol is None else image.sol,
+                instruments.setdefault(image.camera_type.instrument, len(instruments)),
+                image.instrument_metadata.filter_number,
+                image.instrument_metadata.thumbnail,
+                _to_datetime64(image.earth_date_utc),
+                _to_datetime64(image.date_received_on_earth_utc),
+                dimension[0],
+                dimension[1],
+                image.extended_info.xyz or (np.nan,) * 3,
+            )
+        return cls(columns, images, list(instruments))
+
+    @classmethod
+    def from_records(cls, records: ty.Sequence[dict]) -> "ImageTable":
+        """
+        Builds the columns straight from raw feed records, without creating `ImageData` objects.
+        """
+        instruments: ty.Dict[str, int] = {}
+        columns = np.empty(len(records), dtype=COLUMNS)
+        for row, record in enumerate(records):
+            image_id = record["imageid"]
+            instrument_meta = mapi.InstrumentMeta.from_image_id(image_id)
+            extended = record.get("extended") or {}
+            dimension = _parse_tuple(mapi.check_none(extended, "dimension"), 2)
+            columns[row] = (
+                row,
+                int(record["sol"]) if record.get("sol") is not None else MISSING,
+                instruments.setdefault(mapi.check_none(record["camera"], "instrument"), len(instruments)),
+                instrument_meta.filter_number,
+                instrument_meta.thumbnail,
+                _to_datetime64(mapi.check_none(record, "date_taken_utc")),
+                _to_datetime64(mapi.check_none(record, "date_received")),
+                MISSING if np.isnan(dimension[0]) else dimension[0],
+                MISSING if np.isnan(dimension[1]) else dimension[1],
+                _parse_tuple(mapi.check_none(extended, "xyz"), 3),
+            )
+        return cls(columns, records, list(instruments))
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __getitem__(self, key) -> ty.Union[np.ndarray, "ImageTable"]:
+        """
+        A column name returns that column (instrument names decoded), a boolean mask,
+        slice or index array returns the matching subset of the table.
+        """
+        if isinstance(key, str):
+            if key == "instrument":
+                return np.array(self.instruments, dtype=object)[self.columns["instrument"]]
+            return self.columns[key]
+        return ImageTable(self.columns[key], self.source, self.instruments)
+
+    def mask(self, **conditions) -> np.ndarray:
+        """
+        Returns a boolean mask for rows where each named column equals the given value,
+        or is one of the given values for a list, tuple or set.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for name, value in conditions.items():
+            if name == "instrument":
+                values = value if isinstance(value, (list, tuple, set)) else [value]
+                codes = [self.instruments.index(v) for v in values if v in self.instruments]
+                mask &= np.isin(self.columns["instrument"], codes)
+            elif isinstance(value, (list, tuple, set)):
+                mask &= np.isin(self.columns[name], list(value))
+            else:
+                mask &= self.columns[name] == value
+        return mask
+
+    def where(self, **conditions) -> "ImageTable":
+        """
+        E.g. `table.where(instrument="EDL_RDCAM", thumbnail=False, filter_number="E")`
+        """
+        return self[self.mask(**conditions)]
+
+    def group_by(self, name: str) -> ty.Dict[ty.Any, "ImageTable"]:
+        keys, inverse = np.unique(self.columns[name], return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        boundaries = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+        if name == "instrument":
+            keys = [self.instruments[key] for key in keys]
+        else:
+            keys = keys.tolist()
+        return {
+            key: self[indices]
+            for key, indices in zip(keys, np.split(order, boundaries))
+        }
+
+    def image(self, index: int) -> mapi.ImageData:
+        item = self.source[self.columns["row"][index]]
+        if isinstance(item, dict):
+            return mapi.ImageData.from_image_dictionary(item)
+        return item
+
+    def images(self) -> ty.List[mapi.ImageData]:
+        return [self.image(index) for index in range(len(self))]
+
+    def __iter__(self) -> ty.Iterator[mapi.ImageData]:
+        return (self.image(index) for index in range(len(self)))
+
+    def to_collection(self) -> mapi.ImageDataCollection:
+        images = self.images()
+        return mapi.ImageDataCollection(images, None, len(images), len(images))
+
+    def to_dict(self) -> ty.Dict[str, np.ndarray]:
+        columns = {name: self[name] for name in COLUMNS.names if name != "xyz"}
+        for axis, name in enumerate("xyz"):
+            columns[name] = self.columns["xyz"][:, axis]
+        return columns
+
+    def to_pandas(self):
+        """
+        Requires pandas.
+        """
+        import pandas as pd
+
+        return pd.DataFrame(self.to_dict())
+
+    def to_arrow(self):
+        """
+        Requires pyarrow.
+        """
+        import pyarrow as pa
+
+        return pa.table({name: np.asarray(column) for name, column in self.to_dict().items()})
@@ -0,0 +1,152 @@
+import json
+import typing as ty
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import requests as rq
+
+from mars2020 import geo_api
+from mars2020.cache import HTTPCache
+from mars2020.client import HTTPClient
+
+DEFAULT_GEO_DIRECTORY = Path.home() / ".mars2020" / "geo"
+
+
+@dataclass
+class Traverse:
+    """
+    Rover waypoints and drive paths as contiguous NumPy arrays.
+
+    Waypoints are sorted by sol. Paths are stored CSR-style: path i runs over
+    `path_coordinates[path_offsets[i]:path_offsets[i + 1]]`. They are sorted by `path_sol`,
+    the sol of the waypoint whose site position matches the path's end (toRMC), -1 if none does.
+    """
+    coordinates: np.ndarray  # (N, 2) lon/lat
+    sol: np.ndarray  # (N,)
+    attitude: np.ndarray  # (N, 3) roll, pitch, yaw in degrees
+    distance_km: np.ndarray  # (N,)
+    site_position: np.ndarray  # (N,) str
+    drive_type: np.ndarray  # (N,) str
+    path_coordinates: np.ndarray  # (M, 2) lon/lat
+    path_offsets: np.ndarray  # (P + 1,)
+    path_sol: np.ndarray  # (P,)
+    path_length: np.ndarray  # (P,)
+    path_id: np.ndarray  # (P,) str
+    path_from_rmc: np.ndarray  # (P,) str
+    path_to_rmc: np.ndarray  # (P,) str
+
+    @classmethod
+    def from_geojson(cls, waypoints: dict, traverse: dict) -> "Traverse":
+        features = waypoints["features"]
+        properties = [feature["properties"] for feature in features]
+        sol = np.array([int(p["sol"]) for p in properties], dtype=np.int32)
+        order = np.argsort(sol, kind="stable")
+        site_position = np.array([str(p["site_pos"]) for p in properties], dtype=str)[order]
+        sol = sol[order]
+
+        paths = traverse["features"]
+        sol_by_site = dict(zip(site_position.tolist(), sol.tolist()))
+        path_sol = np.array(
+            [sol_by_site.get(str(path["properties"]["toRMC"]), -1) for path in paths], dtype=np.int32
+        )
+        path_order = np.argsort(path_sol, kind="stable")
+        path_arrays = [
+            np.array([c[:2] for c in paths[i]["geometry"]["coordinates"]], dtype=np.float64).reshape(-1, 2)
+            for i in path_order
+        ]
+        path_offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([len(array) for array in path_arrays], out=path_offsets[1:])
+        path_properties = [paths[i]["properties"] for i in path_order]
+        return cls(
+            coordinates=np.array(
+                [feature["geometry"]["coordinates"][:2] for feature in features], dtype=np.float64
+            ).reshape(-1, 2)[order],
+            sol=sol,
+            attitude=np.array(
+                [(float(p["roll_deg"]), float(p["pitch_deg"]), float(p["yaw_deg"])) for p in properties],
+                dtype=np.float64,
+            ).reshape(-1, 3)[order],
+            distance_km=np.array([float(p["dist_km"]) for p in properties], dtype=np.float64)[order],
+            site_position=site_position,
+            drive_type=np.array([str(p["drivetype"]) for p in properties], dtype=str)[order],
+            path_coordinates=np.concatenate(path_arrays) if path_arrays else np.empty((0, 2)),
+            path_offsets=path_offsets,
+            path_sol=path_sol[path_order],
+            path_length=np.array([float(p["length"]) for p in path_properties], dtype=np.float64),
+            path_id=np.array([str(p["Id"]) for p in path_properties], dtype=str),
+            path_from_rmc=np.array([str(p["fromRMC"]) for p in path_properties], dtype=str),
+            path_to_rmc=np.array([str(p["toRMC"]) for p in path_properties], dtype=str),
+        )
+
+    @classmethod
+    def load(
+        cls,
+        directory: ty.Union[str, Path] = DEFAULT_GEO_DIRECTORY,
+        waypoints_url: str = geo_api.WAYPOINTS_URL,
+        traverse_url: str = geo_api.TRAVERSE_URL,
+        client: ty.Union[None, HTTPClient] = None,
+    ) -> "Traverse":
+        """
+        Loads the waypoints and traverse GeoJSON, kept on disk under `directory` and refreshed
+        with a conditional GET. The cached copy is used as is if the server can't be reached.
+        """
+        cache = HTTPCache(directory, max_bytes=256 * 1024 ** 2, revalidate=True, client=client)
+
+        def fetch(url: str) -> dict:
+            try:
+                data = cache.get_bytes(url)
+            except rq.RequestException:
+                data = cache.read(url)
+                if data is None:
+                    raise
+            return json.loads(data)
+
+        return cls.from_geojson(fetch(waypoints_url), fetch(traverse_url))
+
+    def __len__(self):
+        return len(self.sol)
+
+    @property
+    def number_of_paths(self) -> int:
+        return len(self.path_offsets) - 1
+
+    def path(self, index: int) -> np.ndarray:
+        return self.path_coordinates[self.path_offsets[index]: self.path_offsets[index + 1]]
+
+    def paths(self) -> ty.List[np.ndarray]:
+        return [self.path(index) for index in range(self.number_of_paths)]
+
+    def waypoint_slice(self, first_sol: int, last_sol: int) -> slice:
+        """
+        Index range of the waypoints from `first_sol` to `last_sol` inclusive.
+        """
+        return slice(
+            int(np.searchsorted(self.sol, first_sol, side="left")),
+            int(np.searchsorted(self.sol, last_sol, side="right")),
+        )
+
+    def sol_range(self, first_sol: int, last_sol: int) -> "Traverse":
+        """
+        Returns the waypoints and paths from `first_sol` to `last_sol` inclusive.
+        Waypoint and path coordinate arrays are views into this traverse.
+        """
+        waypoints = self.waypoint_slice(first_sol, last_sol)
+        first_path = int(np.searchsorted(self.path_sol, first_sol, side="left"))
+        last_path = int(np.searchsorted(self.path_sol, last_sol, side="right"))
+        start, stop = self.path_offsets[first_path], self.path_offsets[last_path]
+        return Traverse(
+            coordinates=self.coordinates[waypoints],
+            sol=self.sol[waypoints],
+            attitude=self.attitude[waypoints],
+            distance_km=self.distance_km[waypoints],
+            site_position=self.site_position[waypoints],
+            drive_type=self.drive_type[waypoints],
+            path_coordinates=self.path_coordinates[start:stop],
+            path_offsets=self.path_offsets[first_path: last_path + 1] - start,
+            path_sol=self.path_sol[first_path:last_path],
+            path_length=self.path_length[first_path:last_path],
+            path_id=self.path_id[first_path:last_path],
+            path_from_rmc=self.path_from_rmc[first_path:last_path],
+            path_to_rmc=self.path_to_rmc[first_path:last_path],
+        )
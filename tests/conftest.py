@@ -0,0 +1,49 @@
+import sys
+import typing as ty
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+# The feed server and records are shared with the benchmarks
+sys.path.insert(0, str(Path(__file__).parents[1] / "benchmarks"))
+
+from common import FIXTURE, FeedServer, cluster_records, png_bytes
+from common import numbered_records as make_records
+
+from mars2020 import cache
+from mars2020 import image_api as mapi
+from mars2020.client import HTTPClient
+
+
+@pytest.fixture
+def feed_server():
+    with FeedServer(make_records(1000)) as server:
+        yield server
+
+
+@pytest.fixture
+def client():
+    with HTTPClient(retries=0, http2=False) as client:
+        yield client
+
+
+@pytest.fixture
+def image_cache(tmp_path):
+    previous = cache.get_image_cache()
+    image_cache = cache.ImageCache(tmp_path / "images")
+    cache.set_image_cache(image_cache)
+    yield image_cache
+    cache.set_image_cache(previous)
+
+
+def cached_frames(
+    image_cache: cache.ImageCache, number_of_frames: int, size: ty.Tuple[int, int], dimension: ty.Tuple[int, int]
+) -> ty.List[mapi.ImageData]:
+    """
+    A cluster of frames of `size` put straight into `image_cache`, whose records claim `dimension`.
+    """
+    records = cluster_records(1, number_of_frames, image_url="http://example.invalid", dimension=dimension)
+    for n, record in enumerate(records):
+        image_cache.write(record["image_files"]["full_res"], png_bytes(Image.new("RGB", size, (n, n, n))))
+    return [mapi.ImageData.from_image_dictionary(record) for record in records]
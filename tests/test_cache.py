@@ -0,0 +1,72 @@
+import io
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+from PIL import Image
+
+from mars2020 import cache as cache_module
+from mars2020.cache import ImageCache
+
+URL = "http://example.invalid/frame.png"
+
+
+def png_bytes(size=(80, 60)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class StaticClient:
+    """
+    Stands in for HTTPClient, answering every request with `data`.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.requests = 0
+
+    def get(self, url, headers=None):
+        self.requests += 1
+        return SimpleNamespace(status_code=200, content=self.data, headers={})
+
+    def raise_for_status(self, response):
+        pass
+
+
+def test_get_image_returns_a_copy(tmp_path):
+    cache = ImageCache(tmp_path)
+    cache.write(URL, png_bytes())
+    cache.get_image(URL).thumbnail((10, 10))
+    assert cache.get_image(URL).size == (80, 60)
+
+
+def test_read_survives_concurrent_eviction(tmp_path, monkeypatch):
+    cache = ImageCache(tmp_path)
+    cache.write(URL, b"data")
+    utime = os.utime
+
+    def evicting_utime(path, *args):
+        # Another process evicts the file between the read and the mtime bump
+        Path(path).unlink()
+        utime(path, *args)
+
+    monkeypatch.setattr(cache_module.os, "utime", evicting_utime)
+    assert cache.read(URL) == b"data"
+
+
+def test_open_survives_concurrent_eviction(tmp_path, monkeypatch):
+    client = StaticClient(png_bytes())
+    cache = ImageCache(tmp_path, client=client)
+    cache.write(URL, client.data)
+    image_open = Image.open
+
+    def evicting_open(source, *args):
+        # Another process evicts the file between the existence check and opening it
+        if isinstance(source, Path):
+            source.unlink()
+        return image_open(source, *args)
+
+    monkeypatch.setattr(cache_module.Image, "open", evicting_open)
+    assert cache.open(URL).size == (80, 60)
+    assert client.requests == 1
@@ -0,0 +1,67 @@
+import pytest
+import requests as rq
+
+from mars2020.catalog import Catalog
+
+from conftest import make_records
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    with Catalog(tmp_path / "catalog.sqlite") as catalog:
+        yield catalog
+
+
+def test_full_sync(catalog, feed_server, client):
+    assert catalog.sync(feed_url=feed_server.feed_url, client=client) == 1000
+    assert len(catalog) == 1000
+    assert catalog.complete
+    assert catalog.last_sol == 99
+
+
+def test_incremental_sync(catalog, feed_server, client):
+    catalog.sync(feed_url=feed_server.feed_url, client=client)
+    feed_server.records = make_records(25, first=1000) + feed_server.records
+    feed_server.requests = 0
+    assert catalog.sync(feed_url=feed_server.feed_url, client=client) == 25
+    assert len(catalog) == 1025
+    assert feed_server.requests == 2  # the page with the new records, then one with nothing newer
+    assert catalog.sync(feed_url=feed_server.feed_url, client=client) == 0
+
+
+def test_interrupted_full_sync_resumes(catalog, feed_server, client):
+    feed_server.fail_pages = {7}
+    with pytest.raises(rq.HTTPError):
+        catalog.sync(feed_url=feed_server.feed_url, client=client, workers=1)
+    assert 0 < len(catalog) < 1000
+    assert not catalog.complete
+    feed_server.fail_pages = set()
+    catalog.sync(feed_url=feed_server.feed_url, client=client)
+    assert len(catalog) == 1000
+    assert catalog.complete
+
+
+def test_interrupted_full_sync_resumes_after_new_images(catalog, feed_server, client):
+    feed_server.fail_pages = {3, 4}
+    with pytest.raises(rq.HTTPError):
+        catalog.sync(feed_url=feed_server.feed_url, client=client)
+    feed_server.fail_pages = set()
+    # New images push the missing records onto later pages
+    feed_server.records = make_records(130, first=1000) + feed_server.records
+    catalog.sync(feed_url=feed_server.feed_url, client=client)
+    assert len(catalog) == 1130
+    assert catalog.complete
+
+
+def test_records_by_sol(catalog, feed_server, client):
+    catalog.sync(feed_url=feed_server.feed_url, client=client)
+    assert {record["sol"] for record in catalog.records(sol=4)} == {4}
+    assert len(list(catalog.records(sol=(4, 6)))) == 30
+
+
+def test_sync_sols(catalog, feed_server, client):
+    assert catalog.sync_sols([(4, 6), 9], feed_url=feed_server.feed_url, client=client) == 40
+    assert {record["sol"] for record in catalog.records()} == {4, 5, 6, 9}
+    assert not catalog.complete
+    assert catalog.sync(feed_url=feed_server.feed_url, client=client) == 960
+    assert catalog.complete
@@ -0,0 +1,82 @@
+import time
+
+import pytest
+import requests as rq
+
+from mars2020.client import HTTPClient, TokenBucket
+
+
+def page_url(feed_server, page: int = 0) -> str:
+    return f"{feed_server.feed_url}&num=10&page={page}"
+
+
+def make_client(**settings) -> HTTPClient:
+    return HTTPClient(**{"retries": 2, "backoff": 0.01, "http2": False, **settings})
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_retries_then_succeeds(feed_server, status):
+    feed_server.faults[0] = [{"status": status}]
+    with make_client() as client:
+        assert client.get_json(page_url(feed_server))["images"] == feed_server.records[:10]
+    assert feed_server.requests == 2
+
+
+def test_client_errors_are_not_retried(feed_server):
+    feed_server.faults[0] = [{"status": 404}]
+    with make_client() as client:
+        assert client.get(page_url(feed_server)).status_code == 404
+    assert feed_server.requests == 1
+
+
+def test_retry_count_is_respected(feed_server):
+    feed_server.faults[0] = [{"status": 503}] * 5
+    with make_client() as client:
+        assert client.get(page_url(feed_server)).status_code == 503
+        assert feed_server.requests == 3
+        with pytest.raises(rq.HTTPError):
+            client.get_json(page_url(feed_server), retries=1)
+    assert feed_server.requests == 5
+
+
+def test_retry_after_is_honoured(feed_server):
+    feed_server.faults[0] = [{"status": 503, "headers": {"Retry-After": "0.3"}}]
+    with make_client() as client:
+        client.get(page_url(feed_server))
+    first, second = feed_server.request_times
+    assert second - first >= 0.3
+
+
+def test_retry_after_is_capped(feed_server):
+    feed_server.faults[0] = [{"status": 429, "headers": {"Retry-After": "3600"}}]
+    with make_client(max_backoff=0.2) as client:
+        client.get(page_url(feed_server))
+    first, second = feed_server.request_times
+    assert 0.2 <= second - first < 2
+
+
+def test_get_json_retries_truncated_body(feed_server):
+    feed_server.faults[0] = [{"truncate": 10}, {"truncate": 10}]
+    with make_client() as client:
+        assert client.get_json(page_url(feed_server))["images"] == feed_server.records[:10]
+        assert feed_server.requests == 3
+        feed_server.faults[0] = [{"truncate": 10}]
+        with pytest.raises(ValueError):
+            client.get_json(page_url(feed_server), retries=0)
+
+
+def test_token_bucket_pacing():
+    bucket = TokenBucket(rate=20, burst=2)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # The burst goes through at once, the other 4 at 20 per second
+    assert 0.19 <= time.monotonic() - start < 0.5
+
+
+def test_rate_limited_requests_are_spaced(feed_server):
+    with make_client(rate=20, burst=1) as client:
+        for _ in range(4):
+            client.get(page_url(feed_server))
+    gaps = [later - earlier for earlier, later in zip(feed_server.request_times, feed_server.request_times[1:])]
+    assert min(gaps) >= 0.04
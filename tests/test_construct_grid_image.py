@@ -0,0 +1,92 @@
+import argparse
+import importlib.machinery
+import importlib.util
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from mars2020 import image_api as mapi
+
+from conftest import cluster_records, make_records, png_bytes
+
+# The tool is a script without a .py suffix
+_loader = importlib.machinery.SourceFileLoader(
+    "construct_grid_image", str(Path(__file__).parents[1] / "tools" / "construct_grid_image")
+)
+tool = importlib.util.module_from_spec(importlib.util.spec_from_loader(_loader.name, _loader))
+_loader.exec_module(tool)
+
+
+def test_parse_sols():
+    assert tool.parse_sols("40-50,52") == [(40, 50), (52, 52)]
+    with pytest.raises(argparse.ArgumentTypeError):
+        tool.parse_sols("40-x")
+
+
+def test_merge_sols():
+    assert tool.merge_sols([(40, 50), (45, 45), (51, 52), (60, 55), (62, 62)]) == [(40, 52), (55, 60), (62, 62)]
+    assert tool.merge_sols([]) == []
+
+
+def test_select_images():
+    records = make_records(40)
+    for n, record in enumerate(records):
+        record["camera"]["instrument"] = "NAVCAM_LEFT" if n % 2 else "FRONT_HAZCAM_LEFT_A"
+        if n % 3:
+            # Full-size frames; the others are thumbnails
+            record["imageid"] = record["imageid"].replace("_T0030000", "_N0030000")
+    images = [mapi.ImageData.from_image_dictionary(record) for record in records]
+    parameters = tool.Parameters(sols=[(1, 1), (3, 3)], cameras=["NAVCAM_LEFT"])
+    selected = tool.select_images(images, parameters)
+    assert selected == [
+        image for image in images
+        if image.sol in (1, 3)
+        and image.camera_type.instrument == "NAVCAM_LEFT"
+        and not image.instrument_metadata.thumbnail
+    ]
+    assert selected
+    assert len(tool.select_images(images, tool.Parameters())) == sum(
+        not image.instrument_metadata.thumbnail for image in images
+    )
+
+
+@pytest.fixture
+def clusters(image_cache):
+    records = cluster_records(2, 4, image_url="http://example.invalid", dimension=(40, 30))
+    for n, record in enumerate(records):
+        image_cache.write(record["image_files"]["full_res"], png_bytes(Image.new("RGB", (40, 30), (n, n, n))))
+    images = [mapi.ImageData.from_image_dictionary(record) for record in records]
+    return mapi.ImageDataCollection(images, None, len(images), len(images))
+
+
+@pytest.mark.parametrize("layers", [False, True])
+def test_save_clusters_resumes(clusters, tmp_path, layers):
+    parameters = tool.Parameters(output_directory=str(tmp_path / "grids"), save_as_layers=layers, grid_size=4)
+    grid_clusters = tool.imp.get_image_clusters(clusters, 4)
+    paths = [tool.output_path(cluster, parameters) for cluster in grid_clusters]
+    # Leftovers of an interrupted run: a partial output, and a layers directory without its manifest
+    Path(parameters.output_directory).mkdir()
+    tool.partial_path(paths[0]).write_bytes(b"partial")
+    if layers:
+        paths[1].mkdir()
+        (paths[1] / "layer-0.png").write_bytes(b"partial")
+
+    events = []
+    assert tool.save_clusters(clusters, parameters, events.append, workers=2) == {
+        "saved": 2, "skipped": 0, "failed": 0
+    }
+    for cluster, path in zip(grid_clusters, paths):
+        assert tool.is_saved(cluster, parameters)
+        if layers:
+            assert (path / "layers.json").exists()
+        else:
+            assert Image.open(path).size == (2 * 38, 2 * 28)
+    # Nothing but the finished outputs is left
+    assert sorted(Path(parameters.output_directory).iterdir()) == sorted(paths)
+
+    events.clear()
+    assert tool.save_clusters(clusters, parameters, events.append, workers=2) == {
+        "saved": 0, "skipped": 2, "failed": 0
+    }
+    assert [event["event"] for event in events] == ["clusters", "done"]
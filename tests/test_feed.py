@@ -0,0 +1,48 @@
+import math
+
+import pytest
+import requests as rq
+
+from mars2020 import image_api as mapi
+from mars2020.client import HTTPClient
+
+
+@pytest.fixture
+def retrying_client():
+    with HTTPClient(retries=2, backoff=0.01, http2=False) as client:
+        yield client
+
+
+def image_ids(records):
+    return [record["imageid"] for record in records]
+
+
+@pytest.mark.parametrize("page_size", [100, 64, 1000, 1500])
+def test_fetch_all_keeps_feed_order(feed_server, client, page_size):
+    pages = list(
+        mapi.fetch_all_feed_pages(workers=4, page_size=page_size, feed_url=feed_server.feed_url, client=client)
+    )
+    assert len(pages) == math.ceil(len(feed_server.records) / page_size)
+    collection = mapi.ImageDataCollection.fetch_all_mars2020_imagedata(
+        workers=4, page_size=page_size, feed_url=feed_server.feed_url, client=client, lazy=True
+    )
+    assert [image.image_id for image in collection.images] == image_ids(feed_server.records)
+    assert len(collection) == collection.number_of_images == 1000
+
+
+def test_fetch_all_retries_failed_page(feed_server, retrying_client):
+    feed_server.faults[3] = [{"status": 503}, {"truncate": 100}]
+    collection = mapi.ImageDataCollection.fetch_all_mars2020_imagedata(
+        workers=4, page_size=100, feed_url=feed_server.feed_url, client=retrying_client
+    )
+    assert [image.image_id for image in collection.images] == image_ids(feed_server.records)
+    assert feed_server.requests == 1 + 10 + 2
+
+
+@pytest.mark.parametrize("faults", [[{"status": 503}] * 3, [{"status": 404}]])
+def test_fetch_all_raises_failed_page(feed_server, retrying_client, faults):
+    feed_server.faults[3] = faults
+    with pytest.raises(rq.HTTPError):
+        mapi.ImageDataCollection.fetch_all_mars2020_imagedata(
+            workers=4, page_size=100, feed_url=feed_server.feed_url, client=retrying_client
+        )
@@ -0,0 +1,68 @@
+import dataclasses
+
+import pytest
+
+from mars2020 import image_api as mapi
+
+from conftest import make_records
+
+
+@pytest.fixture
+def collection():
+    images = [mapi.ImageData.from_image_dictionary(record) for record in make_records(30)]
+    return mapi.ImageDataCollection(images, None, len(images), len(images))
+
+
+def test_indexes_follow_appends(collection):
+    assert len(collection.by_sol(2)) == 10
+    collection.extend(mapi.ImageData.from_image_dictionary(record) for record in make_records(10, first=20))
+    assert len(collection.by_sol(2)) == 20
+    assert len(collection.to_table()) == 40
+
+
+@pytest.mark.parametrize(
+    "mutate",
+    [
+        lambda images: images.sort(key=lambda image: image.image_id),
+        lambda images: images.reverse(),
+        lambda images: images.__setitem__(0, images[-1]),
+    ],
+)
+def test_invalidate_after_in_place_change(collection, mutate):
+    collection.by_sol(0)
+    collection.to_table()
+    mutate(collection.images)
+    collection.invalidate()
+    for sol in (0, 1, 2):
+        expected = [image for image in collection.images if image.sol == sol]
+        assert collection.by_sol(sol) == expected
+        assert collection.query(sol=sol) == expected
+    assert collection.to_table().images() == collection.images
+
+
+def test_lazy_images_compare_and_replace():
+    record = make_records(1)[0]
+    eager = mapi.ImageData.from_image_dictionary(record)
+    lazy = mapi.ImageData.from_image_dictionary(record, lazy=True)
+    assert eager == lazy and lazy == eager
+    assert lazy == mapi.ImageData.from_image_dictionary(record, lazy=True)
+    replaced = dataclasses.replace(lazy, sol=3)
+    assert replaced.sol == 3 and replaced != eager
+    assert replaced == dataclasses.replace(eager, sol=3)
+    assert mapi.ImageData.from_image_dictionary(replaced.to_image_dictionary()) == replaced
+
+
+def test_indexes_are_built_per_field(collection):
+    collection.clusters()
+    assert set(collection._index) == {"cluster_id"}
+    assert collection.query(sol=1, thumbnail=True) == collection.by_sol(1)
+    assert set(collection._index) == {"cluster_id", "sol", "thumbnail"}
+
+
+def test_image_files_is_optional():
+    image = mapi.ImageData.from_image_dictionary(make_records(1)[0])
+    fields = {name: getattr(image, name) for name in mapi._IMAGE_DATA_PARSERS if name != "image_files"}
+    constructed = mapi.ImageData(**fields)
+    assert constructed.image_files == {}
+    assert constructed.select_rendition(mode="thumbnail") == "full_res"
+    assert mapi.ImageData(**fields).image_files is not constructed.image_files
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from PIL import Image
+from scipy.ndimage import convolve
+
+from mars2020 import image_processing as imp
+
+from conftest import cached_frames
+
+
+@pytest.mark.parametrize("dimension", [(80, 60), (160, 120), (40, 30)])
+def test_grid_uses_decoded_frame_sizes(image_cache, dimension):
+    images = cached_frames(image_cache, 4, (80, 60), dimension)
+    grid = imp.compose_grid(images)
+    assert grid.shape == (2 * 58, 2 * 78, 4)
+    assert grid[0, 0, 0] == 0 and grid[-1, -1, 0] == 3
+
+
+def test_save_grid_layers(image_cache, tmp_path):
+    images = cached_frames(image_cache, 4, (80, 60), (80, 60))
+    directory = imp.save_grid_layers(images, tmp_path / "layers")
+    assert sorted(path.name for path in directory.iterdir()) == [
+        "layer-0.png", "layer-1.png", "layer-2.png", "layer-3.png", "layers.json"
+    ]
+    assert np.array_equal(imp.compose_grid(images), np.asarray(imp.grid_from_imageset(images)))
+
+
+@pytest.mark.parametrize("suffix", [".npy", ".png"])
+def test_save_grid_reads_headers_once(image_cache, tmp_path, monkeypatch, suffix):
+    images = cached_frames(image_cache, 4, (80, 60), (80, 60))
+    expected = imp.compose_grid(images)
+    calls = []
+    grid_geometry = imp._grid_geometry
+    monkeypatch.setattr(imp, "_grid_geometry", lambda images: calls.append(1) or grid_geometry(images))
+    path = imp.save_grid(images, tmp_path / f"grid{suffix}")
+    assert len(calls) == 1
+    saved = np.load(path) if suffix == ".npy" else np.asarray(Image.open(path))
+    assert np.array_equal(saved, expected)
+
+
+def bayer_sites(pattern: str, shape) -> dict:
+    masks = {colour: np.zeros(shape, dtype=bool) for colour in "RGB"}
+    for colour, (y, x) in zip(pattern, [(0, 0), (0, 1), (1, 0), (1, 1)]):
+        masks[colour][y::2, x::2] = True
+    return masks
+
+
+@pytest.mark.parametrize("method", imp.DEMOSAIC_METHODS)
+@pytest.mark.parametrize("pattern", imp.BAYER_PATTERNS)
+@pytest.mark.parametrize("colour", "RGB")
+def test_demosaic_pure_colour(pattern, method, colour):
+    cfa = np.where(bayer_sites(pattern, (12, 16))[colour], 200, 0).astype(np.uint8)
+    rgb = np.asarray(imp.demosaic_image(Image.fromarray(cfa), pattern=pattern, method=method))
+    for index, channel in enumerate("RGB"):
+        # Including the borders: no bleed into the other channels
+        assert (rgb[..., index] == (200 if channel == colour else 0)).all(), channel
+
+
+def legacy_demosaic(cfa: np.ndarray, pattern: str) -> np.ndarray:
+    """
+    The original scipy-convolution bilinear demosaicing, for reference.
+    """
+    image = cfa.astype(np.float64) / 255
+    h_g = np.array([[0, 1, 0], [1, 4, 1], [0, 1, 0]], dtype=np.float64) / 4
+    h_rb = np.array([[1, 2, 1], [2, 4, 2], [1, 2, 1]], dtype=np.float64) / 4
+    masks = bayer_sites(pattern, cfa.shape)
+    channels = [convolve(image * masks[c], h_g if c == "G" else h_rb) for c in "RGB"]
+    return (np.stack(channels, axis=-1) * 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("pattern", imp.BAYER_PATTERNS)
+def test_demosaic_matches_legacy_interior(pattern):
+    cfa = np.random.default_rng(0).integers(0, 256, (32, 48), dtype=np.uint8)
+    rgb = np.asarray(imp.demosaic_image(Image.fromarray(cfa), pattern=pattern)).astype(int)
+    legacy = legacy_demosaic(cfa, pattern).astype(int)
+    assert np.abs(rgb[1:-1, 1:-1] - legacy[1:-1, 1:-1]).max() <= 1
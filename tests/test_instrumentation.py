@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+from mars2020 import instrumentation
+from mars2020.batch import BatchProcessor
+
+from conftest import cached_frames
+
+
+@pytest.mark.parametrize(
+    "url, name",
+    [
+        ("https://mars.nasa.gov/rss/api/?feed=raw_images&num=100&page=3", "mars.nasa.gov/rss/"),
+        (
+            "https://mars.nasa.gov/mars2020-raw-images/pub/ods/surface/sol/00045/ids/edr/browse/ncam/image.png",
+            "mars.nasa.gov/mars2020-raw-images/",
+        ),
+        ("http://localhost:8080/image.png", "localhost:8080/"),
+    ],
+)
+def test_endpoint(url, name):
+    assert instrumentation.endpoint(url) == name
+
+
+def test_worker_events_reach_parent_listeners(image_cache, tmp_path):
+    images = cached_frames(image_cache, 4, (80, 60), (80, 60))
+    events = []
+    emitters = tmp_path / "emitters"
+
+    def listener(event):
+        # Written to a file, so events emitted in (forked) workers show up too
+        with open(emitters, "a") as emitters_file:
+            emitters_file.write(f"{os.getpid()}\n")
+        events.append(event)
+
+    instrumentation.add_listener(listener)
+    try:
+        with BatchProcessor(workers=2) as processor:
+            assert len(list(processor.decode(images))) == 4
+    finally:
+        instrumentation.remove_listener(listener)
+    assert sum(event.kind == "decode" for event in events) == 4
+    assert set(emitters.read_text().split()) == {str(os.getpid())}
+    assert sum(event.size for event in events if event.kind == "decode") == 4 * 80 * 60
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from mars2020 import image_api as mapi
+from mars2020.client import HTTPClient
+
+# 1 byte, a size that splits numbers and multi-byte UTF-8 characters, and the default chunk size
+CHUNK_SIZES = [1, 7, 64 * 1024]
+
+DOCUMENT = {
+    "total_results": 123456.789e2,
+    "meta": {"a": [1, 2, {"images": "]}"}], "b": "not, the [images] }"},
+    "images": [
+        {"title": "a ] b } c , d [ {", "caption": "héllo → 火星 🚀", "sol": 123456789},
+        {"x": -1.5e-3, "y": [True, False, None], "z": {}},
+        [],
+        "\"]},",
+        1234567890123,
+    ],
+    "after": "ignored",
+}
+
+
+def chunked(data: bytes, size: int):
+    return (data[start: start + size] for start in range(0, len(data), size))
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_iter_json_array(size):
+    data = json.dumps(DOCUMENT, ensure_ascii=False).encode("utf-8")
+    assert list(mapi.iter_json_array(chunked(data, size), "images")) == DOCUMENT["images"]
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_iter_json_array_missing_key(size):
+    data = json.dumps({"total_results": 0, "other": [1, 2]}).encode("utf-8")
+    assert list(mapi.iter_json_array(chunked(data, size), "images")) == []
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+@pytest.mark.parametrize("text", ['{"images": []}', '{ "images" : [ ] , "total_results": 0 }'])
+def test_iter_json_array_empty(size, text):
+    assert list(mapi.iter_json_array(chunked(text.encode("utf-8"), size), "images")) == []
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_stream_feed_page_resumes_after_failure(feed_server, size):
+    expected = feed_server.records[:10]
+    body_length = len(json.dumps({"images": expected, "total_results": 1000}).encode("utf-8"))
+    # The connection drops halfway through the body, after several records were yielded
+    feed_server.faults[0] = [{"disconnect": body_length // 2}]
+    with HTTPClient(retries=2, backoff=0.01, http2=False) as client:
+        records = list(mapi.stream_feed_page(10, 0, client=client, feed_url=feed_server.feed_url, chunk_size=size))
+    assert records == expected
+    assert feed_server.requests == 2
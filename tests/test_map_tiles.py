@@ -0,0 +1,18 @@
+from types import SimpleNamespace
+
+import pytest
+
+from mars2020.map_tiles import TileCache, TiledWMSLayer
+
+
+@pytest.mark.parametrize(
+    "version, crs, bbox",
+    [("1.1.1", "srs", "0.5,0.25,0.75,0.5"), ("1.3.0", "crs", "0.25,0.5,0.5,0.75")],
+)
+def test_getmap_params_axis_order(tmp_path, version, crs, bbox):
+    web_map = SimpleNamespace(url="http://localhost/wms", version=version)
+    layer = TiledWMSLayer(web_map, "layer", tile_cache=TileCache(tmp_path))
+    params = layer.getmap_params((2, 2, 1))  # longitudes 0.5-0.75, latitudes 0.25-0.5
+    assert params[crs] == "EPSG:4326"
+    assert params["bbox"] == bbox
+    assert "bgcolor" not in params
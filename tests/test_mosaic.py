@@ -0,0 +1,82 @@
+import copy
+import io
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from mars2020 import image_api as mapi
+from mars2020 import mosaic
+
+from conftest import FIXTURE
+
+SIZE = (160, 120)  # each frame spans the whole NAVCAM sensor, 96 by 72 degrees
+
+
+def pointed_frames(image_cache, pointings, colours=None):
+    """
+    NAVCAM frames without a camera model, pointed at (azimuth, elevation) and filled with a solid colour.
+    """
+    template = json.loads(FIXTURE.read_text())["images"][0]
+    images = []
+    for n, (azimuth, elevation) in enumerate(pointings):
+        record = copy.deepcopy(template)
+        record["imageid"] = f"NLF_0045_{671186153 + n:010d}_000ECM_N0030000NCAM00000_0000LUJ01"
+        record["camera"]["camera_model_type"] = None
+        record["camera"]["camera_model_component_list"] = None
+        record["extended"].update(
+            mastAz=str(azimuth),
+            mastEl=str(elevation),
+            subframeRect="(1,1,5120,3840)",
+            dimension=f"({SIZE[0]},{SIZE[1]})",
+        )
+        record["image_files"] = {"full_res": f"http://example.invalid/mosaic/{n}.png"}
+        colour = colours[n] if colours else (200, 200, 200)
+        buffer = io.BytesIO()
+        Image.new("RGB", SIZE, colour).save(buffer, format="PNG")
+        image_cache.write(record["image_files"]["full_res"], buffer.getvalue())
+        images.append(mapi.ImageData.from_image_dictionary(record))
+    return images
+
+
+def canvas_position(panorama: mosaic.Mosaic, azimuth: float, elevation: float):
+    column = ((azimuth - panorama.origin[0]) % 360) / panorama.resolution
+    row = (panorama.origin[1] - elevation) / panorama.resolution
+    return int(row), int(column)
+
+
+def test_frames_land_at_their_azimuths(image_cache):
+    red, blue = (255, 0, 0), (0, 0, 255)
+    images = pointed_frames(image_cache, [(10, 0), (70, 0)], [red, blue])
+    with mosaic.Mosaic.from_images(images, feather=0) as panorama:
+        pixels = panorama.render().to_array()
+        assert not panorama.full_circle
+        assert panorama.origin[0] == pytest.approx(10 - 48, abs=0.5)
+        assert panorama.shape[1] * panorama.resolution == pytest.approx(60 + 96, abs=1)
+        # Where only one frame reaches, the canvas shows its colour
+        assert tuple(pixels[canvas_position(panorama, -20, 0)]) == (*red, 255)
+        assert tuple(pixels[canvas_position(panorama, 100, 0)]) == (*blue, 255)
+
+
+def test_full_circle_has_no_seam(image_cache):
+    images = pointed_frames(image_cache, [(azimuth, 0) for azimuth in range(0, 360, 45)])
+    with mosaic.Mosaic.from_images(images) as panorama:
+        pixels = panorama.render().to_array()
+        assert panorama.full_circle
+        row = canvas_position(panorama, 0, 0)[0]
+        assert (pixels[row, :, 3] == 255).all()
+        assert (np.abs(pixels[row, :, :3].astype(int) - 200) <= 1).all()
+        # A frame straddling the seam lands in two windows
+        assert any(len(panorama.windows(placement)) == 2 for placement in panorama.placements)
+
+
+def test_transparent_where_no_frame_reaches(image_cache):
+    images = pointed_frames(image_cache, [(0, 0), (150, 0)])
+    with mosaic.Mosaic.from_images(images) as panorama:
+        pixels = panorama.render().to_array()
+        # The frames span -48..48 and 102..198 degrees
+        row, gap = canvas_position(panorama, 75, 0)
+        assert pixels[row, gap, 3] == 0 and (pixels[row, gap, :3] == 0).all()
+        assert pixels[canvas_position(panorama, 0, 0)][3] == 255
+        assert pixels[canvas_position(panorama, 150, 0)][3] == 255
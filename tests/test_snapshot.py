@@ -0,0 +1,53 @@
+import dataclasses
+import json
+import pickle
+
+import pytest
+
+from mars2020 import image_api as mapi
+
+from conftest import FIXTURE, make_records
+
+
+@pytest.fixture(params=[False, True], ids=["eager", "lazy"])
+def collection(request):
+    records = json.loads(FIXTURE.read_text())["images"] + make_records(20)
+    images = [mapi.ImageData.from_image_dictionary(record, lazy=request.param) for record in records]
+    return mapi.ImageDataCollection(images, None, len(images), len(images))
+
+
+def fields(image: mapi.ImageData) -> tuple:
+    return dataclasses.astuple(image)
+
+
+def test_to_image_dictionary_round_trip(collection):
+    for image in collection.images:
+        assert fields(mapi.ImageData.from_image_dictionary(image.to_image_dictionary())) == fields(image)
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_save_load(collection, tmp_path, mmap):
+    loaded = mapi.ImageDataCollection.load(collection.save(tmp_path / "snapshot"), mmap=mmap)
+    assert len(loaded) == len(collection)
+    assert [fields(image) for image in loaded.images] == [fields(image) for image in collection.images]
+    assert loaded.to_table().where(sol=1).images()[0].sol == 1
+    # Snapshots of snapshots copy the stored records
+    reloaded = mapi.ImageDataCollection.load(loaded.save(tmp_path / "copy"))
+    assert [fields(image) for image in reloaded.images] == [fields(image) for image in collection.images]
+
+
+def test_pickle_without_store(collection, tmp_path):
+    loaded = mapi.ImageDataCollection.load(collection.save(tmp_path / "snapshot"))
+    image = pickle.loads(pickle.dumps(loaded.images[0]))
+    assert type(image) is mapi.LazyImageData
+    assert fields(image) == fields(collection.images[0])
+
+
+def test_snapshot_images_compare_and_replace(collection, tmp_path):
+    loaded = mapi.ImageDataCollection.load(collection.save(tmp_path / "snapshot"))
+    assert loaded.images == collection.images
+    replaced = dataclasses.replace(loaded.images[0], sol=3)
+    assert replaced.sol == 3 and replaced == dataclasses.replace(collection.images[0], sol=3)
+    assert pickle.loads(pickle.dumps(replaced)) == replaced
+    copy = mapi.ImageDataCollection.load(mapi.ImageDataCollection([replaced], None, 1, 1).save(tmp_path / "copy"))
+    assert copy.images == [replaced]